@@ -1,9 +1,8 @@
 import csv
-import locale
 from os import read, write
 from pathlib import Path
 
-locale.setlocale(locale.LC_ALL, "en_US.UTF-8")
+from v3.manifest_reader import parse_size
 
 S3_ACR_DATA_DIR = Path("/Users/andrew/CTDS/projects/midrc/s3-data/raw/acrimage/")
 IMAGING_DATA_MANIFESTS = [
@@ -86,7 +85,7 @@ def read_manifest_txt_v2(filename, open_files, seq_files):
                 md5sum = row["md5sum"]
 
             filesize = row["file_size"] if "file_size" in row else row["*file_size"]
-            filesize = locale.atoi(filesize)
+            filesize = parse_size(filesize)
 
             case_id = row["submitter_id"].split("_")[0]
             # study_id = row["storage_urls"].split("/")[6]
@@ -130,7 +129,7 @@ def read_manifest_txt(filename):
             # print(md5sum)
 
             filesize = row["file_size"] if "file_size" in row else row["*file_size"]
-            filesize = locale.atoi(filesize)
+            filesize = parse_size(filesize)
 
             study_id = row["storage_urls"].split("/")[5]
             series_id = row["series.submitter_id"]
@@ -1,8 +1,7 @@
 import csv
-import locale
 from pathlib import Path
 
-locale.setlocale(locale.LC_ALL, "en_US.UTF-8")
+from v3.manifest_reader import parse_size
 
 DATA_DIR = Path("/Users/andrew/CTDS/misc-projects/midrc/data/")
 S3_RSNA_DATA_DIR = DATA_DIR.joinpath("s3-data/rsna/")
@@ -34,7 +33,7 @@ def read_manifest(filename):
             urls = get_storage_url("open-data-midrc", row["storage_urls"])
 
             filesize = row["file_size"]
-            filesize = locale.atoi(filesize)
+            filesize = parse_size(filesize)
             data = {
                 "guid": "",
                 "md5": row["md5sum"],
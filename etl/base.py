@@ -1,5 +1,4 @@
 import json
-import pandas as pd
 import csv
 import yaml
 import createZipFiles as packaging
@@ -7,6 +6,8 @@ from urllib.parse import urlparse
 import os
 import logging
 
+from v3.manifest_reader import read_manifest
+
 logging.basicConfig(
     level=logging.DEBUG,
     format="%(asctime)s %(levelname)s %(name)s %(message)s",
@@ -19,11 +20,8 @@ with open("config.yml", "rt", encoding="utf8") as ymlfile:
 
 def main():
 
-    dataframe = pd.read_csv(
+    dataframe = read_manifest(
         cfg["manifest"]["file_name"],
-        sep="\t",
-        header=0,
-        low_memory=False,
         usecols=[
             "file_name",
             "file_size",
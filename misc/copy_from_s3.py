@@ -3,11 +3,23 @@
 import argparse
 import csv
 import os
+import random
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import partial
 
 import boto3.session
 import tqdm
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from v3.s3_inventory import inventory_delta, read_inventory
+
+# Bucket.copy uses the default TransferConfig, so objects above its threshold
+# are copied in parts of this size and get a '<hash>-<parts>' ETag
+COPY_PART_SIZE = TransferConfig().multipart_chunksize
 
 
 def download_file(s3: boto3.session.Session.resource, src_bucket: str, src_key: str):
@@ -53,24 +65,177 @@ def read_manifest(filename):
     return manifest
 
 
-def run_command(func, manifest, num_workers):
+def sync_manifest(s3, src_inventory, dst_inventory, keys=None, prefixes=None):
+    """
+    Keys to copy for a sync: the source inventory rows missing from the
+    destination inventory or differing in size or ETag (multipart copies
+    made by copy_file are recognised by their part count)
+    """
+    client = s3.meta.client
+    src = read_inventory(src_inventory, keys=keys, prefixes=prefixes, s3_client=client)
+    dst = read_inventory(dst_inventory, keys=keys, prefixes=prefixes, s3_client=client)
+    delta = inventory_delta(src, dst, part_size=COPY_PART_SIZE)["key"].to_pylist()
+    print(
+        "Source inventory: {} objects, destination inventory: {} objects, to copy: {}".format(
+            src.num_rows, dst.num_rows, len(delta)
+        )
+    )
+    if keys is not None:
+        # objects created after the inventory snapshot are not in it yet
+        inventoried = set(src["key"].to_pylist())
+        not_inventoried = [key for key in keys if key not in inventoried]
+        if not_inventoried:
+            print(
+                "{} manifest keys are not in the source inventory and will be copied too".format(
+                    len(not_inventoried)
+                )
+            )
+            delta.extend(not_inventoried)
+    return delta
+
+
+THROTTLING_ERROR_CODES = {
+    "SlowDown",
+    "503",
+    "ServiceUnavailable",
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "RequestThrottled",
+}
+
+
+def is_throttling_error(err):
+    if not isinstance(err, ClientError):
+        return False
+    code = err.response.get("Error", {}).get("Code")
+    status = err.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return code in THROTTLING_ERROR_CODES or status == 503
+
+
+class AdaptiveConcurrency:
+    """
+    Additive-increase/multiplicative-decrease limit on requests in flight
+
+    The limit halves whenever S3 throttles (SlowDown/503) and grows by one
+    after every `increase_after` consecutive successes, never above max_limit.
+    """
+
+    def __init__(self, max_limit, increase_after=50):
+        self.max_limit = max_limit
+        self.limit = max_limit
+        self.increase_after = increase_after
+        self.in_flight = 0
+        self.min_limit_seen = max_limit
+        self._successes = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.min_limit_seen = min(self.min_limit_seen, self.limit)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if (
+                    self._successes >= self.increase_after
+                    and self.limit < self.max_limit
+                ):
+                    self.limit += 1
+                    self._successes = 0
+            self._cond.notify_all()
+
+
+class RunStats:
+    def __init__(self):
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for name, count in counts.items():
+                setattr(self, name, getattr(self, name) + count)
+
+
+def run_with_retries(
+    func, key, limiter, stats, max_retries, base_delay=0.5, max_delay=30
+):
+    """
+    Runs func for one key under the concurrency limiter, retrying with
+    exponential backoff and full jitter; throttling also shrinks the limit
+    """
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            func(src_key=key, dst_key=key)
+        except Exception as err:
+            throttled = is_throttling_error(err)
+            limiter.release(throttled=throttled)
+            stats.add(throttled=int(throttled))
+            if attempt == max_retries:
+                raise
+            stats.add(retries=1)
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2**attempt)))
+        else:
+            limiter.release()
+            return
+
+
+def run_command(func, manifest, num_workers, max_retries=5):
     # List for storing possible failed downloads to retry later
     failed_downloads = []
+    limiter = AdaptiveConcurrency(num_workers)
+    stats = RunStats()
+    start_time = time.time()
 
     with tqdm.tqdm(desc="Processing...", total=len(manifest)) as pbar:
-        with ThreadPoolExecutor(max_workers=1) as executor:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
             # Using a dict for preserving the downloaded file for each future, to store it as a failure if we need that
             futures = {
                 executor.submit(
-                    func, src_key=file_to_download, dst_key=file_to_download
+                    run_with_retries,
+                    func,
+                    file_to_download,
+                    limiter,
+                    stats,
+                    max_retries,
                 ): file_to_download
                 for file_to_download in manifest
             }
             for future in as_completed(futures):
                 if future.exception():
                     failed_downloads.append([futures[future]])
+                    stats.add(failed=1)
+                else:
+                    stats.add(succeeded=1)
                 pbar.update(1)
 
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(
+        "Done: {} succeeded, {} failed, {} retries ({} throttled) in {:.0f}s; "
+        "{:.1f} objects/s; concurrency {} (lowest {}, max {})".format(
+            stats.succeeded,
+            stats.failed,
+            stats.retries,
+            stats.throttled,
+            elapsed,
+            stats.succeeded / elapsed,
+            limiter.limit,
+            limiter.min_limit_seen,
+            num_workers,
+        )
+    )
+
     if len(failed_downloads) > 0:
         print("Some processing have failed. Saving paths to csv...")
         with open("./failed_downloads.csv", "w", newline="\n") as csvfile:
@@ -82,10 +247,18 @@ num_workers_parser = argparse.ArgumentParser(add_help=False)
 num_workers_parser.add_argument(
     "--num-workers",
     action="store",
-    default="4",
-    type=str,
+    default=4,
+    type=int,
     required=False,
-    help="",
+    help="maximum number of objects processed concurrently",
+)
+num_workers_parser.add_argument(
+    "--max-retries",
+    action="store",
+    default=5,
+    type=int,
+    required=False,
+    help="retries per object, with exponential backoff, before it is written to failed_downloads.csv",
 )
 s3_src_op_parser = argparse.ArgumentParser(add_help=False)
 s3_src_op_parser.add_argument(
@@ -126,6 +299,48 @@ move_parser = subparsers.add_parser(
     help="Move files between S3 buckets",
     parents=[s3_src_op_parser, s3_dst_op_parser, num_workers_parser],
 )
+sync_parser = subparsers.add_parser(
+    "sync",
+    help="Copy only the objects missing or different in the destination, by diffing S3 Inventories",
+    parents=[s3_dst_op_parser, num_workers_parser],
+)
+sync_parser.add_argument(
+    "-s",
+    "--src",
+    action="store",
+    type=str,
+    required=True,
+    help="source bucket",
+)
+sync_parser.add_argument(
+    "--src-inventory",
+    action="store",
+    type=str,
+    required=True,
+    help="manifest.json of the source bucket's S3 Inventory (Parquet), s3:// URL or local mirror path",
+)
+sync_parser.add_argument(
+    "--dst-inventory",
+    action="store",
+    type=str,
+    required=True,
+    help="manifest.json of the destination bucket's S3 Inventory (Parquet)",
+)
+sync_parser.add_argument(
+    "-m",
+    "--manifest",
+    action="store",
+    type=str,
+    required=False,
+    help="optional file of keys to restrict the sync to",
+)
+sync_parser.add_argument(
+    "--prefix",
+    action="append",
+    type=str,
+    required=False,
+    help="restrict the sync to keys under this prefix (repeatable)",
+)
 download_parser = subparsers.add_parser(
     "download",
     help="Download files from S3 buckets to local machine",
@@ -135,17 +350,30 @@ args = parser.parse_args()
 
 
 def main(args):
-    s3 = boto3.resource("s3")
+    # retries are handled by run_command so throttling can lower the concurrency
+    s3 = boto3.resource(
+        "s3",
+        config=Config(
+            max_pool_connections=max(10, args.num_workers),
+            retries={"mode": "standard", "max_attempts": 1},
+        ),
+    )
 
-    if args.command == "copy":
+    if args.command in ("copy", "sync"):
         command = copy_file
     elif args.command == "move":
         command = move_file
 
-    manifest = read_manifest(args.manifest)
+    if args.command == "sync":
+        keys = read_manifest(args.manifest) if args.manifest else None
+        manifest = sync_manifest(
+            s3, args.src_inventory, args.dst_inventory, keys=keys, prefixes=args.prefix
+        )
+    else:
+        manifest = read_manifest(args.manifest)
     func = partial(command, s3=s3, src_bucket=args.src, dst_bucket=args.dest)
 
-    run_command(func, manifest, args.num_workers)
+    run_command(func, manifest, args.num_workers, args.max_retries)
 
 
 if __name__ == "__main__":
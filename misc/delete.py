@@ -1,39 +1,336 @@
+#!/usr/bin/env python3
+
+"""
+Bulk delete indexd records
+
+Reads the guids to delete from a CSV with a guid column, looks up their
+current rev in batches through indexd's bulk documents endpoint (falling
+back to one GET per guid if the endpoint is not there) and deletes them
+with up to --concurrency requests in flight over pooled keep-alive
+connections. Responses 429 and 5xx, and connection errors, are retried with
+exponential backoff; the access token is refreshed from the API key before
+it expires and again on a 401.
+
+Every outcome is appended to the result log as "<guid> <status>". Guids
+logged as deleted (200/204) or gone (404) are skipped when the script is
+run again, so an interrupted run resumes where it stopped.
+
+    python3 delete.py --endpoint https://validate.midrc.org --credentials credentials.json --input total_seq.csv
+
+indexd_stub.py serves the same endpoints locally for trying it out.
+"""
+import argparse
 import asyncio
 import csv
+import json
+import random
 import time
+from collections import Counter
 
 import aiohttp
 from tqdm import tqdm
 
-start_time = time.time()
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# deleted, or no record to delete
+DONE_STATUSES = {"200", "204", "404"}
+# refresh the access token this long before it expires
+TOKEN_MARGIN = 60
+
+
+def backoff(attempt, base_delay=0.5, max_delay=30):
+    """
+    Exponential backoff with full jitter
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+class AccessToken:
+    """
+    Bearer token for the Authorization header, from a fixed token or
+    refreshed from a Gen3 API key through fence
+    """
+
+    def __init__(
+        self, session, endpoint, api_key=None, token=None, lifetime=1200, max_retries=5
+    ):
+        assert api_key or token, "An API key or an access token is needed"
+        self.session = session
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.lifetime = lifetime
+        self.max_retries = max_retries
+        self.token = token
+        self.expires = float("inf") if token else 0
+        self._lock = asyncio.Lock()
+
+    @property
+    def refreshable(self):
+        return self.api_key is not None
+
+    async def header(self):
+        if time.time() > self.expires - TOKEN_MARGIN:
+            await self.refresh(self.token)
+        return {"Authorization": "Bearer {}".format(self.token)}
+
+    async def refresh(self, stale):
+        """
+        Gets a new token, unless another request already replaced stale
+        """
+        async with self._lock:
+            if self.token != stale or not self.refreshable:
+                return
+            url = "{}/user/credentials/api/access_token".format(self.endpoint)
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async with self.session.post(
+                        url, json={"api_key": self.api_key}
+                    ) as r:
+                        status = r.status
+                        if status == 200:
+                            self.token = (await r.json())["access_token"]
+                            self.expires = time.time() + self.lifetime
+                            return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    status = type(err).__name__
+                if status not in RETRY_STATUSES and not isinstance(status, str):
+                    break
+                await asyncio.sleep(backoff(attempt))
+            raise RuntimeError(
+                "Could not get an access token from {}: {}".format(url, status)
+            )
+
+
+class IndexdDeleter:
+    """
+    Deletes indexd records with bounded concurrency and retries
+    """
+
+    def __init__(self, session, endpoint, token, concurrency=32, max_retries=5):
+        self.session = session
+        self.endpoint = endpoint
+        self.token = token
+        self.max_retries = max_retries
+        self.bulk = True
+        self.retries = Counter()
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(self, method, path, **kwargs):
+        """
+        Sends a request, retrying 429, 5xx and connection errors; returns
+        (status, JSON body or None), status being the exception name if the
+        last attempt failed without a response
+        """
+        url = "{}{}".format(self.endpoint, path)
+        refreshed = False
+        attempt = 0
+        while True:
+            headers = await self.token.header()
+            retry_after = None
+            try:
+                async with self._semaphore:
+                    async with self.session.request(
+                        method, url, headers=headers, **kwargs
+                    ) as r:
+                        status = r.status
+                        retry_after = r.headers.get("Retry-After")
+                        body = (
+                            await r.json(content_type=None) if status == 200 else None
+                        )
+            except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                status, body = type(err).__name__, None
+
+            if status == 401 and self.token.refreshable and not refreshed:
+                refreshed = True
+                await self.token.refresh(headers["Authorization"].split(" ", 1)[1])
+                continue
+            if (
+                not (status in RETRY_STATUSES or isinstance(status, str))
+                or attempt >= self.max_retries
+            ):
+                return status, body
+            self.retries[status] += 1
+            # full jitter; a Retry-After of the server takes precedence
+            delay = backoff(attempt)
+            if retry_after is not None and retry_after.isdigit():
+                delay = int(retry_after)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get_rev(self, guid):
+        status, body = await self.request("GET", "/index/index/{}".format(guid))
+        return status, body["rev"] if status == 200 else None
+
+    async def get_revs(self, guids):
+        """
+        Returns {guid: rev} for the guids with a record, and {guid: status}
+        for those whose rev could not be fetched (404 if there is no record)
+        """
+        if self.bulk:
+            status, body = await self.request(
+                "POST", "/index/bulk/documents", json=guids
+            )
+            if status == 200:
+                revs = {doc["did"]: doc["rev"] for doc in body}
+                return revs, {guid: 404 for guid in guids if guid not in revs}
+            if status in (404, 405):
+                # no bulk endpoint on this indexd
+                self.bulk = False
+
+        revs, failed = {}, {}
+        for guid, (status, rev) in zip(
+            guids, await asyncio.gather(*(self.get_rev(guid) for guid in guids))
+        ):
+            if rev is None:
+                failed[guid] = status
+            else:
+                revs[guid] = rev
+        return revs, failed
+
+    async def delete(self, guid, rev):
+        status, _ = await self.request(
+            "DELETE", "/index/index/{}".format(guid), params={"rev": rev}
+        )
+        if status == 409:
+            # the record changed since its rev was fetched
+            status, rev = await self.get_rev(guid)
+            if rev is not None:
+                status, _ = await self.request(
+                    "DELETE", "/index/index/{}".format(guid), params={"rev": rev}
+                )
+        return status
+
+
+def read_done(result_log):
+    """
+    Guids already deleted or found missing according to the result log
+    """
+    done = set()
+    try:
+        with open(result_log) as result_file:
+            for line in result_file:
+                guid, _, status = line.rstrip("\n").rpartition(" ")
+                if status in DONE_STATUSES:
+                    done.add(guid)
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def read_guids(path):
+    with open(path) as to_remove_files:
+        return [row["guid"] for row in csv.DictReader(to_remove_files)]
+
+
+async def run(args, guids):
+    stats = Counter()
+    connector = aiohttp.TCPConnector(limit=args.concurrency, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        api_key = None
+        if args.credentials is not None:
+            with open(args.credentials) as credentials_file:
+                api_key = json.load(credentials_file)["api_key"]
+        token = AccessToken(
+            session,
+            args.endpoint,
+            api_key=api_key,
+            token=args.token,
+            max_retries=args.max_retries,
+        )
+        deleter = IndexdDeleter(
+            session, args.endpoint, token, args.concurrency, args.max_retries
+        )
+
+        batches = asyncio.Queue()
+        for start in range(0, len(guids), args.batch_size):
+            batches.put_nowait(guids[start : start + args.batch_size])
+        # deletes queued or running; revs are fetched ahead until this many wait
+        pending = asyncio.Semaphore(4 * args.concurrency)
+        deletes = set()
+
+        # line buffered, so the log is complete up to the last finished request
+        with open(args.result_log, "a", buffering=1) as result_file, tqdm(
+            total=len(guids)
+        ) as progress:
+
+            def record(guid, status):
+                result_file.write("{} {}\n".format(guid, status))
+                stats[str(status)] += 1
+                progress.update(1)
 
-headers = {
-    "Authorization": ""
-}
+            async def delete(guid, rev):
+                try:
+                    record(guid, await deleter.delete(guid, rev))
+                finally:
+                    pending.release()
 
+            async def fetch_revs():
+                while not batches.empty():
+                    revs, failed = await deleter.get_revs(batches.get_nowait())
+                    for guid, status in failed.items():
+                        record(guid, status)
+                    for guid, rev in revs.items():
+                        await pending.acquire()
+                        task = asyncio.ensure_future(delete(guid, rev))
+                        deletes.add(task)
+                        task.add_done_callback(deletes.discard)
 
-async def main():
-    """drop it"""
-    async with aiohttp.ClientSession(headers=headers) as session:
-        with open("total_seq.csv") as to_remove_files:
-            with open("result.csv", "w") as result_file:
-                csv_reader = csv.DictReader(to_remove_files)
-                for row in tqdm(csv_reader, total=1234812):
-                    guid = row["guid"]
-                    url = "https://validate.midrc.org/index/index/{}".format(guid)
+            # several lookups at a time, so a retried one does not stall the deletes
+            await asyncio.gather(
+                *(fetch_revs() for _ in range(max(2, args.concurrency // 8)))
+            )
+            await asyncio.gather(*deletes)
+    return stats, deleter.retries
 
-                    async with session.get(url) as r_rev:
-                        if r_rev.status == 200:
-                            json_body = await r_rev.json()
-                            rev = json_body["rev"]
-                            del_url = "https://validate.midrc.org/index/index/{}?rev={}".format(guid, rev)
 
-                            async with session.delete(del_url) as r:
-                                result_file.write("{} {}\n".format(guid, r.status))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bulk delete indexd records")
+    parser.add_argument(
+        "--input",
+        action="store",
+        type=str,
+        default="total_seq.csv",
+        help="CSV with a guid column",
+    )
+    parser.add_argument(
+        "--endpoint", action="store", type=str, default="https://validate.midrc.org"
+    )
+    parser.add_argument(
+        "--credentials",
+        action="store",
+        type=str,
+        help="Gen3 credentials JSON with an api_key",
+    )
+    parser.add_argument(
+        "--token",
+        action="store",
+        type=str,
+        help="access token to use instead of --credentials",
+    )
+    parser.add_argument("--result_log", action="store", type=str, default="result.csv")
+    parser.add_argument(
+        "--concurrency", action="store", type=int, default=32, help="requests in flight"
+    )
+    parser.add_argument(
+        "--batch_size",
+        action="store",
+        type=int,
+        default=100,
+        help="guids per bulk rev lookup",
+    )
+    parser.add_argument("--max_retries", action="store", type=int, default=5)
+    parser.add_argument(
+        "--timeout", action="store", type=float, default=60, help="seconds per request"
+    )
+    args = parser.parse_args()
 
-                    # async with session.delete(url) as resp:
-                    #     result_file.write("{} {}\n".format(guid, resp.status))
+    start_time = time.time()
+    done = read_done(args.result_log)
+    guids = [guid for guid in read_guids(args.input) if guid not in done]
+    print("{} guids to delete, {} done in earlier runs".format(len(guids), len(done)))
 
-loop = asyncio.get_event_loop()
-result = loop.run_until_complete(main())
-print("--- {} seconds ---".format(time.time() - start_time))
+    stats, retries = asyncio.run(run(args, guids))
+    print("Statuses: {}".format(dict(stats)))
+    if retries:
+        print("Retried: {}".format(dict(retries)))
+    print("--- {} seconds ---".format(time.time() - start_time))
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+"""
+Local stand-in for the indexd and fence endpoints used by the deletion scripts
+
+Serves, for a set of synthetic records held in memory:
+
+    POST   /user/credentials/api/access_token   {"api_key": ...} -> {"access_token": ...}
+    GET    /index/index/<guid>                  the record, with its rev
+    POST   /index/bulk/documents                records of a JSON list of guids
+    DELETE /index/index/<guid>?rev=<rev>        needs a valid token; 409 on a stale rev
+    DELETE /user/data/<guid>                    needs a valid token; 204, or 404 without a record
+
+Tokens expire after --token_ttl seconds, and --fail_rate of the requests get
+a 503 or a 429 so retries and token refreshes are exercised. --write_input
+writes the guids (and some that do not exist) as a CSV to delete:
+
+    python3 indexd_stub.py --records 100000 --write_input total_seq.csv --port 8080
+    python3 delete.py --endpoint http://127.0.0.1:8080 --token x --input total_seq.csv
+"""
+import argparse
+import asyncio
+import csv
+import random
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+
+class IndexdStub:
+    def __init__(
+        self,
+        records,
+        token_ttl=1200,
+        fail_rate=0.0,
+        latency=0.0,
+        bulk=True,
+        accept_any_token=True,
+    ):
+        self.records = {guid: uuid.uuid4().hex[:8] for guid in records}
+        self.token_ttl = token_ttl
+        self.fail_rate = fail_rate
+        self.latency = latency
+        self.bulk = bulk
+        # tokens not issued by the stub (e.g. --token on the command line) never expire
+        self.accept_any_token = accept_any_token
+        self.tokens = {}
+        self.requests = Counter()
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.add_routes(
+            [
+                web.post("/user/credentials/api/access_token", self.access_token),
+                web.get("/index/index/{guid:.+}", self.get_record),
+                web.delete("/index/index/{guid:.+}", self.delete_record),
+                web.delete("/user/data/{guid:.+}", self.delete_data),
+            ]
+        )
+        if self.bulk:
+            app.add_routes([web.post("/index/bulk/documents", self.bulk_documents)])
+        return app
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        self.requests[request.method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if random.random() < self.fail_rate:
+            if random.random() < 0.5:
+                return web.Response(status=429, headers={"Retry-After": "0"})
+            return web.Response(status=503)
+        return await handler(request)
+
+    def authorized(self, request):
+        token = request.headers.get("Authorization", "").replace("Bearer ", "", 1)
+        if token in self.tokens:
+            return time.time() < self.tokens[token]
+        return self.accept_any_token and bool(token)
+
+    async def access_token(self, request):
+        body = await request.json()
+        if not body.get("api_key"):
+            return web.Response(status=401)
+        token = uuid.uuid4().hex
+        self.tokens[token] = time.time() + self.token_ttl
+        return web.json_response({"access_token": token})
+
+    def document(self, guid):
+        return {
+            "did": guid,
+            "rev": self.records[guid],
+            "size": 1,
+            "hashes": {},
+            "urls": [],
+        }
+
+    async def get_record(self, request):
+        guid = request.match_info["guid"]
+        if guid not in self.records:
+            return web.json_response({"error": "no record found"}, status=404)
+        return web.json_response(self.document(guid))
+
+    async def bulk_documents(self, request):
+        guids = await request.json()
+        return web.json_response(
+            [self.document(guid) for guid in guids if guid in self.records]
+        )
+
+    async def delete_record(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        guid = request.match_info["guid"]
+        if guid not in self.records:
+            return web.json_response({"error": "no record found"}, status=404)
+        if request.query.get("rev") != self.records[guid]:
+            return web.json_response({"error": "revision mismatch"}, status=409)
+        del self.records[guid]
+        return web.Response(status=200)
+
+    async def delete_data(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        guid = request.match_info["guid"]
+        if guid not in self.records:
+            return web.Response(status=404)
+        del self.records[guid]
+        return web.Response(status=204)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local indexd and fence stand-in")
+    parser.add_argument("--port", action="store", type=int, default=8080)
+    parser.add_argument("--records", action="store", type=int, default=10000)
+    parser.add_argument(
+        "--write_input",
+        action="store",
+        type=str,
+        help="CSV of guids to delete to write",
+    )
+    parser.add_argument(
+        "--missing",
+        action="store",
+        type=float,
+        default=0.01,
+        help="share of input guids without a record",
+    )
+    parser.add_argument("--token_ttl", action="store", type=float, default=1200)
+    parser.add_argument("--fail_rate", action="store", type=float, default=0.0)
+    parser.add_argument(
+        "--latency",
+        action="store",
+        type=float,
+        default=0.0,
+        help="seconds added to every request",
+    )
+    parser.add_argument(
+        "--no_bulk",
+        action="store_true",
+        help="serve no bulk documents endpoint, like older indexd",
+    )
+    args = parser.parse_args()
+
+    records = ["dg.TEST/{}".format(uuid.uuid4()) for _ in range(args.records)]
+    stub = IndexdStub(
+        records, args.token_ttl, args.fail_rate, args.latency, bulk=not args.no_bulk
+    )
+    if args.write_input is not None:
+        missing = [
+            "dg.TEST/{}".format(uuid.uuid4())
+            for _ in range(int(args.records * args.missing))
+        ]
+        with open(args.write_input, "w") as input_file:
+            writer = csv.writer(input_file)
+            writer.writerow(["guid"])
+            writer.writerows([guid] for guid in records + missing)
+    try:
+        web.run_app(stub.app(), host="127.0.0.1", port=args.port, print=None)
+    finally:
+        print(
+            "Requests: {}, records left: {}".format(
+                dict(stub.requests), len(stub.records)
+            )
+        )
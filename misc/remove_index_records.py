@@ -1,62 +1,175 @@
-import json
-import http.client
-from os import remove
+#!/usr/bin/env python3
 
-INPUT_FILE = "./indexd_guids.txt"
+"""
+Remove the files of a list of guids through fence (or only their indexd records)
 
-payload = ""
-headers = {
-    "cookie": "",
-    "Authorization": "",
-}
+Every guid is first checked in indexd; the ones with a record are deleted
+with DELETE /user/data/<guid>, or with --indexd_only by deleting the indexd
+record at its current rev. Requests go through one pool of keep-alive
+connections to --endpoint, shared by --concurrency worker threads, and
+429/5xx responses are retried with backoff (honouring Retry-After).
 
+--dry_run only checks which guids have a record. Either way, a report of
+statuses and throughput is printed at the end.
 
-def get_indexd_record(guid):
-    conn = http.client.HTTPSConnection("staging.midrc.org")
-    conn.request("GET", f"/index/index/{guid}", payload)
-    res = conn.getresponse()
-    data = res.read()
+    python3 remove_index_records.py --endpoint https://staging.midrc.org --token $TOKEN --dry_run
+    python3 remove_index_records.py --endpoint https://staging.midrc.org --token $TOKEN --concurrency 32
+"""
+import argparse
+import json
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-    data = json.loads(data.decode("utf-8"))
+import urllib3
+from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+INPUT_FILE = "./indexd_guids.txt"
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class IndexClient:
+    """
+    Keep-alive connections to one commons, safe to share between threads;
+    at most concurrency connections are open, further requests wait for one
+    """
+
+    def __init__(self, endpoint, token="", concurrency=16, max_retries=5, timeout=30):
+        self.endpoint = endpoint.rstrip("/")
+        self.headers = {"Authorization": "Bearer {}".format(token)} if token else {}
+        retries = Retry(
+            total=max_retries,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None,  # DELETEs too
+            backoff_factor=0.5,
+            raise_on_status=False,
+        )
+        self.pool = urllib3.PoolManager(
+            maxsize=concurrency, block=True, retries=retries, timeout=timeout
+        )
+        self.requests = Counter()
+        self._lock = threading.Lock()
+
+    def request(self, method, path):
+        with self._lock:
+            self.requests[method] += 1
+        return self.pool.request(
+            method, "{}{}".format(self.endpoint, path), headers=self.headers
+        )
+
+
+def get_indexd_record(client, guid):
+    res = client.request("GET", f"/index/index/{guid}")
+    data = json.loads(res.data.decode("utf-8"))
     rev = data["rev"]
     return rev
 
 
-def remove_indexd_record(guid, rev):
-    conn = http.client.HTTPSConnection("staging.midrc.org")
-    conn.request("DELETE", f"/index/index/{guid}?rev={rev}", payload, headers)
+def remove_indexd_record(client, guid, rev):
+    res = client.request("DELETE", f"/index/index/{guid}?rev={rev}")
+    return res.status
 
-    res = conn.getresponse()
-    data = res.read()
 
-    print(data.decode("utf-8"))
-
-
-def indexd_record_exist(guid):
-    conn = http.client.HTTPSConnection("staging.midrc.org")
-    conn.request("GET", f"/index/index/{guid}", payload)
-    res = conn.getresponse()
+def indexd_record_exist(client, guid):
+    res = client.request("GET", f"/index/index/{guid}")
     return True if res.status != 404 else False
 
 
-def remove_file_fence(guid):
-    conn = http.client.HTTPSConnection("staging.midrc.org")
-    conn.request("DELETE", f"/user/data/{guid}", payload, headers)
-    res = conn.getresponse()
-    # data = res.read()
-    print(res.status, res.reason)
-    # print(data.decode("utf-8"))
+def remove_file_fence(client, guid):
+    res = client.request("DELETE", f"/user/data/{guid}")
+    return res.status
 
 
-if __name__ == "__main__":
-    print("Hello!")
+def remove_guid(client, guid, dry_run=False, indexd_only=False):
+    """
+    Removes one guid; returns its status for the report
+    """
+    if not indexd_record_exist(client, guid):
+        return "no record"
+    if dry_run:
+        return "would remove"
+    if indexd_only:
+        rev = get_indexd_record(client, guid)
+        return remove_indexd_record(client, guid, rev)
+    return remove_file_fence(client, guid)
 
-    with open(INPUT_FILE) as f:
-        guids_to_remove = f.read().splitlines()
 
-    for guid in guids_to_remove:
-        # rev = get_indexd_record(guid)
-        # remove_indexd_record(guid, rev)
-
-        if indexd_record_exist(guid):
-            remove_file_fence(guid)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Remove the files of guids through fence"
+    )
+    parser.add_argument(
+        "--input",
+        action="store",
+        type=str,
+        default=INPUT_FILE,
+        help="file with one guid per line",
+    )
+    parser.add_argument(
+        "--endpoint", action="store", type=str, default="https://staging.midrc.org"
+    )
+    parser.add_argument(
+        "--token",
+        action="store",
+        type=str,
+        default="",
+        help="access token for the DELETEs",
+    )
+    parser.add_argument(
+        "--concurrency",
+        action="store",
+        type=int,
+        default=16,
+        help="guids processed at a time",
+    )
+    parser.add_argument("--max_retries", action="store", type=int, default=5)
+    parser.add_argument(
+        "--dry_run", action="store_true", help="only report which guids have a record"
+    )
+    parser.add_argument(
+        "--indexd_only",
+        action="store_true",
+        help="delete the indexd records instead of the files through fence",
+    )
+    args = parser.parse_args()
+
+    with open(args.input) as f:
+        guids_to_remove = [guid for guid in f.read().splitlines() if guid]
+
+    client = IndexClient(args.endpoint, args.token, args.concurrency, args.max_retries)
+    statuses = Counter()
+    failed = []
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = {
+            executor.submit(
+                remove_guid, client, guid, args.dry_run, args.indexd_only
+            ): guid
+            for guid in guids_to_remove
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                status = future.result()
+            except Exception as err:
+                status = type(err).__name__
+            statuses[str(status)] += 1
+            if str(status) not in ("200", "204", "no record", "would remove"):
+                failed.append((futures[future], status))
+    seconds = time.time() - start_time
+
+    print(
+        "{} guids in {:.1f}s: {:.0f} guids/s, {:.0f} requests/s over {} connections{}".format(
+            len(guids_to_remove),
+            seconds,
+            len(guids_to_remove) / seconds if seconds else 0,
+            sum(client.requests.values()) / seconds if seconds else 0,
+            args.concurrency,
+            " (dry run)" if args.dry_run else "",
+        )
+    )
+    print("Statuses: {}".format(dict(statuses)))
+    print("Requests: {}".format(dict(client.requests)))
+    for guid, status in failed[:20]:
+        print("Failed: {} {}".format(guid, status))
@@ -1,33 +1,276 @@
+#!/usr/bin/env python3
+
+"""
+Remove the indexd records of a manifest (TSV with a did column) with Gen3Index
+
+Records are deleted by --workers threads, at most --rate deletions per
+second, or --business_hours_rate on weekdays during --business_hours (in
+--timezone) so indexd stays responsive for everyone else. Every attempt,
+retries included, waits for the rate limiter: 409, 429 and 5xx responses,
+and connection errors, are retried with backoff here, and the retrying
+Gen3Index.delete_record of the SDK is not used.
+
+Every confirmed deletion (or record found missing) is appended to the
+checkpoint file as "<did>\t<status>"; those dids are skipped when the script
+is run again, so an interrupted run resumes where it stopped. A summary of
+statuses is printed at the end and failures are logged to output.log.
+
+    python3 remove_records.py --manifest to_remove/TODELETE_data.midrc.org_indexd_records_2021-8-31.tsv
+    python3 remove_records.py --credentials data.midrc.org.json --workers 16 --rate 100 --business_hours_rate 20
+"""
+import argparse
 import csv
 import logging
-import sys
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+from itertools import islice
+from zoneinfo import ZoneInfo
 
+import requests
 from gen3.auth import Gen3Auth
 from gen3.index import Gen3Index
+from tqdm import tqdm
 
-# from gen3.tools.indexing import index_object_manifest
-
-logging.basicConfig(filename="output.log", level=logging.DEBUG)
-logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+logging.basicConfig(filename="output.log", level=logging.INFO)
 
 MANIFEST = "./to_remove/TODELETE_data.midrc.org_indexd_records_2021-8-31.tsv"
+# 409: the record changed between fetching its rev and deleting it
+RETRY_STATUSES = {"409", "429", "500", "502", "503", "504"}
+# deleted, or no record to delete
+DONE_STATUSES = {"deleted", "no record", "404"}
+
+
+class RateLimiter:
+    """
+    Spaces out calls to at most rate per second, or business_rate on weekdays
+    between the business_hours (start, end) in timezone; a rate of 0 is no limit
+    """
+
+    def __init__(self, rate, business_rate=None, business_hours=(8, 18), timezone=None):
+        self.rate = rate
+        self.business_rate = rate if business_rate is None else business_rate
+        self.business_hours = business_hours
+        self.timezone = timezone
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def current_rate(self):
+        now = datetime.now(self.timezone)
+        start, end = self.business_hours
+        if now.weekday() < 5 and start <= now.hour < end:
+            return self.business_rate
+        return self.rate
+
+    def wait(self):
+        rate = self.current_rate()
+        if not rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            # no credit for idle time, so there is no burst after a pause
+            self._next = max(self._next, now)
+            delay = self._next - now
+            self._next += 1 / rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+def delete_record(index, did, limiter, max_retries=5):
+    """
+    Deletes one record; returns its status: "deleted", "no record", the HTTP
+    status of the last attempt or the name of its exception
+
+    Does what Gen3Index.delete_record does (GET the record for its rev, then
+    DELETE it) through the index client, without the SDK's backoff, so that
+    every attempt goes through the limiter.
+    """
+    for attempt in range(max_retries + 1):
+        limiter.wait()
+        retry = False
+        try:
+            record = index.client.get(did)
+            if record is None:
+                status = "no record"
+            else:
+                record.delete()
+                status = "deleted"
+        except requests.HTTPError as err:
+            status = str(err.response.status_code)
+            retry = status in RETRY_STATUSES
+        except (requests.ConnectionError, requests.Timeout) as err:
+            status = type(err).__name__
+            retry = True
+        if not retry or attempt == max_retries:
+            return status
+        time.sleep(random.uniform(0, min(30, 0.5 * 2**attempt)))
+
+
+def read_checkpoint(checkpoint):
+    """
+    The dids confirmed deleted or missing by earlier runs
+    """
+    done = set()
+    try:
+        with open(checkpoint) as checkpoint_file:
+            for line in checkpoint_file:
+                did, _, status = line.rstrip("\n").partition("\t")
+                if status in DONE_STATUSES:
+                    done.add(did)
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def read_dids(manifest):
+    with open(manifest) as to_remove_file:
+        to_remove_reader = csv.DictReader(to_remove_file, delimiter="\t", quotechar='"')
+        # dict keeps the manifest order
+        return list(dict.fromkeys(row["did"] for row in to_remove_reader if row["did"]))
+
+
+def delete_records(index, dids, checkpoint, limiter, workers=8, max_retries=5):
+    """
+    Deletes the records of dids with a pool of workers, appending those done
+    to the checkpoint file; returns a Counter of statuses and the failed
+    (did, status). On Ctrl-C, the deletions in flight are finished and
+    checkpointed before returning.
+    """
+    statuses = Counter()
+    failed = []
+    pending = iter(dids)
+    running = {}
+    # line buffered, so the checkpoint is complete up to the last confirmed deletion
+    with ThreadPoolExecutor(max_workers=workers) as executor, open(
+        checkpoint, "a", buffering=1
+    ) as checkpoint_file, tqdm(total=len(dids)) as progress:
+
+        def submit(n):
+            for did in islice(pending, n):
+                running[
+                    executor.submit(delete_record, index, did, limiter, max_retries)
+                ] = did
+
+        def record(future):
+            did = running.pop(future)
+            status = future.result()
+            statuses[status] += 1
+            progress.update(1)
+            if status in DONE_STATUSES:
+                checkpoint_file.write("{}\t{}\n".format(did, status))
+            else:
+                failed.append((did, status))
+                logging.warning("Could not delete {}: {}".format(did, status))
+
+        try:
+            # a couple of dids queued per worker; the rest are only read as needed
+            submit(2 * workers)
+            while running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record(future)
+                submit(len(finished))
+        except KeyboardInterrupt:
+            print("Interrupted, waiting for the deletions in flight")
+            for future in list(running):
+                if future.cancel():
+                    running.pop(future)
+            for future in list(running):
+                future.exception()
+                record(future)
+            statuses["interrupted"] = len(dids) - sum(statuses.values())
+    return statuses, failed
 
 
 def main():
     """
-    Remove indexd.
+    Remove indexd records.
     """
-    auth = Gen3Auth(refresh_file="data.midrc.org.json")
+    parser = argparse.ArgumentParser(
+        description="Remove the indexd records of a manifest"
+    )
+    parser.add_argument(
+        "--manifest",
+        action="store",
+        type=str,
+        default=MANIFEST,
+        help="TSV with a did column",
+    )
+    parser.add_argument(
+        "--credentials", action="store", type=str, default="data.midrc.org.json"
+    )
+    parser.add_argument(
+        "--endpoint",
+        action="store",
+        type=str,
+        help="commons URL, by default the one of the credentials",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        action="store",
+        type=str,
+        help="dids done so far, by default <manifest>.checkpoint",
+    )
+    parser.add_argument(
+        "--workers", action="store", type=int, default=8, help="deletions in flight"
+    )
+    parser.add_argument("--max_retries", action="store", type=int, default=5)
+    parser.add_argument(
+        "--rate",
+        action="store",
+        type=float,
+        default=50,
+        help="deletions per second, 0 for no limit",
+    )
+    parser.add_argument(
+        "--business_hours_rate",
+        action="store",
+        type=float,
+        default=10,
+        help="deletions per second on weekdays during business hours",
+    )
+    parser.add_argument(
+        "--business_hours",
+        action="store",
+        type=str,
+        default="8-18",
+        help="start-end hours, e.g. 8-18",
+    )
+    parser.add_argument(
+        "--timezone", action="store", type=str, default="America/Chicago"
+    )
+    args = parser.parse_args()
 
+    checkpoint = args.checkpoint or "{}.checkpoint".format(args.manifest)
+    start, end = (int(hour) for hour in args.business_hours.split("-"))
+    limiter = RateLimiter(
+        args.rate, args.business_hours_rate, (start, end), ZoneInfo(args.timezone)
+    )
+
+    auth = Gen3Auth(endpoint=args.endpoint, refresh_file=args.credentials)
     print(auth.endpoint)
     index = Gen3Index(auth_provider=auth)
 
-    with open(MANIFEST) as to_remove_file:
-        to_remove_reader = csv.DictReader(to_remove_file, delimiter='\t', quotechar='"')
-        for row in to_remove_reader:
-            did = row["did"]
-            r = index.delete_record(guid=did)
-            print(r)
+    start_time = time.time()
+    done = read_checkpoint(checkpoint)
+    dids = [did for did in read_dids(args.manifest) if did not in done]
+    print("{} records to remove, {} done in earlier runs".format(len(dids), len(done)))
+
+    statuses, failed = delete_records(
+        index, dids, checkpoint, limiter, args.workers, args.max_retries
+    )
+    seconds = time.time() - start_time
+    print("Statuses: {}".format(dict(statuses)))
+    for did, status in failed[:20]:
+        print("Failed: {} {}".format(did, status))
+    print(
+        "{} records in {:.1f}s: {:.1f} records/s".format(
+            len(dids), seconds, len(dids) / seconds if seconds else 0
+        )
+    )
 
 
 if __name__ == "__main__":
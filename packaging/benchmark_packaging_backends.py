@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark package_midrc_series.py backends on a synthetic batch
+
+Seeds a local S3 stand-in (e.g. `moto_server -p 5000` or a MinIO container)
+with a synthetic ACR-style batch, then runs the packaging script once per
+backend against it and prints wall time and throughput for each.
+
+    python3 benchmark_packaging_backends.py --endpoint_url http://127.0.0.1:5000
+    python3 benchmark_packaging_backends.py --endpoint_url http://127.0.0.1:5000 -- --stream
+
+Anything after "--" is passed through to package_midrc_series.py.
+"""
+import argparse
+import csv
+import os
+import subprocess
+import sys
+import time
+from hashlib import md5
+from pathlib import Path
+
+import boto3
+
+parser = argparse.ArgumentParser(description="Benchmark packaging backends")
+parser.add_argument(
+    "--endpoint_url",
+    action="store",
+    type=str,
+    required=True,
+    help="endpoint of the local S3 stand-in",
+)
+parser.add_argument(
+    "--work_dir",
+    action="store",
+    type=str,
+    default="./packaging_benchmark",
+    help="directory for the synthetic batch",
+)
+parser.add_argument("--series", action="store", type=int, default=24)
+parser.add_argument("--instances", action="store", type=int, default=100)
+parser.add_argument(
+    "--instance_kb",
+    action="store",
+    type=int,
+    default=512,
+    help="size of each synthetic instance in KiB",
+)
+parser.add_argument("--n_jobs", action="store", type=int, default=6)
+parser.add_argument(
+    "--processes",
+    action="store",
+    type=int,
+    default=2,
+    help="processes used by the hybrid backend",
+)
+args, passthrough = parser.parse_known_args()
+passthrough = [a for a in passthrough if a != "--"]
+
+BATCH = "ACR_BENCH"
+SRC_BUCKET = "external-data-midrc-replication"
+DST_BUCKET = "internal-data-midrc-replication"
+SCRIPT = Path(__file__).resolve().parent / "package_midrc_series.py"
+
+# the stand-in accepts any credentials, but boto3 refuses to sign without some
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+
+
+def synthetic_instance(seed, nbytes):
+    """
+    Half of the instances look like uncompressed pixel data (compressible),
+    the other half like an already-compressed transfer syntax (random)
+    """
+    if seed % 2:
+        return os.urandom(nbytes)
+    row = bytes((seed + i) % 256 for i in range(512))
+    return (row * (nbytes // len(row) + 1))[:nbytes]
+
+
+def seed_batch(batch_dir):
+    s3 = boto3.resource("s3", endpoint_url=args.endpoint_url)
+    for bucket in (SRC_BUCKET, DST_BUCKET):
+        s3.create_bucket(Bucket=bucket)
+
+    packages = []
+    nbytes = args.instance_kb * 1024
+    for s in range(args.series):
+        case_id, study_uid, series_uid = (
+            "case{}".format(s % 5),
+            "1.2.{}".format(s % 10),
+            "1.2.3.{}".format(s),
+        )
+        folder = batch_dir / "cases" / case_id / study_uid
+        folder.mkdir(parents=True, exist_ok=True)
+        series_file = folder / "{}.tsv".format(series_uid)
+        with open(series_file, "w", encoding="utf8") as f:
+            writer = csv.writer(f, delimiter="\t")
+            writer.writerow(
+                [
+                    "file_name",
+                    "file_size",
+                    "md5sum",
+                    "case_ids",
+                    "study_uid",
+                    "series_uid",
+                    "storage_urls",
+                ]
+            )
+            for i in range(args.instances):
+                body = synthetic_instance(s * args.instances + i, nbytes)
+                file_name = "1.2.3.{}.{}.dcm".format(s, i)
+                key = "{}/{}/{}/{}".format(BATCH, case_id, series_uid, file_name)
+                s3.Object(SRC_BUCKET, "replicated-data-acr/" + key).put(Body=body)
+                writer.writerow(
+                    [
+                        file_name,
+                        len(body),
+                        md5(body).hexdigest(),
+                        case_id,
+                        study_uid,
+                        series_uid,
+                        "//" + key,
+                    ]
+                )
+        packages.append("{}\n".format(series_file.resolve()))
+    with open(batch_dir / "packages.txt", "w") as f:
+        f.writelines(packages)
+
+
+def run_backend(batch_dir, backend):
+    for output in ("packages_manifest.tsv", "packaging_checkpoint.jsonl"):
+        if (batch_dir / output).exists():
+            (batch_dir / output).unlink()
+    cmd = [
+        sys.executable,
+        str(SCRIPT),
+        "--batch_dir",
+        str(batch_dir),
+        "--backend",
+        backend,
+        "--n_jobs",
+        str(args.n_jobs),
+        "--processes",
+        str(args.processes),
+        "--endpoint_url",
+        args.endpoint_url,
+    ] + passthrough
+    start_time = time.time()
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+    return time.time() - start_time
+
+
+if __name__ == "__main__":
+    batch_dir = Path(args.work_dir).resolve() / BATCH
+    if not (batch_dir / "packages.txt").is_file():
+        print(
+            "Seeding {} series x {} instances at {}".format(
+                args.series, args.instances, args.endpoint_url
+            )
+        )
+        seed_batch(batch_dir)
+
+    total_mb = args.series * args.instances * args.instance_kb / 1024
+    print("{:<8} {:>10} {:>10} {:>10}".format("backend", "seconds", "files/s", "MB/s"))
+    for backend in ("thread", "process", "hybrid"):
+        elapsed = run_backend(batch_dir, backend)
+        print(
+            "{:<8} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+                backend,
+                elapsed,
+                args.series * args.instances / elapsed,
+                total_mb / elapsed,
+            )
+        )
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark sequestration_split.split_packages
+
+Builds a synthetic batch of packages, master sequestration list and
+exclusion lists, checks that split_packages assigns every package like the
+previous per-package loop (exclusions checked with `in` on lists) and times
+both. package_contents is canonical JSON, as packaging writes it, except
+with --contents normalize, which benchmarks legacy batches.
+
+    python3 benchmark_sequestration_split.py
+    python3 benchmark_sequestration_split.py --packages 500000 --excluded 20000
+    python3 benchmark_sequestration_split.py --instances 300 --contents validate
+"""
+import argparse
+import hashlib
+import json
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from packages_manifest import FIELDNAMES
+from sequestration_split import CONTENTS_MODES, OUTPUTS, split_packages
+
+parser = argparse.ArgumentParser(description="Benchmark the sequestration split")
+parser.add_argument("--packages", action="store", type=int, default=500000)
+parser.add_argument(
+    "--instances", action="store", type=int, default=3, help="instances per package"
+)
+parser.add_argument(
+    "--excluded",
+    action="store",
+    type=int,
+    default=5000,
+    help="excluded cases and studies",
+)
+parser.add_argument("--org", action="store", type=str, default="ACR")
+parser.add_argument(
+    "--contents", action="store", choices=CONTENTS_MODES, default="pass"
+)
+args = parser.parse_args()
+
+
+def synthetic_batch(n_packages, n_instances, n_excluded, legacy=False, seed=0):
+    rng = np.random.default_rng(seed)
+    n_cases = max(1, n_packages // 10)
+    case = rng.integers(0, n_cases, n_packages)
+    study = case * 4 + rng.integers(0, 4, n_packages)
+    file_name = [
+        "case{}/study_1.2.826.0.{}/1.2.826.0.1.{}".format(c, s, i)
+        for i, (c, s) in enumerate(zip(case, study))
+    ]
+    contents = [
+        {
+            "hashes": {"md5sum": "{:032x}".format(i)},
+            "file_name": "{}.dcm".format(i),
+            "size": 100000 + i,
+        }
+        for i in range(n_instances)
+    ]
+    if legacy:
+        contents = str([dict(entry, size=str(entry["size"])) for entry in contents])
+    else:
+        contents = json.dumps(contents)
+    packages = pd.DataFrame(
+        {
+            "record_type": "package",
+            "guid": "",
+            "md5": ["{:032x}".format(i) for i in range(n_packages)],
+            "size": rng.integers(10**6, 10**9, n_packages).astype(str),
+            "authz": "",
+            "url": ["{}.zip".format(f) for f in file_name],
+            "file_name": file_name,
+            "package_contents": contents,
+        },
+        columns=FIELDNAMES,
+    )
+    # most cases are listed, a few are unknown to the master list
+    datasets = rng.choice(["Open", "Seq", "Ignore"], n_cases, p=[0.6, 0.35, 0.05])
+    seq_master = {"case{}".format(c): d for c, d in enumerate(datasets) if c % 50}
+    exclude_cases = set(
+        "case{}".format(c) for c in rng.integers(0, n_cases, n_excluded)
+    )
+    exclude_studies = set(
+        "1.2.826.0.{}".format(s) for s in rng.integers(0, n_cases * 4, n_excluded)
+    )
+    return packages, seq_master, exclude_studies, exclude_cases
+
+
+def per_package_loop(packages, seq_master, exclude_studies, exclude_cases, org):
+    """
+    The previous implementation, with exclusions as lists
+    """
+    exclude_studies, exclude_cases = list(exclude_studies), list(exclude_cases)
+    outputs = {output: [] for output in OUTPUTS}
+    for item in packages.to_dict("records"):
+        case_id, study_id, _ = item["file_name"].split("/")
+        study_id = study_id.split("_")[-1]
+        package_contents = json.loads(item["package_contents"].replace("'", '"'))
+        for p in package_contents:
+            p["size"] = int(p["size"])
+        item["package_contents"] = json.dumps(package_contents)
+        dataset = seq_master.get(case_id, None)
+        if dataset == "Open":
+            bucket = "s3://open-data-midrc/"
+            authz = json.dumps(
+                [
+                    (
+                        "/programs/Open/projects/A1"
+                        if org == "ACR"
+                        else "/programs/Open/projects/R1"
+                    )
+                ]
+            )
+        elif dataset == "Seq":
+            bucket = "s3://sequestered-data-midrc/"
+            authz = json.dumps(
+                [
+                    (
+                        "/programs/SEQ_Open/projects/A3"
+                        if org == "ACR"
+                        else "/programs/SEQ_Open/projects/R3"
+                    )
+                ]
+            )
+        elif dataset == "Ignore":
+            bucket = "s3://open-data-midrc/"
+            authz = json.dumps(["/programs/TCIA"])
+        else:
+            authz = ""
+            bucket = ""
+        item["authz"] = authz
+        item["url"] = f"{bucket}{item['url']}"
+        if study_id in exclude_studies or case_id in exclude_cases:
+            outputs["remove"].append(item)
+            continue
+        m = hashlib.md5()
+        m.update(f"{item['md5']}{item['size']}".encode("utf-8"))
+        item["guid"] = f"dg.MD1R/{uuid.UUID(m.hexdigest(), version=4)}"
+        if dataset in ("Open", "Ignore"):
+            outputs["open"].append(item)
+        elif dataset == "Seq":
+            outputs["seq"].append(item)
+        else:
+            outputs["missing"].append(item)
+    return outputs
+
+
+if __name__ == "__main__":
+    packages, seq_master, exclude_studies, exclude_cases = synthetic_batch(
+        args.packages,
+        args.instances,
+        args.excluded,
+        legacy=args.contents == "normalize",
+    )
+
+    start_time = time.time()
+    expected = per_package_loop(
+        packages, seq_master, exclude_studies, exclude_cases, args.org
+    )
+    loop_seconds = time.time() - start_time
+
+    start_time = time.time()
+    splits = split_packages(
+        packages, seq_master, exclude_studies, exclude_cases, args.org, args.contents
+    )
+    split_seconds = time.time() - start_time
+
+    for output in OUTPUTS:
+        rows = pd.DataFrame.from_records(expected[output], columns=FIELDNAMES)
+        assert (
+            splits[output].reset_index(drop=True).equals(rows)
+        ), "{} output differs".format(output)
+
+    print(
+        "{} packages; Open: {}, Seq: {}, Remove: {}, Missing: {}".format(
+            len(packages), *(len(splits[output]) for output in OUTPUTS)
+        )
+    )
+    print(
+        "per-package loop: {:.1f}s, split_packages: {:.1f}s ({:.1f}x)".format(
+            loop_seconds, split_seconds, loop_seconds / split_seconds
+        )
+    )
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the series split of process_midrc_submission.process_batch
+
+Builds a synthetic image manifest in memory and times the groupby-based
+split_series against the previous per-series boolean mask loop. The mask loop
+is O(series x instances), so it is only run on a sample of series and its
+total time is extrapolated.
+
+    python3 benchmark_series_split.py
+    python3 benchmark_series_split.py --instances 1000000 5000000 --per_series 50
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from process_midrc_submission import split_series
+
+parser = argparse.ArgumentParser(description="Benchmark the series split")
+parser.add_argument(
+    "--instances",
+    action="store",
+    type=int,
+    nargs="+",
+    default=[1000000, 5000000],
+    help="manifest sizes to benchmark",
+)
+parser.add_argument(
+    "--per_series",
+    action="store",
+    type=int,
+    default=100,
+    help="average number of instances per series",
+)
+parser.add_argument(
+    "--sample_series",
+    action="store",
+    type=int,
+    default=200,
+    help="series timed with the mask loop before extrapolating",
+)
+args = parser.parse_args()
+
+
+def synthetic_manifest(n_instances, per_series, seed=0):
+    """
+    Instances of each series are spread over the manifest, like in
+    submissions that list files by upload order rather than by series
+    """
+    rng = np.random.default_rng(seed)
+    n_series = max(1, n_instances // per_series)
+    series = rng.integers(0, n_series, n_instances)
+    series_uid = pd.Series(series).map("1.2.826.0.1.{}".format)
+    study = series // 4
+    return pd.DataFrame(
+        {
+            "file_name": ["{}.dcm".format(i) for i in range(n_instances)],
+            "file_size": rng.integers(100000, 600000, n_instances),
+            "case_ids": pd.Series(study // 3).map("case{}".format),
+            "study_uid": pd.Series(study).map("1.2.826.0.{}".format),
+            "series_uid": series_uid,
+        }
+    )
+
+
+def mask_loop(instances, series_uids):
+    """
+    The previous implementation: one boolean mask over the manifest per series
+    """
+    packages = []
+    for series_uid in series_uids:
+        sdf = instances.loc[instances["series_uid"] == series_uid]
+        case_ids = list(set(sdf.case_ids))
+        assert len(case_ids) == 1
+        study_uid = list(set(sdf.study_uid))
+        assert len(study_uid) == 1
+        series_path = "{}/{}/{}".format(case_ids[0], study_uid[0], series_uid)
+        if series_path not in packages:
+            packages.append(series_path)
+    return packages
+
+
+def groupby_split(instances):
+    ordered, series = split_series(instances)
+    packages = [
+        "{}/{}/{}".format(case_id, study_uid, series_uid)
+        for case_id, study_uid, series_uid in zip(
+            series.case_id, series.study_uid, series.series_uid
+        )
+    ]
+    return ordered, packages
+
+
+if __name__ == "__main__":
+    print(
+        "{:>10} {:>8} {:>14} {:>12} {:>9}".format(
+            "instances", "series", "mask loop (s)", "groupby (s)", "speedup"
+        )
+    )
+    for n_instances in args.instances:
+        instances = synthetic_manifest(n_instances, args.per_series)
+        series_uids = list(set(instances.series_uid))
+
+        start_time = time.time()
+        mask_loop(instances, series_uids[: args.sample_series])
+        sample = min(args.sample_series, len(series_uids))
+        mask_seconds = (time.time() - start_time) * len(series_uids) / sample
+
+        start_time = time.time()
+        groupby_split(instances)
+        groupby_seconds = time.time() - start_time
+
+        print(
+            "{:>10} {:>8} {:>14.1f} {:>12.1f} {:>8.0f}x".format(
+                n_instances,
+                len(series_uids),
+                mask_seconds,
+                groupby_seconds,
+                mask_seconds / groupby_seconds,
+            )
+        )
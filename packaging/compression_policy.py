@@ -0,0 +1,126 @@
+"""
+Per-series zip compression policy for DICOM packages
+
+Deflate buys nothing on instances that are already compressed (JPEG,
+JPEG 2000, RLE, ...) and costs CPU, while uncompressed CT/MR pixel data
+often shrinks 2-3x. choose_compression looks at the first few instances of
+a series, by transfer syntax and by how well a sample deflates, and picks
+ZIP_STORED or ZIP_DEFLATED for the whole series.
+"""
+
+import struct
+import time
+import zipfile
+import zlib
+from collections import namedtuple
+
+POLICIES = ["stored", "deflate", "auto"]
+
+# transfer syntaxes whose pixel data is not compressed
+UNCOMPRESSED_TRANSFER_SYNTAXES = {
+    "1.2.840.10008.1.2",  # Implicit VR Little Endian
+    "1.2.840.10008.1.2.1",  # Explicit VR Little Endian
+    "1.2.840.10008.1.2.2",  # Explicit VR Big Endian (retired)
+}
+
+# bytes of each sample instance deflated to estimate compressibility
+SAMPLE_BYTES = 1024 * 1024
+# keep deflate only if the sample shrinks below this fraction of its size
+MAX_DEFLATE_RATIO = 0.9
+
+CompressionChoice = namedtuple(
+    "CompressionChoice", ["compression", "compresslevel", "reason", "sample_ratio"]
+)
+
+
+def read_transfer_syntax(data):
+    """
+    Returns the Transfer Syntax UID (0002,0010) from a DICOM Part 10 header,
+    or None if data does not start with a readable file meta group
+    """
+    if len(data) < 132 or data[128:132] != b"DICM":
+        return None
+    pos = 132
+    # file meta elements are always explicit VR little endian
+    while pos + 8 <= len(data):
+        group, element = struct.unpack_from("<HH", data, pos)
+        if group != 0x0002:
+            return None
+        vr = data[pos + 4 : pos + 6]
+        if vr in (b"OB", b"OW", b"OF", b"SQ", b"UT", b"UN"):
+            if pos + 12 > len(data):
+                return None
+            length = struct.unpack_from("<I", data, pos + 8)[0]
+            pos += 12
+        else:
+            length = struct.unpack_from("<H", data, pos + 6)[0]
+            pos += 8
+        if element == 0x0010:
+            return data[pos : pos + length].decode("ascii", "ignore").strip("\x00 ")
+        pos += length
+    return None
+
+
+def sample_ratio(samples, level):
+    """
+    Deflated size / original size over the first SAMPLE_BYTES of each sample
+    """
+    original = compressed = 0
+    for data in samples:
+        data = data[:SAMPLE_BYTES]
+        original += len(data)
+        compressed += len(zlib.compress(data, level))
+    return compressed / original if original else 1.0
+
+
+def choose_compression(samples, policy="auto", level=6):
+    """
+    Picks the zip compression for a series from the bytes of its first instances
+
+    policy is "stored" or "deflate" to force one, or "auto" to use stored
+    when every sample has a compressed transfer syntax or deflates poorly.
+    """
+    if policy == "stored":
+        return CompressionChoice(zipfile.ZIP_STORED, None, "policy", None)
+    if policy == "deflate":
+        return CompressionChoice(zipfile.ZIP_DEFLATED, level, "policy", None)
+
+    syntaxes = {read_transfer_syntax(data) for data in samples}
+    if (
+        samples
+        and None not in syntaxes
+        and not syntaxes & UNCOMPRESSED_TRANSFER_SYNTAXES
+    ):
+        return CompressionChoice(
+            zipfile.ZIP_STORED, None, "compressed transfer syntax", None
+        )
+
+    # level 1 is enough to tell compressible pixel data from noise
+    ratio = sample_ratio(samples, 1)
+    if ratio < MAX_DEFLATE_RATIO:
+        return CompressionChoice(zipfile.ZIP_DEFLATED, level, "sample deflates", ratio)
+    return CompressionChoice(zipfile.ZIP_STORED, None, "sample incompressible", ratio)
+
+
+def describe(choice):
+    """
+    Short label for reports, e.g. 'stored' or 'deflate-6'
+    """
+    if choice.compression == zipfile.ZIP_DEFLATED:
+        return "deflate-{}".format(choice.compresslevel)
+    return "stored"
+
+
+class ThreadCpuTimer:
+    """
+    Measures CPU time spent by the current thread, which is where zip
+    framing, deflate and md5 run for a series
+    """
+
+    def __enter__(self):
+        self.start = time.thread_time()
+        self.seconds = None
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.seconds = time.thread_time() - self.start
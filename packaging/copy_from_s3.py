@@ -7,6 +7,10 @@ from functools import partial
 from pathlib import Path
 
 import boto3, tqdm
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from v3.s3_inventory import already_copied, inventory_delta, read_inventory
 
 parser = argparse.ArgumentParser(
     description="Move package files to their respective buckets"
@@ -25,6 +29,47 @@ parser.add_argument(
     required=True,
     help="Either 'open' or 'seq'.",
 )
+parser.add_argument(
+    "--workers",
+    action="store",
+    type=int,
+    default=16,
+    help="number of objects copied concurrently",
+)
+parser.add_argument(
+    "--part_size",
+    "--part-size",
+    action="store",
+    type=int,
+    default=64,
+    help="part size in MiB; objects at least this large are copied server-side with UploadPartCopy",
+)
+parser.add_argument(
+    "--part_concurrency",
+    action="store",
+    type=int,
+    default=4,
+    help="number of parts copied concurrently for each multipart copy",
+)
+parser.add_argument(
+    "--src_inventory",
+    action="store",
+    type=str,
+    required=False,
+    help="manifest.json of the source bucket's S3 Inventory (Parquet), s3:// URL or local mirror path",
+)
+parser.add_argument(
+    "--dst_inventory",
+    action="store",
+    type=str,
+    required=False,
+    help="manifest.json of the destination bucket's S3 Inventory; with --src_inventory, only the inventory diff is copied",
+)
+parser.add_argument(
+    "--no_skip_existing",
+    action="store_true",
+    help="copy every object even if the destination already has it with the same size and ETag",
+)
 args = parser.parse_args()
 
 """
@@ -33,23 +78,54 @@ Trouble-shooting:
 class Args:
     batch_dir="/home/ubuntu/wd/output/ACR_20220606"
     destination="open"
+    workers=16
+    part_size=64
+    part_concurrency=4
+    no_skip_existing=False
+    src_inventory=None
+    dst_inventory=None
 args=Args()
 
 """
 
+BUCKET_PREFIXES = {
+    "open": "s3://open-data-midrc/",
+    "seq": "s3://sequestered-data-midrc/",
+}
+
+
+def list_prefix(client, bucket: str, prefix: str):
+    """
+    Lists {key: {"Size", "ETag"}} under prefix; one LIST call covers up to 1000
+    objects, which is far cheaper than a HEAD per object
+    """
+    objects = {}
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            objects[obj["Key"]] = {"Size": obj["Size"], "ETag": obj["ETag"]}
+    return objects
+
+
+def list_objects(client, bucket: str, keys, workers: int):
+    """
+    Lists the objects of bucket under the case prefixes ('zip/<case_id>/') of keys
+    """
+    prefixes = {"/".join(key.split("/")[:2]) + "/" for key in keys}
+    objects = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for listed in executor.map(partial(list_prefix, client, bucket), prefixes):
+            objects.update(listed)
+    return objects
+
 
 def copy_file(
-    s3: boto3.session.Session.resource, src_bucket: str, dst_bucket: str, key: str
+    client, src_bucket: str, dst_bucket: str, transfer_config: TransferConfig, key: str
 ):
-    if args.destination == "open":
-        key = key.replace("s3://open-data-midrc/", "")
-    elif args.destination == "seq":
-        key = key.replace("s3://sequestered-data-midrc/", "")
     copy_source = {"Bucket": src_bucket, "Key": key}
-    bucket.copy(copy_source, key)
+    client.copy(copy_source, dst_bucket, key, Config=transfer_config)
 
 
-s3 = boto3.resource("s3")
 # SRC_BUCKET = "external-data-midrc-replication"
 SRC_BUCKET = "internal-data-midrc-replication"
 
@@ -66,7 +142,7 @@ assert (
     index_manifest.is_file()
 ), "Couldn't find the input index manifest file: {}".format(index_manifest)
 
-df = pd.read_csv(index_manifest, sep="\t", header=0)
+df = pd.read_csv(index_manifest, sep="\t", header=0, dtype=str)
 files_to_download = list(set(df.urls))
 print(
     "Total of {} package files found in index manifest file:\n\t{}".format(
@@ -79,20 +155,83 @@ if args.destination == "open":
 elif args.destination == "seq":
     DST_BUCKET = "sequestered-data-midrc"
 
-bucket = s3.Bucket(DST_BUCKET)
-func = partial(copy_file, s3, SRC_BUCKET, DST_BUCKET)
+keys = [url.replace(BUCKET_PREFIXES[args.destination], "") for url in files_to_download]
+# md5 of each package, the ETag of a multipart source copied as a single part
+md5s = dict(
+    zip(
+        (url.replace(BUCKET_PREFIXES[args.destination], "") for url in df.urls),
+        df.md5,
+    )
+)
+
+part_size = args.part_size * 1024 * 1024
+# every worker may run part_concurrency part copies at once
+client = boto3.client(
+    "s3",
+    config=Config(max_pool_connections=max(10, args.workers * args.part_concurrency)),
+)
+transfer_config = TransferConfig(
+    multipart_threshold=part_size,
+    multipart_chunksize=part_size,
+    max_concurrency=args.part_concurrency,
+)
+
+if args.no_skip_existing:
+    print("Copying all {} package files".format(len(keys)))
+elif args.src_inventory and args.dst_inventory:
+    src_inventory = read_inventory(args.src_inventory, keys=keys, s3_client=client)
+    dst_inventory = read_inventory(args.dst_inventory, keys=keys, s3_client=client)
+    delta = inventory_delta(src_inventory, dst_inventory, part_size, md5s)
+    delta = set(delta["key"].to_pylist())
+    # zips created after the inventory snapshot are not in it and still need copying
+    not_inventoried = set(keys) - set(src_inventory["key"].to_pylist())
+    print(
+        "Inventory diff: {} package files to copy, {} not in the source inventory yet, {} already in s3://{}".format(
+            len(delta),
+            len(not_inventoried),
+            len(keys) - len(delta) - len(not_inventoried),
+            DST_BUCKET,
+        )
+    )
+    keys = [key for key in keys if key in delta or key in not_inventoried]
+else:
+    src_objects = list_objects(client, SRC_BUCKET, keys, args.workers)
+    missing_sources = [key for key in keys if key not in src_objects]
+    if missing_sources:
+        print(
+            "{} package files are not in s3://{}, e.g. {}".format(
+                len(missing_sources), SRC_BUCKET, missing_sources[:3]
+            )
+        )
+
+    dst_objects = list_objects(client, DST_BUCKET, keys, args.workers)
+    skipped = [
+        key
+        for key in keys
+        if already_copied(
+            src_objects.get(key), dst_objects.get(key), part_size, md5s.get(key)
+        )
+    ]
+    print(
+        "Skipping {} package files already in s3://{} with the same size and ETag".format(
+            len(skipped), DST_BUCKET
+        )
+    )
+    skipped = set(skipped)
+    keys = [key for key in keys if key not in skipped]
+
+func = partial(copy_file, client, SRC_BUCKET, DST_BUCKET, transfer_config)
 
 failed_downloads = []  # possible failed downloads to retry later
-with tqdm.tqdm(desc="Copying...", total=len(files_to_download)) as pbar:
-    with ThreadPoolExecutor(max_workers=16) as executor:
+with tqdm.tqdm(desc="Copying...", total=len(keys)) as pbar:
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
         # Using a dict for preserving the downloaded file for each future, to store it as a failure if we need that
-        futures = {
-            executor.submit(func, file_to_download): file_to_download
-            for file_to_download in files_to_download
-        }
+        futures = {executor.submit(func, key): key for key in keys}
         for future in as_completed(futures):
             if future.exception():
-                failed_downloads.append([futures[future]])
+                failed_downloads.append(
+                    [BUCKET_PREFIXES[args.destination] + futures[future]]
+                )
             pbar.update(1)
 
 if len(failed_downloads) > 0:
@@ -101,4 +240,4 @@ if len(failed_downloads) > 0:
         wr = csv.writer(csvfile, quoting=csv.QUOTE_MINIMAL)
         wr.writerows(failed_downloads)
 else:
-    print("All {} copies were successful".format(len(files_to_download)))
+    print("All {} copies were successful".format(len(keys)))
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+"""
+Package GUID minting and the index of GUIDs minted so far
+
+Package GUIDs are derived from the zip: dg.MD1R/<md5(md5 + size) as a v4
+UUID>, so packaging the same zip again gives the same GUID. The index is a
+SQLite table keyed by GUID, recording the package each GUID was minted for;
+sequestration_split.py checks a batch against it before writing the
+indexing manifests and flags GUIDs already taken by another package, within
+the batch or by an earlier one, instead of finding out when indexing.
+
+Existing indexd records can be loaded with
+
+    python3 guid_index.py --index guids.sqlite --add_manifest <manifest.tsv> --batch indexd
+"""
+import argparse
+import hashlib
+import json
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+GUID_PREFIX = "dg.MD1R/"
+# GUIDs per lookup query
+CHUNK_SIZE = 100000
+
+
+def mint_guid(md5, size, prefix=GUID_PREFIX):
+    """
+    The GUID of a package, same as f"{prefix}{uuid.UUID(md5(...).hexdigest(), version=4)}"
+    """
+    digest = bytearray(hashlib.md5(f"{md5}{size}".encode("utf-8")).digest())
+    digest[6] = digest[6] & 0x0F | 0x40  # version 4
+    digest[8] = digest[8] & 0x3F | 0x80  # RFC 4122 variant
+    h = digest.hex()
+    return f"{prefix}{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def mint_guids(md5s, sizes, prefix=GUID_PREFIX):
+    """
+    mint_guid over columns of md5s and sizes, as a list
+    """
+    return [mint_guid(md5, size, prefix) for md5, size in zip(md5s, sizes)]
+
+
+def duplicates_within(guids, file_names):
+    """
+    Mask of the rows whose GUID was also minted for another package of the batch
+    """
+    rows = pd.DataFrame({"guid": list(guids), "file_name": list(file_names)})
+    packages = rows.drop_duplicates()
+    shared = packages.guid[packages.guid.duplicated(keep=False)]
+    return rows.guid.isin(set(shared)).to_numpy()
+
+
+class GuidIndex:
+    """
+    SQLite index of minted GUIDs: guid -> file_name, md5, size, batch
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # clustered on guid, so a lookup is one B-tree descent
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS guids ("
+            "guid TEXT PRIMARY KEY, file_name TEXT, md5 TEXT, size INTEGER, batch TEXT, minted_at REAL"
+            ") WITHOUT ROWID"
+        )
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM guids").fetchone()[0]
+
+    def __contains__(self, guid):
+        return (
+            self._db.execute("SELECT 1 FROM guids WHERE guid = ?", (guid,)).fetchone()
+            is not None
+        )
+
+    def lookup(self, guids):
+        """
+        Returns a DataFrame of the index entries of those guids that are in it
+        """
+        found = []
+        # sorted, so consecutive lookups walk neighbouring pages
+        guids = sorted(set(guids))
+        for start in range(0, len(guids), CHUNK_SIZE):
+            found.extend(
+                self._db.execute(
+                    "SELECT guid, file_name, md5, size, batch FROM guids "
+                    "WHERE guid IN (SELECT value FROM json_each(?))",
+                    (json.dumps(guids[start : start + CHUNK_SIZE]),),
+                )
+            )
+        return pd.DataFrame(
+            found, columns=["guid", "file_name", "md5", "size", "batch"]
+        )
+
+    def taken(self, guids, file_names):
+        """
+        Returns (mask, entries): which rows have a GUID the index holds for
+        another package, and the index entries of those GUIDs
+        """
+        entries = self.lookup(guids)
+        owner = dict(zip(entries.guid, entries.file_name))
+        mask = [
+            guid in owner and owner[guid] != file_name
+            for guid, file_name in zip(guids, file_names)
+        ]
+        return np.array(mask, dtype=bool), entries
+
+    def add(self, guids, file_names, md5s, sizes, batch):
+        """
+        Records minted GUIDs; GUIDs already in the index keep their entry
+        """
+        minted_at = time.time()
+        rows = sorted(zip(guids, file_names, md5s, sizes))
+        with self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO guids VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (guid, file_name, md5, int(size), batch, minted_at)
+                    for guid, file_name, md5, size in rows
+                ),
+            )
+
+
+def check_batch(index, packages, batch, shared=()):
+    """
+    Flags packages (a DataFrame with guid, file_name, md5 and size) whose
+    GUID is minted for another package, in the batch or in the index, and
+    records the others in the index under batch
+
+    When packages is only part of the batch, shared holds the GUIDs minted
+    for more than one package of the whole batch, which are flagged too.
+    Returns (mask of flagged rows, report DataFrame of the flagged rows with
+    the package holding their GUID in the index, if any).
+    """
+    guids, file_names = packages["guid"].tolist(), packages["file_name"].tolist()
+    within = duplicates_within(guids, file_names)
+    taken, entries = index.taken(guids, file_names)
+    flagged = within | taken
+    if shared:
+        flagged |= packages["guid"].isin(set(shared)).to_numpy()
+
+    report = packages.loc[flagged, ["guid", "file_name", "md5", "size"]].merge(
+        entries[["guid", "file_name", "batch"]].rename(
+            columns={"file_name": "indexed_file_name", "batch": "indexed_batch"}
+        ),
+        on="guid",
+        how="left",
+    )
+    fresh = packages.loc[~flagged]
+    index.add(
+        *(fresh[column].tolist() for column in ["guid", "file_name", "md5", "size"]),
+        batch,
+    )
+    return flagged, report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Load existing GUIDs into the package GUID index"
+    )
+    parser.add_argument(
+        "--index",
+        action="store",
+        type=str,
+        required=True,
+        help="SQLite GUID index file",
+    )
+    parser.add_argument(
+        "--add_manifest",
+        action="store",
+        type=str,
+        nargs="+",
+        required=True,
+        help="TSV manifests with guid, file_name, md5 and size columns, e.g. indexed packages",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store",
+        type=str,
+        default="indexd",
+        help="batch name recorded for these GUIDs",
+    )
+    args = parser.parse_args()
+
+    with GuidIndex(args.index) as index:
+        for manifest in args.add_manifest:
+            rows = pd.read_csv(
+                manifest,
+                sep="\t",
+                dtype=str,
+                usecols=["guid", "file_name", "md5", "size"],
+            )
+            rows = rows.dropna(subset=["guid"])
+            index.add(
+                rows.guid,
+                rows.file_name.fillna(""),
+                rows.md5.fillna(""),
+                rows["size"].fillna(0),
+                args.batch,
+            )
+            print(
+                "{}: {} GUIDs, index now holds {}".format(
+                    manifest, len(rows), len(index)
+                )
+            )
@@ -8,14 +8,43 @@ import re
 
 import csv
 import json
+import heapq
+import math
+import multiprocessing
+import queue
+import shutil
+import threading
+import time
 import zipfile
 import os
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import md5
 from io import BytesIO
+from itertools import chain, islice
 
 import boto3
-from pqdm.threads import pqdm
+from botocore.config import Config
+from tqdm import tqdm
+
+from compression_policy import POLICIES, ThreadCpuTimer, choose_compression, describe
+from package_plan import PACKAGE_PLAN_INDEX, PackagePlan
+from packages_manifest import PACKAGES_MANIFEST, PackagesManifestWriter
+from s3_multipart import S3MultipartWriter, DEFAULT_PART_SIZE
+from v3.manifest_reader import parse_size
+from v3.url_normalization import ORG_URL_REPLACEMENTS, normalize_storage_url
+
+
+def parse_bytes(value):
+    """
+    Parses a byte count such as '2147483648', '512M' or '8G'
+    """
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    value = value.strip().upper().rstrip("B")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
 
 parser = argparse.ArgumentParser(description="Package a MIDRC batch submission")
 parser.add_argument(
@@ -25,10 +54,96 @@ parser.add_argument(
     required=True,
     help="the batch directory containing packages.txt",
 )
+parser.add_argument(
+    "--stream",
+    action="store_true",
+    help="stream S3 objects straight into a multipart upload of the zip instead of building it in memory",
+)
+parser.add_argument(
+    "--part_size_mb",
+    action="store",
+    type=int,
+    default=DEFAULT_PART_SIZE // (1024 * 1024),
+    help="multipart upload part size in MiB used with --stream (min 5)",
+)
+parser.add_argument(
+    "--prefetch",
+    action="store",
+    type=int,
+    default=8,
+    help="number of instances downloaded ahead within each series (0 streams them one at a time)",
+)
+parser.add_argument(
+    "--n_jobs",
+    action="store",
+    type=int,
+    default=6,
+    help="number of series packaged concurrently",
+)
+parser.add_argument(
+    "--max_inflight_bytes",
+    "--max-inflight-bytes",
+    action="store",
+    type=parse_bytes,
+    default=None,
+    help="cap on the summed file_size of series being packaged at the same time, e.g. '16G'",
+)
+parser.add_argument(
+    "--verify_uploaded",
+    action="store_true",
+    help="HEAD the zip of every checkpointed series and repackage it if it is missing or has the wrong size",
+)
+parser.add_argument(
+    "--compression",
+    action="store",
+    choices=POLICIES,
+    default="stored",
+    help="zip compression: always stored, always deflate, or auto to pick per series from its first instances",
+)
+parser.add_argument(
+    "--compresslevel",
+    action="store",
+    type=int,
+    default=6,
+    help="deflate level (1-9) when deflate is used",
+)
+parser.add_argument(
+    "--sample_instances",
+    action="store",
+    type=int,
+    default=3,
+    help="number of leading instances of a series sampled by --compression auto",
+)
+parser.add_argument(
+    "--backend",
+    action="store",
+    choices=["thread", "process", "hybrid"],
+    default="thread",
+    help="run the --n_jobs packaging workers as threads, as processes, or as threads spread over --processes processes",
+)
+parser.add_argument(
+    "--processes",
+    action="store",
+    type=int,
+    default=os.cpu_count(),
+    help="number of worker processes for --backend hybrid",
+)
+parser.add_argument(
+    "--endpoint_url",
+    action="store",
+    type=str,
+    default=None,
+    help="S3 endpoint, e.g. a local S3 stand-in for benchmarking",
+)
 args = parser.parse_args()
 
+N_JOBS = args.n_jobs  # series packaged concurrently
+# read size for copying an S3 GET body into a zip entry
+COPY_CHUNK_SIZE = 1024 * 1024
+
 batch = args.batch_dir.split('/')[-1]
-print("Processing batch '{}' in directory '{}'.".format(batch,args.batch_dir))
+if __name__ == "__main__":
+    print("Processing batch '{}' in directory '{}'.".format(batch,args.batch_dir))
 
 org = batch.split("_",1)[0] #org = batch.split("_",1)[0]
 if org in ['ACR','RSNA']:
@@ -36,143 +151,588 @@ if org in ['ACR','RSNA']:
 else:
     SRC_BUCKET = "midrcprod-default-813684607867-upload" # for non-RSNA/ACR uploads like TCIA
 DST_BUCKET = "internal-data-midrc-replication"
-s3 = boto3.resource("s3")
+# storage_urls of non-RSNA/ACR batches point into the TCIA upload bucket
+URL_ORG = org if org in ORG_URL_REPLACEMENTS else "TCIA"
+# shared by the main process and every worker process, which builds its own
+# client from it; one connection per concurrent GET, otherwise urllib3
+# discards pooled connections
+S3_CONFIG = Config(max_pool_connections=max(10, N_JOBS * (args.prefetch + 1)))
+s3 = boto3.resource("s3", endpoint_url=args.endpoint_url, config=S3_CONFIG)
 src_bucket = s3.Bucket(SRC_BUCKET)
 dst_bucket = s3.Bucket(DST_BUCKET)
 
+PACKAGE_REGEX = re.compile(r'^.*cases\/(.*)\/(.*)\/(.*).tsv$')
+# batches processed with --package_plan have no per-series TSV files
+package_plan = (
+    PackagePlan(args.batch_dir)
+    if os.path.isfile(os.path.join(args.batch_dir, PACKAGE_PLAN_INDEX))
+    else None
+)
+CHECKPOINT_FILE = "packaging_checkpoint.jsonl"
+PACKAGING_REPORT = "packaging_report.tsv"
+REPORT_FIELDNAMES = [
+    "series_uid",
+    "files",
+    "fetched_bytes",
+    "zip_size",
+    "zip_ratio",
+    "compression",
+    "reason",
+    "sample_ratio",
+    "cpu_seconds",
+]
+
+
+class CheckpointJournal:
+    """
+    Append-only JSONL journal of series that were packaged and uploaded
+
+    A line is appended only after the zip is uploaded and its row is written
+    to the packages manifest, so every series in the journal is complete. A partially
+    written last line (from a crash) is ignored on load.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        if os.path.isfile(path):
+            with open(path, encoding="utf8") as journal_file:
+                for line in journal_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.completed[entry["series_uid"]] = entry
+        truncated = False
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as journal_file:
+                journal_file.seek(-1, os.SEEK_END)
+                truncated = journal_file.read(1) != b"\n"
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf8")
+        if truncated:
+            # terminate a truncated last line so new entries start on their own line
+            self._file.write("\n")
+
+    def record(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.completed[entry["series_uid"]] = entry
+
+    def close(self):
+        self._file.close()
+
+
+def is_uploaded(entry):
+    """
+    Confirms with a HEAD that the checkpointed zip exists with the recorded size
+    """
+    try:
+        response = s3.meta.client.head_object(Bucket=DST_BUCKET, Key=entry["url"])
+    except Exception:
+        return False
+    return response["ContentLength"] == int(entry["size"])
+
+
+def skip_completed(package_manifests, checkpoint):
+    """
+    Drops series already recorded in the checkpoint journal (and, with
+    --verify_uploaded, whose zip is in the destination bucket)
+    """
+    done = {}
+    for package_manifest in package_manifests:
+        series_uid = PACKAGE_REGEX.match(package_manifest).group(3)
+        entry = checkpoint.completed.get(series_uid)
+        if entry is not None:
+            done[package_manifest] = entry
+
+    if args.verify_uploaded and done:
+        print("Verifying {} checkpointed zips in s3://{}".format(len(done), DST_BUCKET))
+        with ThreadPoolExecutor(max_workers=N_JOBS * 4) as executor:
+            verified = list(executor.map(is_uploaded, done.values()))
+        done = {m: e for (m, e), ok in zip(done.items(), verified) if ok}
+
+    if done:
+        print(
+            "Skipping {} series already packaged according to {}".format(
+                len(done), checkpoint.path
+            )
+        )
+    return [m for m in package_manifests if m not in done]
+
+
 def read_packages_list():
     #series = defaultdict(list)
-    os.makedirs("{}/packages".format(args.batch_dir), exist_ok=True)
     package_manifests = []
     with open("{}/packages.txt".format(args.batch_dir), encoding="utf8") as packages_list:
         for line in packages_list.readlines():
             line = line.strip()
-            package_manifests.append(line)
+            if line:
+                package_manifests.append(line)
     return package_manifests
 
-def create_archive(files, series_uid):
+
+def open_series_file(package_manifest):
+    """
+    Opens a series manifest TSV, from the package plan if the batch has one
     """
-    Creates archive for package
+    if package_plan is not None and package_manifest in package_plan:
+        return package_plan.open_series(package_manifest)
+    return open(package_manifest, encoding="utf8")
 
-    For trouble-shooting:
-        filename = files[0][0]
-        file_url = files[0][1]
 
+def read_series_size(package_manifest):
     """
-    archive = BytesIO()
-    count,total = 0,len(files)
-    with zipfile.ZipFile(archive, "w") as zip_archive:
+    Sums the file_size column of a series TSV; sizes may contain thousands separators
+    """
+    total = 0
+    with open_series_file(package_manifest) as series_file:
+        reader = csv.DictReader(series_file, delimiter="\t")
+        for row in reader:
+            size = (row.get("file_size") or "").replace(",", "").strip()
+            if size.isdigit():
+                total += int(size)
+    return total
+
+
+def schedule_packages(package_manifests, n_jobs):
+    """
+    Orders series longest-processing-time first, using total bytes as the cost
+
+    Workers pull series in this order, so the big series start first and the
+    small ones fill in the gaps at the end instead of leaving a long tail.
+    Returns (ordered manifests, {manifest: bytes}).
+    """
+    series_bytes = {m: read_series_size(m) for m in package_manifests}
+    ordered = sorted(package_manifests, key=lambda m: series_bytes[m], reverse=True)
+
+    # simulate the greedy assignment to report how evenly bytes spread over workers
+    loads = [0] * max(1, n_jobs)
+    for package_manifest in ordered:
+        heapq.heapreplace(loads, loads[0] + series_bytes[package_manifest])
+    total = sum(series_bytes.values())
+    print(
+        "Scheduled {} series ({:.1f} GB) over {} workers; expected bytes per worker {:.1f}-{:.1f} GB".format(
+            len(ordered), total / 1e9, len(loads), min(loads) / 1e9, max(loads) / 1e9
+        )
+    )
+    return ordered, series_bytes
+
+
+def fetch_object(file_url, read_body=True):
+    """
+    GETs a source object; the response carries LastModified, so no extra HEAD is needed
+    """
+    response = s3.meta.client.get_object(Bucket=SRC_BUCKET, Key=file_url)
+    if read_body:
+        response["Body"] = BytesIO(response["Body"].read())
+    return response
+
+
+def fetch_objects(files, prefetch):
+    """
+    Yields (filename, GET response) for files in manifest order
+
+    With prefetch > 0 a thread pool downloads up to `prefetch` objects ahead
+    of the consumer, so zip entries are still written in deterministic order.
+    With prefetch == 0 objects are fetched one at a time and their bodies are
+    left unread so they can be streamed.
+    """
+    files = iter(files)
+    if prefetch < 1:
         for filename, file_url in files:
-            count+=1
-            #print("Creating archive: {}/{}".format(count,total),end='\r')
-            file_obj = BytesIO()
-            obj_path = file_url
-            obj = src_bucket.Object(obj_path)
             try:
-                obj.download_fileobj(file_obj)
+                response = fetch_object(file_url, read_body=False)
             except:
-                print("Object failed to download: {}\n\t".format(filename,file_url))
-            in_zip_path = "{}/{}".format(series_uid, filename)
-            last_modified = obj.last_modified
-            last_modified = tuple(last_modified.timetuple()[0:6])
-            zinfo = zipfile.ZipInfo(filename=in_zip_path, date_time=last_modified)
-            file_obj.seek(0)
-            zip_archive.writestr(zinfo, file_obj.getvalue())
-    return archive
+                print("Object failed to download: {}\n\t{}".format(filename, file_url))
+                raise
+            yield filename, response
+        return
+
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    pending = deque()
+    try:
+        for filename, file_url in islice(files, prefetch):
+            pending.append((filename, file_url, executor.submit(fetch_object, file_url)))
+        while pending:
+            filename, file_url, future = pending.popleft()
+            for next_filename, next_url in islice(files, 1):
+                pending.append(
+                    (next_filename, next_url, executor.submit(fetch_object, next_url))
+                )
+            try:
+                response = future.result()
+            except:
+                print("Object failed to download: {}\n\t{}".format(filename, file_url))
+                raise
+            yield filename, response
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def open_series(files):
+    """
+    Starts fetching the series and picks its compression from the first
+    --sample_instances instances; returns (choice, responses) where responses
+    yields every (filename, GET response) in manifest order
+    """
+    responses = fetch_objects(files, args.prefetch)
+    if args.compression != "auto":
+        return choose_compression([], args.compression, args.compresslevel), responses
+
+    samples = list(islice(responses, args.sample_instances))
+    sample_bodies = []
+    for _, response in samples:
+        body = response["Body"].read()
+        response["Body"] = BytesIO(body)
+        sample_bodies.append(body)
+    choice = choose_compression(sample_bodies, args.compression, args.compresslevel)
+    return choice, chain(samples, responses)
+
+
+def write_zip_entries(zip_archive, responses, series_uid):
+    """
+    Writes every file of the series into zip_archive and returns the number of bytes fetched
+    """
+    fetched_bytes = 0
+    for filename, response in responses:
+        in_zip_path = "{}/{}".format(series_uid, filename)
+        last_modified = tuple(response["LastModified"].timetuple()[0:6])
+        zinfo = zipfile.ZipInfo(filename=in_zip_path, date_time=last_modified)
+        zinfo.file_size = response["ContentLength"]
+        zinfo.compress_type = zip_archive.compression
+        # ZipFile.open() takes the level from the ZipInfo, not from the archive
+        zinfo._compresslevel = zip_archive.compresslevel
+        with zip_archive.open(zinfo, "w") as zip_entry:
+            shutil.copyfileobj(response["Body"], zip_entry, COPY_CHUNK_SIZE)
+        fetched_bytes += response["ContentLength"]
+    return fetched_bytes
+
+
+def create_archive(responses, series_uid, choice):
+    """
+    Creates archive for package and returns (archive, fetched_bytes)
+
+    For trouble-shooting:
+        choice, responses = open_series(files)
+
+    """
+    archive = BytesIO()
+    with zipfile.ZipFile(
+        archive, "w", compression=choice.compression, compresslevel=choice.compresslevel
+    ) as zip_archive:
+        fetched_bytes = write_zip_entries(zip_archive, responses, series_uid)
+    return archive, fetched_bytes
+
+
+def create_archive_stream(responses, series_uid, zip_url, choice):
+    """
+    Streams the package straight to s3://DST_BUCKET/zip_url and returns (md5sum, size, fetched_bytes)
+
+    Each S3 GET body is copied chunk by chunk into its zip entry, and the zip
+    output goes into a multipart upload, so memory per series is bounded by
+    the part size (plus --prefetch objects) instead of the series size.
+    """
+    with S3MultipartWriter(
+        s3.meta.client, DST_BUCKET, zip_url, part_size=args.part_size_mb * 1024 * 1024
+    ) as zip_stream:
+        with zipfile.ZipFile(
+            zip_stream,
+            "w",
+            compression=choice.compression,
+            compresslevel=choice.compresslevel,
+        ) as zip_archive:
+            fetched_bytes = write_zip_entries(zip_archive, responses, series_uid)
+    return zip_stream.md5sum, zip_stream.size, fetched_bytes
 
 
 def process_packages(package_manifest):
     """
-    Process package file
+    Process package file: builds and uploads the zip and returns the result
+    for write_package_result
     For trouble-shooting:
         package_manifest = package_manifests[0]
     """
-    package_regex = re.compile(r'^.*cases\/(.*)\/(.*)\/(.*).tsv$')
-    case_id, study_uid, series_uid = package_regex.match(package_manifest).groups()
+    case_id, study_uid, series_uid = PACKAGE_REGEX.match(package_manifest).groups()
 
     files_metadata = []
     files = []
 
-    with open(package_manifest, encoding="utf8") as series_file:
+    with open_series_file(package_manifest) as series_file:
         reader = csv.DictReader(series_file, delimiter="\t")
         for row in reader:
             file_name = row["file_name"]
-            if org == "RSNA":
-                url = row["storage_urls"].replace("s3://storage.ir.rsna.ai/", "")
-            elif org == "ACR":
-                url = row["storage_urls"].replace("//", "replicated-data-acr/")
-                ## for ACR batch6
-                # url = url.replace("/0914/", "/10/batch6/")
-            else:
-                url = row["storage_urls"].replace("[", "").replace("]", "").replace("'", "")
-                url = url.replace("s3://midrcprod-default-813684607867-upload/", "")
+            url = normalize_storage_url(row["storage_urls"], URL_ORG)
+            ## for ACR batch6
+            # url = url.replace("/0914/", "/10/batch6/")
 
             files.append((file_name, url))
             files_metadata.append(
                 {
                     "hashes": {"md5sum": row["md5sum"]},
                     "file_name": "{}/{}".format(series_uid, file_name),
-                    "size": row["file_size"],
+                    # integer sizes keep package_contents canonical, see packages_manifest.py
+                    "size": parse_size(row["file_size"]),
                 }
             )
 
-    try:
-        zip_obj = create_archive(files, series_uid)
-    except:
-        print("create_archive failed for {}".format(package_manifest))
+    zip_file_name = "{}/{}/{}.zip".format(case_id, study_uid, series_uid)
+    zip_url = "zip/{}".format(zip_file_name)
+
+    with ThreadCpuTimer() as cpu:
+        choice, responses = open_series(files)
+        if args.stream:
+            try:
+                md5sum, size, fetched_bytes = create_archive_stream(
+                    responses, series_uid, zip_url, choice
+                )
+            except:
+                print("create_archive_stream failed for {}".format(package_manifest))
+                raise
+        else:
+            try:
+                zip_obj, fetched_bytes = create_archive(responses, series_uid, choice)
+            except:
+                print("create_archive failed for {}".format(package_manifest))
+                raise
 
-    size = zip_obj.getbuffer().nbytes
+            size = zip_obj.getbuffer().nbytes
 
-    zip_obj.seek(0)
-    md5sum = md5(zip_obj.getbuffer())
-    md5sum = md5sum.hexdigest()
+            zip_obj.seek(0)
+            md5sum = md5(zip_obj.getbuffer())
+            md5sum = md5sum.hexdigest()
 
-    zip_file_name = "{}/{}/{}.zip".format(case_id, study_uid, series_uid)
-    zip_url = "zip/{}".format(zip_file_name)
+            zip_obj.seek(0)
+            dst_bucket.Object(zip_url).upload_fileobj(zip_obj)
+
+    return {
+        "series_uid": series_uid,
+        "package_manifest": package_manifest,
+        "files": len(files),
+        "fetched_bytes": fetched_bytes,
+        "report": {
+            "series_uid": series_uid,
+            "files": len(files),
+            "fetched_bytes": fetched_bytes,
+            "zip_size": size,
+            "zip_ratio": "{:.3f}".format(size / fetched_bytes) if fetched_bytes else "",
+            "compression": describe(choice),
+            "reason": choice.reason,
+            "sample_ratio": "" if choice.sample_ratio is None else "{:.3f}".format(choice.sample_ratio),
+            "cpu_seconds": "{:.3f}".format(cpu.seconds),
+        },
+        "row": {
+            "record_type": "package",
+            "guid": "",
+            "md5": md5sum,
+            "size": size,
+            "authz": "",
+            "url": zip_url,
+            "file_name": zip_file_name,
+            "package_contents": json.dumps(files_metadata),
+        },
+    }
 
-    zip_obj.seek(0)
-    dst_bucket.Object(zip_url).upload_fileobj(zip_obj)
-
-    with open(
-        "{}/packages/{}.txt".format(args.batch_dir,series_uid), "w", encoding="utf8"
-    ) as tsv_result_file:
-        fieldnames = [
-            "record_type",
-            "guid",
-            "md5",
-            "size",
-            "authz",
-            "url",
-            "file_name",
-            "package_contents",
+
+def write_package_result(result, manifest, report, checkpoint):
+    """
+    Appends the package row to the packages manifest and its stats to the
+    packaging report, then records the series in the checkpoint
+
+    Only the main process calls this, so output files have a single writer
+    whatever the backend.
+    """
+    row = result["row"]
+    manifest.write_row(row)
+    report.write_row(result["report"])
+    checkpoint.record(
+        {
+            "series_uid": result["series_uid"],
+            "package_manifest": result["package_manifest"],
+            "md5": row["md5"],
+            "size": row["size"],
+            "url": row["url"],
+            "files": result["files"],
+        }
+    )
+
+
+def package_worker(task_queue, result_queue):
+    """
+    Packages series from task_queue until it reads None, posting
+    (status, package_manifest, result or error) to result_queue
+    """
+    while True:
+        package_manifest = task_queue.get()
+        if package_manifest is None:
+            return
+        try:
+            result_queue.put(("done", package_manifest, process_packages(package_manifest)))
+        except Exception as err:
+            result_queue.put(("failed", package_manifest, repr(err)))
+
+
+def package_worker_process(task_queue, result_queue, n_threads):
+    """
+    Entry point of a worker process; runs n_threads package_worker threads
+    """
+    threads = [
+        threading.Thread(target=package_worker, args=(task_queue, result_queue))
+        for _ in range(n_threads)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def start_workers(task_queue, result_queue):
+    """
+    Starts the packaging workers for args.backend and returns (workers, n_slots)
+    where n_slots is the number of series that can be packaged at once
+    """
+    if args.backend == "thread":
+        n_processes, n_threads = 0, N_JOBS
+    elif args.backend == "process":
+        n_processes, n_threads = N_JOBS, 1
+    else:
+        n_processes = max(1, min(args.processes, N_JOBS))
+        n_threads = math.ceil(N_JOBS / n_processes)
+
+    if n_processes == 0:
+        workers = [
+            threading.Thread(
+                target=package_worker, args=(task_queue, result_queue), daemon=True
+            )
+            for _ in range(n_threads)
         ]
-        tsv_writer = csv.DictWriter(
-            tsv_result_file, delimiter="\t", fieldnames=fieldnames
-        )
-        tsv_writer.writeheader()
-        tsv_writer.writerow(
-            {
-                "record_type": "package",
-                "guid": "",
-                "md5": md5sum,
-                "size": size,
-                "authz": "",
-                "url": zip_url,
-                "file_name": zip_file_name,
-                "package_contents": json.dumps(files_metadata),
-            }
-        )
-    return {series_uid:len(files)}
+    else:
+        # spawn rather than fork: boto3 clients are not fork-safe, and each
+        # child re-imports this script and builds its own client from S3_CONFIG
+        context = multiprocessing.get_context("spawn")
+        workers = [
+            context.Process(
+                target=package_worker_process,
+                args=(task_queue, result_queue, n_threads),
+                daemon=True,
+            )
+            for _ in range(n_processes)
+        ]
+    for worker in workers:
+        worker.start()
+    return workers, max(1, n_processes) * n_threads
+
+
+def next_result(result_queue, workers):
+    """
+    Waits for the next series result, failing fast if a worker process died
+    (e.g. was OOM-killed) since its series would never report back
+    """
+    while True:
+        try:
+            return result_queue.get(timeout=10)
+        except queue.Empty:
+            dead = [w for w in workers if not w.is_alive()]
+            if dead:
+                raise RuntimeError(
+                    "{} packaging worker(s) exited unexpectedly; rerun to resume from the checkpoint".format(
+                        len(dead)
+                    )
+                )
+
+
+def run_packaging(package_manifests, series_bytes, manifest, report, checkpoint):
+    """
+    Feeds series to the workers in scheduled order and writes their results
+
+    A series is only handed out while a worker slot is free and, with
+    --max_inflight_bytes, while the summed size of the series in flight stays
+    under the cap. A series larger than the whole cap runs on its own.
+    Returns ({series_uid: (files, fetched_bytes)}, [(package_manifest, error)]).
+    """
+    if args.backend == "thread":
+        task_queue, result_queue = queue.Queue(), queue.Queue()
+    else:
+        context = multiprocessing.get_context("spawn")
+        task_queue, result_queue = context.Queue(), context.Queue()
+    workers, n_slots = start_workers(task_queue, result_queue)
+
+    limit = args.max_inflight_bytes
+    pending = deque(package_manifests)
+    reserved = {}
+    results, failed = {}, []
+    with tqdm(desc="Packaging...", total=len(pending)) as pbar:
+        while pending or reserved:
+            while pending and len(reserved) < n_slots:
+                nbytes = series_bytes[pending[0]]
+                if limit is not None:
+                    nbytes = min(nbytes, limit)
+                    if reserved and sum(reserved.values()) + nbytes > limit:
+                        break
+                package_manifest = pending.popleft()
+                reserved[package_manifest] = nbytes
+                task_queue.put(package_manifest)
+
+            status, package_manifest, result = next_result(result_queue, workers)
+            del reserved[package_manifest]
+            if status == "done":
+                write_package_result(result, manifest, report, checkpoint)
+                results[result["series_uid"]] = (result["files"], result["fetched_bytes"])
+            else:
+                print("Packaging failed for {}: {}".format(package_manifest, result))
+                failed.append((package_manifest, result))
+            pbar.update(1)
+
+    for _ in range(n_slots):
+        task_queue.put(None)
+    for worker in workers:
+        worker.join()
+    return results, failed
+
 
 def main():
     """
         Boilerplate for entrypoint for packaging script.
     """
     package_manifests = read_packages_list()
-    result = pqdm(package_manifests, process_packages, n_jobs=6)
-    results = {k: v for d in result for k, v in d.items()}
-    total_packaged = sum(results.values())
+    checkpoint = CheckpointJournal("{}/{}".format(args.batch_dir, CHECKPOINT_FILE))
+    package_manifests = skip_completed(package_manifests, checkpoint)
+    package_manifests, series_bytes = schedule_packages(package_manifests, N_JOBS)
+
+    manifest = PackagesManifestWriter("{}/{}".format(args.batch_dir, PACKAGES_MANIFEST))
+    report = PackagesManifestWriter(
+        "{}/{}".format(args.batch_dir, PACKAGING_REPORT), fieldnames=REPORT_FIELDNAMES
+    )
+
+    start_time = time.time()
+    results, failed = run_packaging(
+        package_manifests, series_bytes, manifest, report, checkpoint
+    )
+    elapsed = max(time.time() - start_time, 1e-9)
+    manifest.close()
+    report.close()
+    checkpoint.close()
+    print("Package rows written to: {}/{}".format(args.batch_dir, PACKAGES_MANIFEST))
+
+    if failed:
+        print(
+            "{} series failed and will be retried on the next run: {}".format(
+                len(failed), [m for m, _ in failed[:5]]
+            )
+        )
+    total_packaged = sum(n_files for n_files, _ in results.values())
+    total_bytes = sum(n_bytes for _, n_bytes in results.values())
     print("Total files packaged: {}".format(total_packaged))
+    print(
+        "Throughput: {:.1f} files/s, {:.1f} MB/s ({:.1f} MB in {:.0f}s)".format(
+            total_packaged / elapsed,
+            total_bytes / 1e6 / elapsed,
+            total_bytes / 1e6,
+            elapsed,
+        )
+    )
 
 if __name__ == "__main__":
     main()
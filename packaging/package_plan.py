@@ -0,0 +1,82 @@
+"""
+Indexed package plan: every series manifest of a batch in one TSV
+
+Instead of one cases/<case>/<study>/<series>.tsv file per series,
+process_midrc_submission.py can write <batch>/package_plan.tsv, which holds
+the instance rows of all series contiguously under a single header, and
+<batch>/package_plan_index.tsv, which maps each series path listed in
+packages.txt to the byte range of its rows. When the batch has a plan index,
+package_midrc_series.py reads every series it lists from the plan, and only
+falls back to the series file for series missing from the index.
+"""
+
+import csv
+import os
+from io import StringIO
+
+PACKAGE_PLAN = "package_plan.tsv"
+PACKAGE_PLAN_INDEX = "package_plan_index.tsv"
+INDEX_FIELDNAMES = ["series_path", "offset", "length", "instances"]
+
+
+def write_package_plan(batch_path, header, series):
+    """
+    Writes the plan and its index
+
+    series yields (series_path, rows) with rows as lists of values in header
+    order; the series are written in the order given.
+    """
+    plan_path = os.path.join(batch_path, PACKAGE_PLAN)
+    index_path = os.path.join(batch_path, PACKAGE_PLAN_INDEX)
+    buffer = StringIO()
+    writer = csv.writer(buffer, delimiter="\t", lineterminator="\n")
+
+    with open(plan_path, "wb") as plan, open(
+        index_path, "w", encoding="utf8", newline=""
+    ) as index_file:
+        index = csv.writer(index_file, delimiter="\t", lineterminator="\n")
+        index.writerow(INDEX_FIELDNAMES)
+        writer.writerow(header)
+        plan.write(buffer.getvalue().encode("utf8"))
+
+        for series_path, rows in series:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(rows)
+            data = buffer.getvalue().encode("utf8")
+            index.writerow([series_path, plan.tell(), len(data), len(rows)])
+            plan.write(data)
+    return plan_path
+
+
+class PackagePlan:
+    """
+    Reads single series out of a package plan by their series path
+    """
+
+    def __init__(self, batch_path):
+        self.path = os.path.join(batch_path, PACKAGE_PLAN)
+        self.index = {}
+        with open(
+            os.path.join(batch_path, PACKAGE_PLAN_INDEX), encoding="utf8", newline=""
+        ) as index_file:
+            for row in csv.DictReader(index_file, delimiter="\t"):
+                self.index[row["series_path"]] = (
+                    int(row["offset"]),
+                    int(row["length"]),
+                )
+        with open(self.path, "rb") as plan:
+            self.header = plan.readline()
+
+    def __contains__(self, series_path):
+        return series_path in self.index
+
+    def open_series(self, series_path):
+        """
+        Returns the series manifest (header and rows) as a text file object
+        """
+        offset, length = self.index[series_path]
+        with open(self.path, "rb") as plan:
+            plan.seek(offset)
+            data = plan.read(length)
+        return StringIO((self.header + data).decode("utf8"), newline="")
@@ -0,0 +1,169 @@
+"""
+Consolidated packages manifest: one TSV row per packaged series
+
+Packaging appends one row per series to <batch_dir>/packages_manifest.tsv
+instead of writing packages/<series_uid>.txt files, so downstream steps read
+a whole batch in one pass. Each row is flushed as soon as its zip is
+uploaded; a row cut short by a crash is dropped when the manifest is
+reopened, and a series packaged again on a later run supersedes its older row.
+
+package_contents is written in canonical form, JSON with integer sizes, so
+later steps pass it through as is; normalize_package_contents rewrites rows
+of batches packaged before that (single quotes, string sizes).
+"""
+
+import csv
+import json
+import os
+import sys
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# package_contents of large CT series runs into megabytes
+csv.field_size_limit(sys.maxsize)
+
+PACKAGES_MANIFEST = "packages_manifest.tsv"
+FIELDNAMES = [
+    "record_type",
+    "guid",
+    "md5",
+    "size",
+    "authz",
+    "url",
+    "file_name",
+    "package_contents",
+]
+
+
+def normalize_package_contents(package_contents):
+    """
+    Rewrites a legacy package_contents in canonical form
+    """
+    contents = json.loads(package_contents.replace("'", '"'))
+    for entry in contents:
+        entry["size"] = int(entry["size"])
+    return json.dumps(contents)
+
+
+def check_package_contents(package_contents):
+    """
+    Returns why package_contents is not in canonical form, or None if it is
+    """
+    try:
+        contents = json_loads(package_contents)
+    except ValueError as err:
+        return "invalid JSON: {}".format(err)
+    if not isinstance(contents, list):
+        return "not a list"
+    for entry in contents:
+        if not isinstance(entry, dict) or "file_name" not in entry:
+            return "entry without file_name"
+        size = entry.get("size")
+        if not isinstance(size, int) or isinstance(size, bool):
+            return "size {!r} of {} is not an integer".format(size, entry["file_name"])
+    return None
+
+
+def truncate_partial_line(path, block_size=64 * 1024):
+    """
+    Cuts the file back to its last newline, dropping a partially written row
+    """
+    with open(path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - block_size)
+            f.seek(start)
+            block = f.read(pos - start)
+            newline = block.rfind(b"\n")
+            if newline != -1:
+                if start + newline + 1 != end:
+                    f.truncate(start + newline + 1)
+                return
+            pos = start
+        f.truncate(0)
+
+
+class PackagesManifestWriter:
+    """
+    Appends package rows to the consolidated manifest, one durable line per row
+
+    Also used for other per-series batch outputs (like the packaging report)
+    by passing their fieldnames.
+    """
+
+    def __init__(self, path, fieldnames=FIELDNAMES):
+        self.path = path
+        if os.path.isfile(path):
+            truncate_partial_line(path)
+        self._file = open(path, "a", encoding="utf8", newline="")
+        self._writer = csv.DictWriter(
+            self._file, delimiter="\t", fieldnames=fieldnames, lineterminator="\n"
+        )
+        if self._file.tell() == 0:
+            self._writer.writeheader()
+
+    def write_row(self, row):
+        self._writer.writerow(row)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def read_packages_manifest(path):
+    """
+    Yields the package rows of a consolidated manifest in file order
+
+    Only complete lines are read, and when a series was packaged more than
+    once only its last row is kept.
+    """
+
+    def complete_lines(f):
+        return (line for line in f if line.endswith("\n"))
+
+    with open(path, encoding="utf8", newline="") as f:
+        last_row = {}
+        reader = csv.DictReader(complete_lines(f), delimiter="\t")
+        for n, row in enumerate(reader):
+            last_row[row["file_name"]] = n
+
+    keep = set(last_row.values())
+    with open(path, encoding="utf8", newline="") as f:
+        reader = csv.DictReader(complete_lines(f), delimiter="\t")
+        for n, row in enumerate(reader):
+            if n in keep:
+                yield row
+
+
+def has_packages_manifest(batch_dir):
+    """
+    False for batches packaged before packages_manifest.tsv existed, whose
+    rows are in packages/<series_uid>.txt files
+    """
+    return os.path.isfile(os.path.join(batch_dir, PACKAGES_MANIFEST))
+
+
+def read_package_rows(batch_dir):
+    """
+    Yields every package row of a batch, from packages_manifest.tsv or, for
+    batches packaged before it existed, from the packages/<series_uid>.txt files
+    """
+    manifest_path = os.path.join(batch_dir, PACKAGES_MANIFEST)
+    if has_packages_manifest(batch_dir):
+        yield from read_packages_manifest(manifest_path)
+        return
+
+    package_dir = os.path.join(batch_dir, "packages")
+    assert os.path.isdir(package_dir), "Neither {} nor {} exists".format(
+        manifest_path, package_dir
+    )
+    for entry in os.scandir(package_dir):
+        if not entry.name.endswith(".txt"):
+            continue
+        with open(entry.path, encoding="utf8") as package_file:
+            yield from csv.DictReader(package_file, delimiter="\t")
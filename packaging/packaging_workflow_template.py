@@ -16,7 +16,11 @@ sed -i 's/case_id/case_ids/g' image_manifest_${batch}.tsv
 
 """
 # upload the script
+# process_midrc_submission.py and package_midrc_series.py import shared helpers from the repo's v3 package;
+# copying it next to the scripts is enough for `from v3 import ...` to resolve
+scp -r ${repo}/v3 utilityvm.midrc.csoc:/home/ubuntu/wd/scripts/
 scp /Users/christopher/Documents/Notes/MIDRC/packaging/scripts/process_midrc_submission.py utilityvm.midrc.csoc:/home/ubuntu/wd/scripts/
+scp /Users/christopher/Documents/Notes/MIDRC/packaging/scripts/package_plan.py utilityvm.midrc.csoc:/home/ubuntu/wd/scripts/
 
 
 # input shell variables
@@ -27,6 +31,8 @@ script="/home/ubuntu/wd/scripts/process_midrc_submission.py"
 
 # command to run in terminal
 python3 ${script} --batch ${batch} --input_path ${input_path} --output_path ${output_path}
+# or write one indexed package_plan.tsv instead of a TSV per series (read by the packaging script)
+python3 ${script} --batch ${batch} --input_path ${input_path} --output_path ${output_path} --package_plan
 
 # checks
 find ${output_path}/${batch}/cases -name "*.tsv" | wc -l
@@ -34,11 +40,15 @@ head ${output_path}/${batch}/packages.txt
 
 """
 2) Run packaging script
-- This creates the packages in s3 and also creates the "packages" dir in the batch's output directory, which contains series package manifest files named "<series_uid>.txt"
+- This creates the packages in s3 and also appends one row per series package to "packages_manifest.tsv" in the batch's output directory
 - Probably want to use tmux to keep packaging running in case you're disconnected.
 """
-# upload the script
+# upload the script and its helper modules
 scp /Users/christopher/Documents/Notes/MIDRC/packaging/scripts/package_midrc_series.py utilityvm.midrc.csoc:/home/ubuntu/wd/scripts/
+scp /Users/christopher/Documents/Notes/MIDRC/packaging/scripts/s3_multipart.py utilityvm.midrc.csoc:/home/ubuntu/wd/scripts/
+scp /Users/christopher/Documents/Notes/MIDRC/packaging/scripts/packages_manifest.py utilityvm.midrc.csoc:/home/ubuntu/wd/scripts/
+scp /Users/christopher/Documents/Notes/MIDRC/packaging/scripts/compression_policy.py utilityvm.midrc.csoc:/home/ubuntu/wd/scripts/
+scp /Users/christopher/Documents/Notes/MIDRC/packaging/scripts/package_plan.py utilityvm.midrc.csoc:/home/ubuntu/wd/scripts/
 
 tmux
 batch="ACR_20220606"
@@ -46,6 +56,25 @@ script="/home/ubuntu/wd/scripts/package_midrc_series.py"
 batch_dir="/home/ubuntu/wd/output/${batch}"
 python3 ${script} --batch_dir ${batch_dir}
 
+# for batches with large CT/MR series, stream zips to S3 in 16 MiB parts instead of building them in memory
+python3 ${script} --batch_dir ${batch_dir} --stream --part_size_mb 16
+
+# series are packaged largest-first; cap the bytes of series packaged at once to stay within the VM's memory
+python3 ${script} --batch_dir ${batch_dir} --n_jobs 6 --max_inflight_bytes 24G
+
+# completed series are journaled in ${batch_dir}/packaging_checkpoint.jsonl; rerunning after a crash skips them
+# add --verify_uploaded to HEAD each checkpointed zip and repackage any that are missing
+python3 ${script} --batch_dir ${batch_dir} --verify_uploaded
+
+# zip framing, md5 (and deflate) run under the GIL with threads; on a many-core VM use worker processes,
+# or threads spread over a few processes (compare them with benchmark_packaging_backends.py against moto_server/MinIO)
+python3 ${script} --batch_dir ${batch_dir} --backend process --n_jobs 8
+python3 ${script} --batch_dir ${batch_dir} --backend hybrid --n_jobs 16 --processes 4
+
+# pick stored/deflate per series from its transfer syntax and a deflate sample of its first instances;
+# per-series compression, zip ratio and CPU seconds are appended to ${batch_dir}/packaging_report.tsv
+python3 ${script} --batch_dir ${batch_dir} --compression auto --compresslevel 6
+
 
 # tmux commands:
 tmux list-sessions # this lists all running tmux sessions along w ID number
@@ -60,16 +89,29 @@ ctrl+d # deletes a tmux session
 python3 sequestration_split.py --batch_dir --master_seq_file --exclude_cases --exclude_studies
 
 - This creates the packages indexing manifests in directory "to_index" in the batch directory
+- package_contents is copied as is from packages_manifest.tsv and normalized for batches that
+  only have packages/*.txt files; "--contents validate" checks it first, "--contents normalize"
+  forces normalizing
 
 """
-# upload the script
+# upload the script and its helper modules
 scp /Users/christopher/Documents/Notes/MIDRC/packaging/scripts/sequestration_split.py utilityvm.midrc.csoc:/home/ubuntu/wd/scripts/
+scp /Users/christopher/Documents/Notes/MIDRC/packaging/scripts/packages_manifest.py utilityvm.midrc.csoc:/home/ubuntu/wd/scripts/
+scp /Users/christopher/Documents/Notes/MIDRC/packaging/scripts/guid_index.py utilityvm.midrc.csoc:/home/ubuntu/wd/scripts/
+scp /Users/christopher/Documents/Notes/MIDRC/packaging/scripts/sequestration_store.py utilityvm.midrc.csoc:/home/ubuntu/wd/scripts/
 
 # run the script
 script="/home/ubuntu/wd/scripts/sequestration_split.py"
 batch_dir="/home/ubuntu/wd/output/${batch}"
 master_seq_file="/home/ubuntu/wd/master_sequestration_locations_54536_2022-10-24.tsv"
 python3 ${script} --batch_dir ${batch_dir} --master_seq_file ${master_seq_file}
+# or check the package GUIDs against every GUID minted so far; packages whose GUID belongs to
+# another package are left out and listed in to_index/guid_duplicates_${batch}.tsv
+# python3 ${script} --batch_dir ${batch_dir} --master_seq_file ${master_seq_file} --guid_index /home/ubuntu/wd/package_guids.sqlite
+# or look the cases up in the sequestration store (sequestration_store.py) instead of the master TSV
+# python3 ${script} --batch_dir ${batch_dir} --seq_store /home/ubuntu/wd/sequestration/master_sequestration.sqlite
+# large batches: split and write 1000 packages at a time with flat memory
+# python3 ${script} --batch_dir ${batch_dir} --master_seq_file ${master_seq_file} --stream
 
 # checks
 ll ${batch_dir}/to_index
@@ -127,6 +169,10 @@ batch_dir="/home/ubuntu/wd/output/${batch}"
 python3 ${script} --batch_dir ${batch_dir} --destination open
 python3 ${script} --batch_dir ${batch_dir} --destination seq
 
+# zips already in the destination with the same size/ETag are skipped, so a rerun only copies what is missing;
+# large zips are copied server-side in --part-size MiB parts
+python3 ${script} --batch_dir ${batch_dir} --destination open --workers 32 --part-size 128
+
 
 """
 6) Spot check some downloads using newly indexed packages
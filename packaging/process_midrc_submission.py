@@ -1,14 +1,16 @@
 import argparse
 import csv
-import locale
 import re
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
-locale.setlocale(locale.LC_ALL, "en_US.UTF-8")
+from package_plan import write_package_plan
+from v3 import url_normalization as urls
+from v3.manifest_reader import ENGINES, read_manifest
 
 parser = argparse.ArgumentParser(description="Process a MIDRC batch submission")
 # batch = "RSNA_20220427"
@@ -35,41 +37,151 @@ parser.add_argument(
     required=True,
     help="output path for packages information",
 )
-args = parser.parse_args()
+parser.add_argument(
+    "--n_jobs",
+    action="store",
+    type=int,
+    default=8,
+    help="number of threads writing series manifests",
+)
+parser.add_argument(
+    "--engine",
+    action="store",
+    choices=ENGINES,
+    default="c",
+    help="CSV parser used to read the image manifest",
+)
+parser.add_argument(
+    "--package_plan",
+    action="store_true",
+    help="write a single indexed package_plan.tsv instead of one TSV per series",
+)
+
+
+def split_series(instances):
+    """
+    Groups instances by series in a single groupby pass
+
+    Returns (instances reordered so each series is contiguous, series) where
+    series has one row per series in order of first appearance with its
+    case_id, study_uid, series_uid and the [start, stop) row range of its
+    instances. Every series must belong to exactly one case and one study;
+    this is checked for all series at once.
+    """
+    assert (
+        instances["series_uid"].notna().all()
+    ), "Got {} instances without a series_uid".format(
+        instances["series_uid"].isna().sum()
+    )
+    grouped = instances.groupby("series_uid", sort=False)
+
+    counts = grouped[["case_ids", "study_uid"]].nunique(dropna=False)
+    multiple_cases = counts.index[counts["case_ids"] > 1]
+    assert (
+        len(multiple_cases) == 0
+    ), "Got multiple case_ids '{}' for series '{}' ({} series in total)".format(
+        list(set(grouped.get_group(multiple_cases[0]).case_ids)),
+        multiple_cases[0],
+        len(multiple_cases),
+    )
+    multiple_studies = counts.index[counts["study_uid"] > 1]
+    assert (
+        len(multiple_studies) == 0
+    ), "Got multiple study_uids for series '{}' ({} series in total)".format(
+        multiple_studies[0], len(multiple_studies)
+    )
+
+    # a stable sort on the group number keeps the instance order within each series
+    order = np.argsort(grouped.ngroup().to_numpy(), kind="stable")
+    ordered = instances.iloc[order].reset_index(drop=True)
+    sizes = grouped.size().to_numpy()
+    stop = np.cumsum(sizes)
+    start = stop - sizes
+    series = pd.DataFrame(
+        {
+            "case_id": ordered["case_ids"].to_numpy()[start],
+            "study_uid": ordered["study_uid"].to_numpy()[start],
+            "series_uid": ordered["series_uid"].to_numpy()[start],
+            "start": start,
+            "stop": stop,
+        }
+    )
+    return ordered, series
+
+
+def row_values(instances):
+    """
+    Instance rows as lists of values for csv.writer, with missing values
+    written as empty fields like DataFrame.to_csv does
+    """
+    return instances.astype(object).where(instances.notna(), "").to_numpy().tolist()
+
 
+def write_series_files(packages_path, header, rows, series, n_jobs):
+    """
+    Writes cases/<case>/<study>/<series>.tsv for every series
+
+    All directories are created up front, then the files are written by a
+    thread pool with csv.writer, which is much cheaper than DataFrame.to_csv
+    for the few hundred rows of a typical series.
+    """
+    for case_id, study_uid in set(zip(series.case_id, series.study_uid)):
+        (packages_path / "cases" / case_id / study_uid).mkdir(
+            parents=True, exist_ok=True
+        )
 
-def process_batch(batch, input_path, output_path):
+    def write_series(item):
+        case_id, study_uid, series_uid, start, stop = item
+        series_file = (
+            packages_path / "cases" / case_id / study_uid / f"{series_uid}.tsv"
+        )
+        with open(series_file, "w", newline="") as f:
+            writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+            writer.writerow(header)
+            writer.writerows(rows[start:stop])
+
+    total = len(series)
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for count, _ in enumerate(
+            executor.map(write_series, series.itertuples(index=False, name=None)), 1
+        ):
+            print("Series {}/{}".format(count, total), end="\r")
+
+
+def process_batch(
+    batch, input_path, output_path, n_jobs=8, package_plan=False, engine="c"
+):
     print("Processing batch '{}'".format(batch))
 
     """
         Read manifest and create output directory
     """
     batch_path = Path(input_path) / batch
-    assert (batch_path.is_dir()), "The batch input directory is not found! {}".format(batch_path)
+    assert batch_path.is_dir(), "The batch input directory is not found! {}".format(
+        batch_path
+    )
 
     mani_name = "image_manifest_{}.tsv".format(batch)
-    mani_path = Path("{}/{}".format(input_path,mani_name))
+    mani_path = Path("{}/{}".format(input_path, mani_name))
     if not mani_path.is_file():
         mani = list(batch_path.glob("imag*manifest*.tsv"))
-        assert (len(mani) == 1), "only one manifest should exist in the TSVs directory"
+        assert len(mani) == 1, "only one manifest should exist in the TSVs directory"
         mani_path = Path(mani[0])
-        assert (mani_path.is_file()), "Couldn't find the manifest file! {}".format(mani_path)
+        assert mani_path.is_file(), "Couldn't find the manifest file! {}".format(
+            mani_path
+        )
 
-    instances = pd.read_csv(mani_path, sep="\t")
-    instances.drop(columns={'acl','modality'},inplace=True, errors='ignore')
+    instances = read_manifest(mani_path, engine=engine)
+    instances.drop(columns={"acl", "modality"}, inplace=True, errors="ignore")
 
-    org = batch.split("_",1)[0]
-    if org == "RSNA":
-        instances["storage_urls"] = instances["storage_urls"].apply(
-            lambda v: v.replace("s3://storage.ir.rsna.ai/", "")
-        )
-    elif org == "ACR":
-        instances["storage_urls"] = instances["storage_urls"].apply(
-            lambda v: v.replace("//", "replicated-data-acr/")
+    org = batch.split("_", 1)[0]
+    if org in ("ACR", "RSNA"):
+        instances["storage_urls"] = urls.normalize_storage_urls(
+            instances["storage_urls"], org
         )
 
-    instances["file_name"] = instances["file_name"].apply(lambda v: v.split("/")[-1])
-    instances["instance_uid"] = instances["file_name"].apply(lambda v: v.replace(".dcm",""))
+    instances["file_name"] = urls.basename(instances["file_name"])
+    instances["instance_uid"] = urls.replace(instances["file_name"], ".dcm", "")
 
     """
         Write packages to output directory
@@ -78,36 +190,49 @@ def process_batch(batch, input_path, output_path):
     packages_path = Path(output_path) / batch
     packages_path.mkdir(parents=True, exist_ok=True)
 
-    packages = []
-    series_uids = list(set(instances.series_uid))
-    count,total = 0,len(series_uids)
-    print("Creating package manifests for {} instances in {} series.".format(len(instances),total))
-    for series_uid in series_uids:
-        count+=1
-        print("Series {}/{}".format(count,total), end='\r')
-        sdf = instances.loc[instances['series_uid']==series_uid]
-
-        case_ids = list(set(sdf.case_ids))
-        assert(len(case_ids)==1), "Got multiple case_ids '{}' for series '{}'".format(case_ids,series_uid)
-        case_id = case_ids[0]
-
-        study_uid = list(set(sdf.study_uid))
-        assert(len(study_uid)==1), "Got multiple study_uids for series '{}'".format(series_uid)
-        study_uid = study_uid[0]
-
-#        series_path = f"./cases/{case_id}/{study_uid}/{series_uid}.tsv\n"
-        series_path = "{}/{}/cases/{}/{}/{}.tsv\n".format(output_path,batch,case_id,study_uid,series_uid)
-        if series_path not in packages:
-            packages.append(series_path)
-
-        folder = packages_path / "cases" / case_id / study_uid
-        folder.mkdir(parents=True, exist_ok=True)
+    ordered, series = split_series(instances)
+    print(
+        "Creating package manifests for {} instances in {} series.".format(
+            len(instances), len(series)
+        )
+    )
 
-        series_file = folder / f"{series_uid}.tsv"
-        sdf.to_csv(series_file,sep='\t',index=False)
+    # series are unique, so are their paths
+    packages = [
+        "{}/{}/cases/{}/{}/{}.tsv\n".format(
+            output_path, batch, case_id, study_uid, series_uid
+        )
+        for case_id, study_uid, series_uid in zip(
+            series.case_id, series.study_uid, series.series_uid
+        )
+    ]
+
+    header = list(ordered.columns)
+    rows = row_values(ordered)
+    if package_plan:
+        plan_path = write_package_plan(
+            packages_path,
+            header,
+            (
+                (series_path.strip(), rows[start:stop])
+                for series_path, start, stop in zip(packages, series.start, series.stop)
+            ),
+        )
+        print("Package plan written to: {}".format(plan_path))
+    else:
+        write_series_files(packages_path, header, rows, series, n_jobs)
 
     with open(packages_path / "packages.txt", "w") as f:
         f.writelines(packages)
 
+
 if __name__ == "__main__":
-    process_batch(args.batch, args.input_path, args.output_path)
+    args = parser.parse_args()
+    process_batch(
+        args.batch,
+        args.input_path,
+        args.output_path,
+        args.n_jobs,
+        args.package_plan,
+        args.engine,
+    )
@@ -0,0 +1,119 @@
+"""
+Write-only file object that streams into an S3 multipart upload.
+
+Bytes are buffered up to one part and uploaded as soon as the part is full, so
+memory stays bounded at roughly one part size regardless of the total object
+size. The md5 and size of the whole object are computed as bytes pass through.
+"""
+
+from hashlib import md5
+
+# S3 requires every part except the last to be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+
+
+class S3MultipartWriter:
+    """
+    File-like object uploading everything written to it to s3://bucket/key.
+
+    Usage:
+        with S3MultipartWriter(s3_client, "bucket", "zip/a/b/c.zip") as out:
+            out.write(data)
+        out.md5sum, out.size
+    """
+
+    def __init__(self, client, bucket, key, part_size=DEFAULT_PART_SIZE):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError(
+                "part_size must be at least {} bytes, got {}".format(
+                    MIN_PART_SIZE, part_size
+                )
+            )
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.size = 0
+        self.md5sum = None
+        self.closed = False
+        self._hash = md5()
+        self._buffer = bytearray()
+        self._parts = []
+        self._upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)[
+            "UploadId"
+        ]
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def tell(self):
+        # zipfile relies on tell() to track header offsets on unseekable streams
+        return self.size
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed S3MultipartWriter")
+        data = memoryview(data).cast("B")
+        self._hash.update(data)
+        self.size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        return len(data)
+
+    def _upload_part(self, body):
+        part_number = len(self._parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        """
+        Upload the last (possibly short) part and complete the upload.
+        """
+        if self.closed:
+            return
+        try:
+            if self._buffer or not self._parts:
+                self._upload_part(bytes(self._buffer))
+                self._buffer = bytearray()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+            self.md5sum = self._hash.hexdigest()
+        except Exception:
+            self.abort()
+            raise
+        self.closed = True
+
+    def abort(self):
+        """
+        Abort the multipart upload so no orphaned parts are left in the bucket.
+        """
+        self._buffer = bytearray()
+        self.closed = True
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
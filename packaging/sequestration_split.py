@@ -1,161 +1,399 @@
 #!/usr/bin/env python3
 
+"""
+Split MIDRC packages into open, sequestered, removed and missing
+
+The packages of a batch are loaded into one DataFrame and joined against
+the master sequestration list (case_ids -> dataset), read from the TSV or
+looked up in a sequestration store (sequestration_store.py), and the
+excluded case and study sets; every package is then assigned to one of the outputs by
+boolean masks over the whole batch rather than by a per-package loop.
+
+package_contents is copied to the outputs as written by packaging, which
+writes it in canonical form; --contents validate checks every row first and
+--contents normalize rewrites batches packaged before that. Without
+--contents, batches with a packages_manifest.tsv are passed through and
+legacy batches (packages/*.txt files only, possibly with string sizes) are
+normalized, so their outputs get integer sizes as before.
+
+With --guid_index, the GUIDs of the open and seq packages are checked
+against the index of GUIDs minted so far (guid_index.py); packages whose
+GUID already belongs to another package are left out of the outputs and
+listed in guid_duplicates_<batch>.tsv, the others are added to the index.
+
+With --stream, packages are read and split --chunk_size at a time and each
+chunk is appended to the outputs as soon as it is split, so memory does not
+grow with the batch; progress is printed every --stats_interval seconds.
+With --guid_index as well, a first pass over the batch finds the GUIDs
+minted for more than one package, so that all packages sharing a GUID are
+left out however the chunks fall, as without --stream; this pass keeps one
+GUID and file_name per package in memory.
+"""
 import argparse
 import csv, json
 import os, sys
-import random, uuid, hashlib
+import time
+from itertools import islice
 from pathlib import PosixPath
 import pandas as pd
 
+from guid_index import GuidIndex, check_batch, duplicates_within, mint_guid, mint_guids
+from packages_manifest import (
+    FIELDNAMES,
+    check_package_contents,
+    has_packages_manifest,
+    normalize_package_contents,
+    read_package_rows,
+)
+from sequestration_store import SequestrationStore
+
 csv.field_size_limit(sys.maxsize)
 
-parser = argparse.ArgumentParser(description="Split MIDRC packages into open and sequestered")
-parser.add_argument(
-    "--batch_dir",
-    action="store",
-    type=str,
-    required=True,
-    help="the batch directory containing packages.txt",
-)
-parser.add_argument(
-    "--master_seq_file",
-    action="store",
-    type=str,
-    required=True,
-    help="master TSV file containing sequestration locations for cases",
-)
-parser.add_argument(
-    "--exclude_cases",
-    action="store",
-    type=str,
-    required=False,
-    help="master TSV file containing case_ids column to exclude",
-)
-parser.add_argument(
-    "--exclude_studies",
-    action="store",
-    type=str,
-    required=False,
-    help="master TSV file containing study_uid column to exclude",
-)
+OUTPUTS = ["open", "seq", "remove", "missing"]
+CONTENTS_MODES = ["pass", "validate", "normalize"]
+BUCKETS = {
+    "Open": "s3://open-data-midrc/",
+    "Seq": "s3://sequestered-data-midrc/",
+    "Ignore": "s3://open-data-midrc/",
+}
+# authz of a dataset, per org for the datasets that depend on it
+AUTHZ = {
+    "Open": {"ACR": ["/programs/Open/projects/A1"], "RSNA": ["/programs/Open/projects/R1"]},
+    "Seq": {"ACR": ["/programs/SEQ_Open/projects/A3"], "RSNA": ["/programs/SEQ_Open/projects/R3"]},
+    "Ignore": ["/programs/TCIA"],
+}
+
+
+def read_master(path):
+    """
+    Reads the master sequestration TSV into a dict of case_ids -> dataset
+    """
+    seq_master = pd.read_csv(path, sep="\t", dtype=str, usecols=["case_ids", "dataset"])
+    return dict(zip(seq_master.case_ids, seq_master.dataset))
+
+
+def read_exclusions(path, column):
+    """
+    Reads the set of values of column to exclude; empty without a file
+    """
+    if path is None:
+        return set()
+    return set(pd.read_csv(path, sep="\t", dtype=str, usecols=[column])[column])
+
+
+def authz_for(dataset, org):
+    authz = AUTHZ.get(dataset, "")
+    if isinstance(authz, dict):
+        authz = authz.get(org, "")
+    return json.dumps(authz) if authz else ""
+
+
+def validate_contents(packages):
+    """
+    Raises ValueError naming the packages whose package_contents is not canonical
+    """
+    problems = packages["package_contents"].map(check_package_contents).dropna()
+    if len(problems):
+        examples = dict(zip(packages.loc[problems.index[:5], "file_name"], problems.head(5)))
+        raise ValueError(
+            "{} packages with non-canonical package_contents, e.g. {}; "
+            "rerun with --contents normalize for batches packaged before canonical package_contents".format(
+                len(problems), examples
+            )
+        )
+
+
+def split_packages(packages, seq_master, exclude_studies, exclude_cases, org, contents="pass"):
+    """
+    Assigns the packages of a batch (a DataFrame of package rows) to the
+    open/seq/remove/missing outputs and returns a dict of output -> rows
+
+    Excluded cases and studies are removed whatever their dataset; the other
+    packages go by the dataset of their case in seq_master (a dict or a
+    SequestrationStore), "Open" and
+    "Ignore" to open, "Seq" to seq and anything else, or no entry, to missing.
+
+    contents is one of CONTENTS_MODES: "pass" copies package_contents as is,
+    "validate" first checks that every row is canonical and "normalize"
+    rewrites legacy rows.
+    """
+    assert contents in CONTENTS_MODES, "Unknown contents mode '{}', expected one of {}".format(
+        contents, CONTENTS_MODES
+    )
+    if packages.empty:
+        return {output: packages[FIELDNAMES] for output in OUTPUTS}
+    parts = packages["file_name"].str.split("/", expand=True)
+    assert parts.shape[1] == 3, "file_name is not <case_id>/<study_id>/<series_id>"
+    case_id = parts[0]
+    study_id = parts[1].str.rsplit("_", n=1).str[-1]  # remove any study_id prefix
+
+    packages = packages.copy()
+    if contents == "validate":
+        validate_contents(packages)
+    elif contents == "normalize":
+        packages["package_contents"] = packages["package_contents"].map(normalize_package_contents)
+    if isinstance(seq_master, SequestrationStore):
+        seq_master = seq_master.datasets(case_id.unique().tolist())
+    dataset = case_id.map(seq_master)
+    packages["authz"] = dataset.map({d: authz_for(d, org) for d in dataset.dropna().unique()}).fillna("")
+    packages["url"] = dataset.map(BUCKETS).fillna("") + packages["url"]
+
+    remove = study_id.isin(exclude_studies) | case_id.isin(exclude_cases)
+    packages["guid"] = ""
+    packages.loc[~remove, "guid"] = mint_guids(
+        packages.loc[~remove, "md5"].tolist(), packages.loc[~remove, "size"].tolist()
+    )
+
+    is_open = ~remove & dataset.isin(["Open", "Ignore"])
+    is_seq = ~remove & (dataset == "Seq")
+    masks = {
+        "open": is_open,
+        "seq": is_seq,
+        "remove": remove,
+        "missing": ~remove & ~is_open & ~is_seq,
+    }
+    return {output: packages.loc[mask, FIELDNAMES] for output, mask in masks.items()}
+
+
+def check_guids(splits, index, batch, shared=()):
+    """
+    Checks the GUIDs of the open and seq packages against a GuidIndex and
+    returns (splits without the flagged packages, report of flagged packages);
+    shared are GUIDs of the batch to flag as well, see shared_guids
+    """
+    flagged, report = check_batch(index, pd.concat([splits["open"], splits["seq"]]), batch, shared)
+    n_open = len(splits["open"])
+    splits = dict(splits, open=splits["open"][~flagged[:n_open]], seq=splits["seq"][~flagged[n_open:]])
+    return splits, report
+
+
+def shared_guids(batch_dir, seq_master, exclude_studies, exclude_cases, org):
+    """
+    GUIDs minted for more than one open or seq package of the batch
+
+    With --stream, check_batch only sees one chunk at a time; flagging these
+    GUIDs in every chunk leaves out all the packages sharing a GUID, as
+    without --stream. A first pass over the rows keeps one file_name per
+    GUID; only the rows of GUIDs seen with another file_name are read again
+    and split, to tell open and seq packages from the others.
+    """
+    first, candidates = {}, set()
+    for row in read_package_rows(batch_dir):
+        guid = mint_guid(row["md5"], row["size"])
+        if first.setdefault(guid, row["file_name"]) != row["file_name"]:
+            candidates.add(guid)
+    del first
+    if not candidates:
+        return set()
+
+    rows = [row for row in read_package_rows(batch_dir) if mint_guid(row["md5"], row["size"]) in candidates]
+    packages = pd.DataFrame.from_records(rows, columns=FIELDNAMES)
+    splits = split_packages(packages, seq_master, exclude_studies, exclude_cases, org)
+    indexed = pd.concat([splits["open"], splits["seq"]])
+    within = duplicates_within(indexed["guid"].tolist(), indexed["file_name"].tolist())
+    return set(indexed.loc[within, "guid"])
+
+
+def iter_chunks(rows, chunk_size):
+    """
+    Groups package rows into DataFrames of at most chunk_size rows
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield pd.DataFrame.from_records(chunk, columns=FIELDNAMES)
+
+
+class SplitWriter:
+    """
+    Writes the outputs of a batch as its packages are split
+
+    All outputs are opened up front and rows are appended as they come;
+    outputs that got no rows are removed on close, so only non-empty
+    packages_<output>_<batch>.tsv files are left, as before.
+    """
+
+    def __init__(self, to_index_path, batch):
+        to_index_path.mkdir(parents=True, exist_ok=True)
+        self.to_index_path = to_index_path
+        self.batch = batch
+        self.counts = {output: 0 for output in OUTPUTS}
+        self.duplicates = 0
+        self._files, self._writers = {}, {}
+        for output in OUTPUTS:
+            f = open(self.path(output), "w")
+            self._files[output] = f
+            self._writers[output] = csv.writer(f, delimiter="\t")
+            self._writers[output].writerow(FIELDNAMES)
+        self._duplicates_file = None
+        # left over from an earlier run of the batch
+        if os.path.isfile(self.duplicates_path()):
+            os.remove(self.duplicates_path())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def path(self, output):
+        return self.to_index_path / "packages_{}_{}.tsv".format(output, self.batch)
+
+    def duplicates_path(self):
+        return self.to_index_path / "guid_duplicates_{}.tsv".format(self.batch)
+
+    def write(self, splits):
+        for output in OUTPUTS:
+            self._writers[output].writerows(splits[output].itertuples(index=False))
+            self.counts[output] += len(splits[output])
+
+    def write_duplicates(self, report):
+        if report.empty:
+            return
+        if self._duplicates_file is None:
+            self._duplicates_file = open(self.duplicates_path(), "w")
+            self._duplicates_writer = csv.writer(self._duplicates_file, delimiter="\t")
+            self._duplicates_writer.writerow(report.columns)
+        self._duplicates_writer.writerows(report.itertuples(index=False))
+        self.duplicates += len(report)
+
+    def stats(self):
+        return "Open: {}, Seq: {}, Remove: {}, Missing: {}".format(*(self.counts[output] for output in OUTPUTS))
+
+    def close(self):
+        for output, f in self._files.items():
+            f.close()
+            if not self.counts[output]:
+                os.remove(self.path(output))
+        if self._duplicates_file is not None:
+            self._duplicates_file.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split MIDRC packages into open and sequestered")
+    parser.add_argument(
+        "--batch_dir",
+        action="store",
+        type=str,
+        required=True,
+        help="the batch directory containing packages.txt",
+    )
+    master = parser.add_mutually_exclusive_group(required=True)
+    master.add_argument(
+        "--master_seq_file",
+        action="store",
+        type=str,
+        help="master TSV file containing sequestration locations for cases",
+    )
+    master.add_argument(
+        "--seq_store",
+        action="store",
+        type=str,
+        help="sequestration store (sequestration_store.py) to look the cases up in instead",
+    )
+    parser.add_argument(
+        "--exclude_cases",
+        action="store",
+        type=str,
+        required=False,
+        help="master TSV file containing case_ids column to exclude",
+    )
+    parser.add_argument(
+        "--exclude_studies",
+        action="store",
+        type=str,
+        required=False,
+        help="master TSV file containing study_uid column to exclude",
+    )
+    parser.add_argument(
+        "--contents",
+        action="store",
+        choices=CONTENTS_MODES,
+        help="copy package_contents as is, validate it first, or normalize batches packaged with string sizes; "
+        "by default pass for batches with a packages manifest and normalize for legacy packages/*.txt batches",
+    )
+    parser.add_argument(
+        "--guid_index",
+        action="store",
+        type=str,
+        required=False,
+        help="SQLite index of minted GUIDs to check this batch against and add it to",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="split the packages --chunk_size at a time, writing the outputs as they go, so memory stays flat",
+    )
+    parser.add_argument(
+        "--chunk_size",
+        action="store",
+        type=int,
+        default=1000,
+        help="packages split at a time with --stream",
+    )
+    parser.add_argument(
+        "--stats_interval",
+        action="store",
+        type=float,
+        default=30,
+        help="seconds between progress lines",
+    )
+
+    args = parser.parse_args()
+    batch = args.batch_dir.split('/')[-1]
+    batch_dir = PosixPath(args.batch_dir)
+    org = batch.split("_",1)[0] #org = batch.split("_",1)[0]
+
+    if args.seq_store is not None:
+        seq_master = SequestrationStore(args.seq_store, readonly=True)
+    else:
+        seq_master = read_master(args.master_seq_file)
+    exclude_studies = read_exclusions(args.exclude_studies, "study_uid")
+    exclude_cases = read_exclusions(args.exclude_cases, "case_ids")
+    index = GuidIndex(args.guid_index) if args.guid_index is not None else None
+    contents = args.contents
+    if contents is None:
+        contents = "pass" if has_packages_manifest(batch_dir) else "normalize"
+        if contents == "normalize":
+            print("No packages manifest in {}, normalizing the package_contents of packages/*.txt".format(batch_dir))
+
+    shared = ()
+    if index is not None and args.stream:
+        shared = shared_guids(batch_dir, seq_master, exclude_studies, exclude_cases, org)
+
+    # one pass over packages_manifest.tsv (or the legacy packages/*.txt files)
+    rows = read_package_rows(batch_dir)
+    if args.stream:
+        chunks = iter_chunks(rows, args.chunk_size)
+    else:
+        chunks = [pd.DataFrame.from_records(list(rows), columns=FIELDNAMES)]
+
+    to_index_path = batch_dir / "to_index"
+    count = 0
+    start_time = last_stats = time.time()
+    with SplitWriter(to_index_path, batch) as writer:
+        for packages in chunks:
+            splits = split_packages(packages, seq_master, exclude_studies, exclude_cases, org, contents)
+            if index is not None:
+                splits, duplicates = check_guids(splits, index, batch, shared)
+                writer.write_duplicates(duplicates)
+            writer.write(splits)
+            count += len(packages)
+            if time.time() - last_stats >= args.stats_interval:
+                last_stats = time.time()
+                print("{}; {} ({:.0f} packages/s)".format(count, writer.stats(), count / (last_stats - start_time)))
+    if index is not None:
+        index.close()
+    if args.seq_store is not None:
+        seq_master.close()
 
-args = parser.parse_args()
-batch = args.batch_dir.split('/')[-1]
-batch_dir = PosixPath(args.batch_dir)
-org = batch.split("_",1)[0] #org = batch.split("_",1)[0]
-
-# read in master sequestration list
-seq_master = {}
-with open(args.master_seq_file) as sequestration_master_file:
-    reader = csv.DictReader(sequestration_master_file, delimiter="\t")
-    for row in reader:
-        seq_master[row["case_ids"]] = row["dataset"]
-
-# get list of study_uids to exclude:
-if args.exclude_studies is not None:
-    df = pd.read_csv(args.exclude_studies,sep='\t',dtype=str)
-    exclude_studies = list(set(df.study_uid))
-else:
-    exclude_studies = []
-
-# get list of case_ids to exclude:
-if args.exclude_cases is not None:
-    df = pd.read_csv(args.exclude_cases,sep='\t',dtype=str)
-    exclude_cases = list(set(df.case_ids))
-else:
-    exclude_cases = []
-
-package_dir = batch_dir / "packages"
-assert(package_dir.is_dir()), "Packages dir does not exist: {}".format(package_dir)
-
-open_packages,seq_packages,remove_packages,missing_packages = [],[],[],[]
-
-packages = list(package_dir.glob('*.txt'))
-count,total = 0,len(packages)
-
-for package_filepath in package_dir.iterdir():
-    count+=1
-    with open(package_filepath) as package_file:
-        reader = csv.DictReader(package_file, delimiter="\t")
-        for row in reader:
-            item = row
-            file_name = item["file_name"]
-            case_id, study_id, _ = file_name.split("/")
-            study_id = study_id.split("_")[-1] # remove any study_id prefix
-            package_contents = json.loads(item["package_contents"].replace("'", "\""))
-            for p in package_contents:
-                p["size"] = int(p["size"])
-            item["package_contents"] = json.dumps(package_contents)
-            dataset = seq_master.get(case_id, None)
-            if dataset == "Open":
-                bucket = "s3://open-data-midrc/"
-                if org == "ACR":
-                    authz = json.dumps(["/programs/Open/projects/A1"])
-                if org == "RSNA":
-                    authz = json.dumps(["/programs/Open/projects/R1"])
-            elif dataset == "Seq":
-                bucket = "s3://sequestered-data-midrc/"
-                if org == "ACR":
-                    authz = json.dumps(["/programs/SEQ_Open/projects/A3"])
-                if org == "RSNA":
-                    authz = json.dumps(["/programs/SEQ_Open/projects/R3"])
-            elif dataset == "Ignore":
-                bucket = "s3://open-data-midrc/"
-                authz = json.dumps(["/programs/TCIA"])
-            else:
-                authz = ""
-                bucket = ""
-            item["authz"] = authz
-            item["url"] = f"{bucket}{item['url']}"
-            if study_id in exclude_studies:
-                remove_packages.append(item)
-                continue
-            if case_id in exclude_cases:
-                remove_packages.append(item)
-                continue
-            m = hashlib.md5()
-            m.update(f"{item['md5']}{item['size']}".encode('utf-8'))
-            item["guid"] = f"dg.MD1R/{uuid.UUID(m.hexdigest(), version=4)}"
-            if (dataset == "Open") | (dataset == "Ignore"):
-                open_packages.append(item)
-            elif dataset == "Seq":
-                seq_packages.append(item)
-            else:
-                print('\n')
-                missing_packages.append(item)
-
-    print("{}/{}; Open: {}, Seq: {}, Remove: {}, Missing: {}; Processing case_id '{}': {}           ".format(count, total, len(open_packages), len(seq_packages), len(remove_packages), len(missing_packages), case_id, dataset), end='\r')
-
-datasets = []
-if len(open_packages) > 0:
-    datasets.append(("packages_open_{}.tsv".format(batch), open_packages))
-if len(seq_packages) > 0:
-    datasets.append(("packages_seq_{}.tsv".format(batch), seq_packages))
-if len(remove_packages) > 0:
-    datasets.append(("packages_remove_{}.tsv".format(batch), remove_packages))
-if len(missing_packages) > 0:
-    datasets.append(("packages_missing_{}.tsv".format(batch), missing_packages))
-
-fieldnames = [
-    "record_type",
-    "guid",
-    "md5",
-    "size",
-    "authz",
-    "url",
-    "file_name",
-    "package_contents"]
-
-to_index_path = batch_dir / "to_index"
-to_index_path.mkdir(parents=True, exist_ok=True)
-
-for filename, dataset in datasets:
-    if not dataset:
-        continue
-    with open(to_index_path / filename, "w") as f:
-        writer = csv.DictWriter(f, delimiter="\t", fieldnames=fieldnames)
-        writer.writeheader()
-        for item in dataset:
-            writer.writerow(item)
-
-print("\nOutput written to: {}".format(to_index_path))
+    print("{}; {}".format(count, writer.stats()))
+    if writer.duplicates:
+        print(
+            "{} packages left out, their GUID belongs to another package: {}".format(
+                writer.duplicates, writer.duplicates_path()
+            )
+        )
+    print("Output written to: {}".format(to_index_path))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+"""
+Master sequestration store: case_ids -> dataset, in an indexed SQLite file
+
+Replaces re-reading and re-writing master_sequestration_locations_<N>_<date>.tsv
+for every COMPLETED sequestration file. COMPLETED files are merged into the
+store incrementally, each file once; like the master list, a case keeps the
+dataset it was first given. sequestration_split.py --seq_store looks cases up
+in the store instead of loading the whole list:
+
+    python3 sequestration_store.py --store seq.sqlite import master_sequestration_locations_54536_2022-10-24.tsv
+    python3 sequestration_store.py --store seq.sqlite merge COMPLETED_sequestration_data_*_*.tsv
+    python3 sequestration_store.py --store seq.sqlite lookup 10003-1234 10003-1235
+    python3 sequestration_store.py --store seq.sqlite export --output_dir /home/ubuntu/wd
+"""
+import argparse
+import json
+import os
+import sqlite3
+import time
+from datetime import date
+
+import pandas as pd
+
+# case_ids per lookup query
+CHUNK_SIZE = 100000
+# pages of the store mapped into memory by readers
+MMAP_SIZE = 1024**3
+
+
+class SequestrationStore:
+    """
+    SQLite table of cases (case_ids, dataset, project_id, source) keyed by
+    case_ids, plus the COMPLETED files merged so far
+    """
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        if readonly:
+            assert os.path.isfile(path), "No sequestration store at {}".format(path)
+            self._db = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+            self._db.execute("PRAGMA mmap_size={}".format(MMAP_SIZE))
+            return
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cases (case_ids TEXT PRIMARY KEY, dataset TEXT, project_id TEXT, source TEXT)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS merged_files (name TEXT PRIMARY KEY, cases INTEGER, merged_at REAL)"
+        )
+        self._db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM cases").fetchone()[0]
+
+    def __contains__(self, case_id):
+        return self.get(case_id) is not None
+
+    def get(self, case_id):
+        """
+        The dataset of a case, None if the case is not in the store
+        """
+        row = self._db.execute(
+            "SELECT dataset FROM cases WHERE case_ids = ?", (case_id,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def datasets(self, case_ids):
+        """
+        Returns a dict of case_ids -> dataset for those case_ids in the store
+        """
+        case_ids = sorted(set(case_ids))
+        found = {}
+        for start in range(0, len(case_ids), CHUNK_SIZE):
+            found.update(
+                self._db.execute(
+                    "SELECT case_ids, dataset FROM cases WHERE case_ids IN (SELECT value FROM json_each(?))",
+                    (json.dumps(case_ids[start : start + CHUNK_SIZE]),),
+                )
+            )
+        return found
+
+    def add(self, cases, source):
+        """
+        Adds the cases (a DataFrame with case_ids, dataset and optionally
+        project_id) not in the store yet; returns how many were added
+        """
+        project_ids = (
+            cases["project_id"].tolist()
+            if "project_id" in cases
+            else [None] * len(cases)
+        )
+        before = len(self)
+        with self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO cases VALUES (?, ?, ?, ?)",
+                (
+                    (case_id, dataset, project_id, source)
+                    for case_id, dataset, project_id in zip(
+                        cases["case_ids"].tolist(),
+                        cases["dataset"].tolist(),
+                        project_ids,
+                    )
+                ),
+            )
+        return len(self) - before
+
+    def merged(self, name):
+        return (
+            self._db.execute(
+                "SELECT 1 FROM merged_files WHERE name = ?", (name,)
+            ).fetchone()
+            is not None
+        )
+
+    def merge_completed(self, path):
+        """
+        Merges a COMPLETED_sequestration_data_<org>_<date>.tsv; returns the
+        number of new cases, or None if the file was merged before
+        """
+        name = os.path.basename(path)
+        if self.merged(name):
+            return None
+        completed = pd.read_csv(path, sep="\t", dtype=str)
+        completed["case_ids"] = completed["submitter_id"]
+        added = self.add(completed.dropna(subset=["case_ids"]), name)
+        with self._db:
+            self._db.execute(
+                "INSERT INTO merged_files VALUES (?, ?, ?)", (name, added, time.time())
+            )
+        return added
+
+    def to_frame(self):
+        """
+        The store as a master sequestration list, in the order cases were added
+        """
+        return pd.read_sql_query(
+            "SELECT case_ids, dataset, project_id FROM cases ORDER BY rowid", self._db
+        )
+
+
+def master_list_name(n_cases, day=None):
+    """
+    master_sequestration_locations_<number of cases>_<date>.tsv
+    """
+    day = day or date.today()
+    return "master_sequestration_locations_{}_{}.tsv".format(
+        n_cases, day.strftime("%Y-%m-%d")
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Maintain the master sequestration store"
+    )
+    parser.add_argument(
+        "--store",
+        action="store",
+        type=str,
+        required=True,
+        help="SQLite sequestration store file",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser(
+        "import", help="add the cases of master sequestration list TSVs"
+    )
+    import_parser.add_argument("master_seq_files", nargs="+")
+    merge_parser = commands.add_parser(
+        "merge", help="merge COMPLETED sequestration files not merged yet"
+    )
+    merge_parser.add_argument("completed_files", nargs="+")
+    lookup_parser = commands.add_parser("lookup", help="print the dataset of cases")
+    lookup_parser.add_argument("case_ids", nargs="+")
+    export_parser = commands.add_parser(
+        "export",
+        help="write the store as master_sequestration_locations_<N>_<date>.tsv",
+    )
+    export_parser.add_argument("--output_dir", action="store", type=str, default=".")
+    args = parser.parse_args()
+
+    with SequestrationStore(args.store, readonly=args.command == "lookup") as store:
+        if args.command == "import":
+            for path in args.master_seq_files:
+                master = pd.read_csv(path, sep="\t", dtype=str)
+                added = store.add(
+                    master.dropna(subset=["case_ids"]), os.path.basename(path)
+                )
+                print("{}: {} new case_ids".format(path, added))
+        elif args.command == "merge":
+            for path in args.completed_files:
+                added = store.merge_completed(path)
+                if added is None:
+                    print("{}: already merged, skipped".format(path))
+                else:
+                    print("There are {} new case_ids from {}".format(added, path))
+        elif args.command == "lookup":
+            datasets = store.datasets(args.case_ids)
+            for case_id in args.case_ids:
+                print("{}\t{}".format(case_id, datasets.get(case_id, "")))
+        elif args.command == "export":
+            master = store.to_frame()
+            path = os.path.join(args.output_dir, master_list_name(len(master)))
+            master.to_csv(path, sep="\t", index=False)
+            print("Output written to: {}".format(path))
+        if args.command in ("import", "merge"):
+            print("The store holds {} case_ids".format(len(store)))
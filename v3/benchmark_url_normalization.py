@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+"""
+Checks v3/url_normalization.py against the Series.apply lambdas it replaced
+and benchmarks both on synthetic submission columns
+
+Every rule must give the same values as its lambda; the script stops with
+an AssertionError naming the rule if one does not.
+
+    python3 -m v3.benchmark_url_normalization
+    python3 -m v3.benchmark_url_normalization --rows 5000000
+"""
+import argparse
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from v3 import url_normalization as urls
+
+parser = argparse.ArgumentParser(description="Check and benchmark URL normalization")
+parser.add_argument("--rows", action="store", type=int, default=1000000)
+args = parser.parse_args()
+
+ID_REGEX = re.compile(r"([\d\.]+)$")
+
+
+def synthetic_columns(n, seed=0):
+    rng = np.random.default_rng(seed)
+    series = rng.integers(0, max(1, n // 100), n)
+    uid = pd.Series(series).map("1.2.826.0.1.3680043.{}".format)
+    instance = pd.Series(np.arange(n)).map("1.2.826.0.1.3680043.9.{}".format)
+    return {
+        "acr_urls": "//ACR_20220606/case_"
+        + uid
+        + "/1.2/"
+        + uid
+        + "/"
+        + instance
+        + ".dcm",
+        "rsna_urls": "s3://storage.ir.rsna.ai/RSNA_20220524/"
+        + uid
+        + "/"
+        + instance
+        + ".dcm",
+        "tcia_urls": "['s3://{}/TCIA/".format(urls.TCIA_UPLOAD_BUCKET)
+        + instance
+        + ".dcm']",
+        "file_names": "case/" + uid + "/" + instance + ".dcm",
+        "prefixed_ids": "Case_" + uid,
+        "series_ids": "Series_" + uid,
+    }
+
+
+def tcia_lambda(v):
+    v = v.replace("[", "").replace("]", "").replace("'", "")
+    return v.replace("s3://{}/".format(urls.TCIA_UPLOAD_BUCKET), "")
+
+
+# (rule, column, lambda-based implementation, vectorized implementation)
+RULES = [
+    (
+        "ACR storage_urls",
+        "acr_urls",
+        lambda s: s.apply(lambda v: v.replace("//", "replicated-data-acr/")),
+        lambda s: urls.normalize_storage_urls(s, "ACR"),
+    ),
+    (
+        "RSNA storage_urls",
+        "rsna_urls",
+        lambda s: s.apply(lambda v: v.replace("s3://storage.ir.rsna.ai/", "")),
+        lambda s: urls.normalize_storage_urls(s, "RSNA"),
+    ),
+    (
+        "TCIA storage_urls",
+        "tcia_urls",
+        lambda s: s.apply(tcia_lambda),
+        lambda s: urls.normalize_storage_urls(s, "TCIA"),
+    ),
+    (
+        "file_name basename",
+        "file_names",
+        lambda s: s.apply(lambda v: v.split("/")[-1]),
+        urls.basename,
+    ),
+    (
+        "instance_uid from file_name",
+        "file_names",
+        lambda s: s.apply(lambda v: v.split("/")[-1]).apply(
+            lambda v: v.replace(".dcm", "")
+        ),
+        lambda s: urls.replace(urls.basename(s), ".dcm", ""),
+    ),
+    (
+        "URL components 0,1,3,5",
+        "acr_urls",
+        lambda s: s.apply(lambda v: "/".join(v.split("/")[i] for i in [0, 1, 3, 5])),
+        lambda s: urls.join_path_components(s, [0, 1, 3, 5]),
+    ),
+    (
+        "URL component 5",
+        "acr_urls",
+        lambda s: s.str.split("/").apply(lambda v: v[5]),
+        lambda s: urls.path_component(s, 5),
+    ),
+    (
+        "ID token after '_'",
+        "series_ids",
+        lambda s: s.str.split("_").apply(lambda v: v[1]),
+        lambda s: urls.path_component(s, 1, sep="_"),
+    ),
+    (
+        "remove 'Case_' prefix",
+        "prefixed_ids",
+        lambda s: s.apply(lambda v: v[v.startswith("Case_") and len("Case_") :]),
+        lambda s: urls.remove_prefix(s, "Case_"),
+    ),
+    (
+        "trailing UID",
+        "series_ids",
+        lambda s: s.apply(lambda v: ID_REGEX.search(v).group(0)),
+        urls.trailing_uid,
+    ),
+    (
+        "file_name from instance_id",
+        "prefixed_ids",
+        lambda s: s.apply(lambda v: f"{v}.dcm"),
+        lambda s: urls.add_suffix(s, ".dcm"),
+    ),
+]
+
+
+if __name__ == "__main__":
+    columns = synthetic_columns(args.rows)
+    print(
+        "{:<30} {:>12} {:>14} {:>9}".format(
+            "rule", "lambda (s)", "vectorized (s)", "speedup"
+        )
+    )
+    for rule, column, with_lambda, vectorized in RULES:
+        values = columns[column].astype("string")
+
+        start_time = time.time()
+        expected = with_lambda(values)
+        lambda_seconds = time.time() - start_time
+
+        start_time = time.time()
+        result = vectorized(values)
+        vectorized_seconds = max(time.time() - start_time, 1e-9)
+
+        assert result.astype(object).equals(
+            expected.astype(object)
+        ), "{} differs from its lambda".format(rule)
+        print(
+            "{:<30} {:>12.2f} {:>14.2f} {:>8.1f}x".format(
+                rule,
+                lambda_seconds,
+                vectorized_seconds,
+                lambda_seconds / vectorized_seconds,
+            )
+        )
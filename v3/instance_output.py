@@ -0,0 +1,64 @@
+"""
+Writing and reading the per-submission instance table
+
+The processors write instance_<submission>.csv and, with
+--output_format parquet (or both), instance_<submission>.parquet: zstd
+compressed, sorted by case_id and series_id, with per row group min/max
+statistics. Since the rows of a case or series are contiguous, readers
+filtering on those columns only decode the row groups that can match:
+
+    instances = read_instances(path, case_ids=["10003-1234"])
+"""
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+OUTPUT_FORMATS = ["csv", "parquet", "both"]
+SORT_COLUMNS = ["case_id", "series_id"]
+# small enough that one case spans few row groups, large enough to compress well
+ROW_GROUP_SIZE = 64 * 1024
+
+
+def write_instances(instances, output_path, submission, output_format="csv"):
+    """
+    Writes instance_<submission>.csv and/or .parquet to output_path and
+    returns the paths written
+    """
+    assert (
+        output_format in OUTPUT_FORMATS
+    ), "Unknown output format '{}', expected one of {}".format(
+        output_format, OUTPUT_FORMATS
+    )
+    paths = []
+    if output_format in ("csv", "both"):
+        path = f"{output_path}/instance_{submission}.csv"
+        instances.to_csv(path, index=False)
+        paths.append(path)
+    if output_format in ("parquet", "both"):
+        path = f"{output_path}/instance_{submission}.parquet"
+        table = pa.Table.from_pandas(
+            instances.sort_values(SORT_COLUMNS, kind="stable"), preserve_index=False
+        )
+        pq.write_table(
+            table,
+            path,
+            compression="zstd",
+            row_group_size=ROW_GROUP_SIZE,
+            write_statistics=True,
+        )
+        paths.append(path)
+    return paths
+
+
+def read_instances(path, case_ids=None, series_ids=None, columns=None):
+    """
+    Reads an instance_<submission>.parquet into a DataFrame, optionally only
+    some columns and only the rows of some cases and/or series
+    """
+    filters = []
+    if case_ids is not None:
+        filters.append(("case_id", "in", list(case_ids)))
+    if series_ids is not None:
+        filters.append(("series_id", "in", list(series_ids)))
+    table = pq.read_table(path, columns=columns, filters=filters or None)
+    return table.to_pandas()
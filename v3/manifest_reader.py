@@ -0,0 +1,152 @@
+"""
+Image manifest loading with a pinned schema
+
+Submission manifests are read with explicit dtypes instead of pandas type
+inference: DICOM UIDs and other identifiers stay strings (inference turns
+UIDs such as '1.2.840' into floats and mixed columns into object dtype),
+acl and modality are categoricals and file_size is int64. Any column not in
+MANIFEST_DTYPES is read as a string. Old ACR manifests mark required columns
+with a leading '*' ('*file_size'); those get the schema of the bare name.
+
+    instances = read_manifest(path)
+    instances = read_manifest(path, engine="pyarrow")
+    for chunk in read_manifest(path, chunksize=500000):
+        ...
+"""
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+
+MANIFEST_DTYPES = {
+    "file_name": "string",
+    "file_size": "int64",
+    "md5sum": "string",
+    "acl": "category",
+    "modality": "category",
+    "storage_urls": "string",
+    "case_ids": "string",
+    "study_uid": "string",
+    "series_uid": "string",
+    "instance_uid": "string",
+}
+ENGINES = ["c", "pyarrow"]
+
+
+def parse_size(text):
+    """
+    Parses one file size such as '1,234,567', like locale.atoi under en_US
+    but without needing that locale installed
+    """
+    return int(text.replace(",", "").strip())
+
+
+def parse_file_size(sizes):
+    """
+    Converts file sizes read as strings, possibly with thousands separators
+    ('1,234,567'), to int64; nullable Int64 if some sizes are missing
+
+    Raises ValueError naming the rows whose size is not a whole number.
+    """
+    cleaned = pc.utf8_trim_whitespace(
+        pc.replace_substring(
+            pa.array(sizes, type=pa.string(), from_pandas=True),
+            pattern=",",
+            replacement="",
+        )
+    )
+    cleaned = pc.if_else(pc.equal(cleaned, ""), pa.scalar(None, pa.string()), cleaned)
+    invalid = pc.invert(pc.match_substring_regex(cleaned, pattern=r"^[+-]?\d+$"))
+    invalid = pc.fill_null(invalid, False).to_numpy(zero_copy_only=False)
+    if invalid.any():
+        examples = sizes[invalid].head(5)
+        raise ValueError(
+            "{} invalid file_size values in column '{}', e.g. (row: value) {}".format(
+                int(invalid.sum()), sizes.name, dict(zip(examples.index, examples))
+            )
+        )
+
+    numbers = pc.cast(cleaned, pa.int64())
+    if numbers.null_count:
+        values = pc.fill_null(numbers, 0).to_numpy()
+        missing = numbers.is_null().to_numpy(zero_copy_only=False)
+        return pd.Series(
+            pd.arrays.IntegerArray(values, missing), index=sizes.index, name=sizes.name
+        )
+    return pd.Series(numbers.to_numpy(), index=sizes.index, name=sizes.name)
+
+
+def apply_schema(df):
+    """
+    Casts the columns of a manifest read as strings to MANIFEST_DTYPES
+    """
+    for column in df.columns:
+        dtype = MANIFEST_DTYPES.get(column.lstrip("*"), "string")
+        if dtype == "int64":
+            df[column] = parse_file_size(df[column])
+        elif df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def _pyarrow_options(path, sep, usecols):
+    """
+    pyarrow.csv options reading every column as a string; pandas' pyarrow
+    engine would infer types first and turn a UID like '1.20' into '1.2'
+    """
+    columns = usecols or pd.read_csv(path, sep=sep, nrows=0).columns
+    return dict(
+        read_options=pv.ReadOptions(block_size=64 * 1024 * 1024),
+        parse_options=pv.ParseOptions(delimiter=sep),
+        convert_options=pv.ConvertOptions(
+            column_types={column: pa.string() for column in columns},
+            include_columns=list(columns),
+            strings_can_be_null=True,
+        ),
+    )
+
+
+def _iter_pyarrow(path, sep, usecols, chunksize):
+    reader = pv.open_csv(path, **_pyarrow_options(path, sep, usecols))
+    # pyarrow reads blocks by bytes; regroup them into chunks of chunksize rows
+    pending, pending_rows = [], 0
+    for batch in reader:
+        pending.append(batch)
+        pending_rows += batch.num_rows
+        if pending_rows >= chunksize:
+            table = pa.Table.from_batches(pending)
+            for start in range(0, table.num_rows - chunksize + 1, chunksize):
+                yield apply_schema(table.slice(start, chunksize).to_pandas())
+            rest = table.num_rows % chunksize
+            pending = table.slice(table.num_rows - rest).to_batches() if rest else []
+            pending_rows = rest
+    if pending_rows:
+        yield apply_schema(pa.Table.from_batches(pending).to_pandas())
+
+
+def read_manifest(path, usecols=None, engine="c", chunksize=None, sep="\t"):
+    """
+    Reads a manifest TSV into a DataFrame with the manifest schema
+
+    engine is "c" or "pyarrow" (multi-threaded parsing). With chunksize, an
+    iterator of DataFrames of at most chunksize rows is returned instead, so
+    a multi-GB manifest can be processed with bounded memory. Categories are
+    per chunk, so concatenated chunks may fall back to object dtype.
+    """
+    assert engine in ENGINES, "Unknown engine '{}', expected one of {}".format(
+        engine, ENGINES
+    )
+    if chunksize is not None:
+        if engine == "pyarrow":
+            return _iter_pyarrow(path, sep, usecols, chunksize)
+        reader = pd.read_csv(
+            path, sep=sep, usecols=usecols, dtype="string", chunksize=chunksize
+        )
+        return (apply_schema(chunk) for chunk in reader)
+
+    if engine == "pyarrow":
+        return apply_schema(
+            pv.read_csv(path, **_pyarrow_options(path, sep, usecols)).to_pandas()
+        )
+    return apply_schema(pd.read_csv(path, sep=sep, usecols=usecols, dtype="string"))
@@ -5,24 +5,28 @@ Packaging script
 import argparse
 import csv
 import json
+import multiprocessing
+import time
 import zipfile
 import os
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from hashlib import md5
 from io import BytesIO
+from itertools import islice
 
 
 import boto3
-from pqdm.threads import pqdm
+from botocore.config import Config
+from tqdm import tqdm
 
-s3 = boto3.resource("s3")
+from v3.manifest_reader import parse_size
+
+N_JOBS = 6  # series packaged concurrently
 
 SRC_BUCKET = "external-data-midrc-replication"
 DST_BUCKET = "internal-data-midrc-replication"
 
-src_bucket = s3.Bucket(SRC_BUCKET)
-dst_bucket = s3.Bucket(DST_BUCKET)
-
 series = defaultdict(list)
 
 # s3://external-data-midrc-replication/replicated-data-acr/ACR_20211115/clinical_manifestfile_ACR_20211115.tsv
@@ -35,46 +39,86 @@ parser.add_argument(
     required=True,
     help="Directory for Series files",
 )
+parser.add_argument(
+    "--prefetch",
+    action="store",
+    type=int,
+    default=8,
+    help="number of instances downloaded ahead within each series",
+)
+parser.add_argument(
+    "--backend",
+    action="store",
+    choices=["thread", "process"],
+    default="thread",
+    help="package the series in threads, or in processes so zip and md5 work escape the GIL",
+)
 args = parser.parse_args()
 
+S3_CONFIG = Config(max_pool_connections=max(10, N_JOBS * (args.prefetch + 1)))
+s3 = boto3.resource("s3", config=S3_CONFIG)
+src_bucket = s3.Bucket(SRC_BUCKET)
+dst_bucket = s3.Bucket(DST_BUCKET)
+
 # FOLDER = "/midrc-data/ACR_20220415/output"
 # FOLDER = "./packages_acrimage/2021/09"
 # FOLDER = "./packages_acrimage/2021/0827"
 
 
+def fetch_object(file_url):
+    """
+    Downloads a source object; LastModified comes with the GET, so no extra HEAD is needed
+    """
+    response = s3.meta.client.get_object(Bucket=SRC_BUCKET, Key=file_url)
+    return response["Body"].read(), response["LastModified"]
+
+
+def fetch_objects(files, prefetch):
+    """
+    Yields (filename, body, last_modified) in manifest order while a thread
+    pool downloads up to `prefetch` objects ahead
+    """
+    files = iter(files)
+    executor = ThreadPoolExecutor(max_workers=max(1, prefetch))
+    pending = deque()
+    try:
+        for filename, file_url in islice(files, max(1, prefetch)):
+            pending.append((filename, executor.submit(fetch_object, file_url)))
+        while pending:
+            filename, future = pending.popleft()
+            for next_filename, next_url in islice(files, 1):
+                pending.append((next_filename, executor.submit(fetch_object, next_url)))
+            body, last_modified = future.result()
+            yield filename, body, last_modified
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
 def create_archive(files, series_id):
     """
-    Creates archive for package
+    Creates archive for package and returns (archive, fetched_bytes)
     """
     archive = BytesIO()
+    fetched_bytes = 0
 
     with zipfile.ZipFile(archive, "w") as zip_archive:
-        for filename, file_url in files:
-            file_obj = BytesIO()
-            # obj_path = "/".join(file_url.split("/")[3:])
-            obj_path = file_url
-
-            obj = src_bucket.Object(obj_path)
-            obj.download_fileobj(file_obj)
-
+        for filename, body, last_modified in fetch_objects(files, args.prefetch):
             # filename = file_url.split("/")[-1]
             in_zip_path = "{}/{}".format(series_id, filename)
 
-            last_modified = obj.last_modified
             last_modified = tuple(last_modified.timetuple()[0:6])
 
             zinfo = zipfile.ZipInfo(filename=in_zip_path, date_time=last_modified)
 
-            file_obj.seek(0)
+            zip_archive.writestr(zinfo, body)
+            fetched_bytes += len(body)
 
-            zip_archive.writestr(zinfo, file_obj.getvalue())
-
-    return archive
+    return archive, fetched_bytes
 
 
 def process_package_file(package_file):
     """
-    Process package file
+    Process package file; returns (series_id, package row, files, fetched_bytes)
     """
     line_split = package_file.split("/")
     case_id = line_split[2]
@@ -107,11 +151,11 @@ def process_package_file(package_file):
                 {
                     "hashes": {"md5sum": row["md5sum"]},
                     "file_name": "{}/{}".format(series_id, file_name),
-                    "size": row["file_size"],
+                    "size": parse_size(row["file_size"]),
                 }
             )
 
-    zip_obj = create_archive(files, series_id)
+    zip_obj, fetched_bytes = create_archive(files, series_id)
 
     size = zip_obj.getbuffer().nbytes
 
@@ -125,6 +169,23 @@ def process_package_file(package_file):
     zip_obj.seek(0)
     dst_bucket.Object(zip_url).upload_fileobj(zip_obj)
 
+    row = {
+        "record_type": "package",
+        "guid": "",
+        "md5": md5sum,
+        "size": size,
+        "authz": "",
+        "url": zip_url,
+        "file_name": zip_file_name,
+        "package_contents": json.dumps(files_metadata),
+    }
+    return series_id, row, len(files), fetched_bytes
+
+
+def write_package_result(series_id, row):
+    """
+    Writes packages/<series_id>.txt; only the main process writes these
+    """
     with open(
         args.input_directory + "/packages/{}.txt".format(series_id),
         "w",
@@ -144,18 +205,38 @@ def process_package_file(package_file):
             tsv_result_file, delimiter="\t", fieldnames=fieldnames
         )
         tsv_writer.writeheader()
-        tsv_writer.writerow(
-            {
-                "record_type": "package",
-                "guid": "",
-                "md5": md5sum,
-                "size": size,
-                "authz": "",
-                "url": zip_url,
-                "file_name": zip_file_name,
-                "package_contents": json.dumps(files_metadata),
-            }
+        tsv_writer.writerow(row)
+
+
+def run_packaging(package_files):
+    """
+    Packages the series with N_JOBS workers of args.backend and writes each
+    result as it comes back; returns ([(files, fetched_bytes)], [(package_file, error)])
+    """
+    if args.backend == "process":
+        # spawn rather than fork: boto3 is not fork-safe, and each child
+        # re-imports this script and builds its own resource from S3_CONFIG
+        executor = ProcessPoolExecutor(
+            max_workers=N_JOBS, mp_context=multiprocessing.get_context("spawn")
         )
+    else:
+        executor = ThreadPoolExecutor(max_workers=N_JOBS)
+
+    packaged, failed = [], []
+    with executor:
+        futures = {
+            executor.submit(process_package_file, package_file): package_file
+            for package_file in package_files
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            try:
+                series_id, row, n_files, fetched_bytes = future.result()
+            except Exception as err:
+                failed.append((futures[future], err))
+                continue
+            write_package_result(series_id, row)
+            packaged.append((n_files, fetched_bytes))
+    return packaged, failed
 
 
 def main():
@@ -172,4 +253,18 @@ if __name__ == "__main__":
 
     os.makedirs(args.input_directory + "/packages", exist_ok=True)
 
-    result = pqdm(package_files, process_package_file, n_jobs=6)
+    start_time = time.time()
+    packaged, failed = run_packaging(package_files)
+    elapsed = time.time() - start_time
+
+    if failed:
+        print("{} series failed".format(len(failed)))
+        for package_file, error in failed:
+            print("Packaging failed for {}: {!r}".format(package_file, error))
+    total_files = sum(n_files for n_files, _ in packaged)
+    total_bytes = sum(n_bytes for _, n_bytes in packaged)
+    print(
+        "Total files packaged: {} ({:.1f} files/s, {:.1f} MB/s)".format(
+            total_files, total_files / elapsed, total_bytes / 1e6 / elapsed
+        )
+    )
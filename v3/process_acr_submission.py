@@ -1,14 +1,16 @@
 import argparse
 import csv
-import locale
 from itertools import chain
 from pathlib import Path
 
-import numpy as np
 import pandas as pd
 import os
 import boto3
 
+from v3.instance_output import OUTPUT_FORMATS, write_instances
+from v3.manifest_reader import parse_file_size, read_manifest
+from v3.submission_rules import load_rules, rules_for
+
 # download file
 # s3://external-data-midrc-replication/replicated-data-acr/ACR_20220415/image_file_object_manifest_ACR_20220415.tsv
 #      ^ bucket                        ^ actual path we care (key)
@@ -19,8 +21,6 @@ import boto3
 # python3 process_acr_submission.py --submission ACR_20220415 --input_path /midrc-data --output_path /midrc-data/ACR_20220415/output
 # python3 process_acr_submission.py --submission $SUBMISSION --input_path $INPUT_PATH --output_path $OUTPUT_PATH
 
-locale.setlocale(locale.LC_ALL, "en_US.UTF-8")
-
 parser = argparse.ArgumentParser(description="Process ACR submission")
 parser.add_argument(
     "--submission",
@@ -55,6 +55,19 @@ parser.add_argument(
     type=str,
     help="s3key for manifest",
 )
+parser.add_argument(
+    "--output_format",
+    action="store",
+    choices=OUTPUT_FORMATS,
+    default="csv",
+    help="write instance_<submission> as CSV, as Parquet sorted by case_id/series_id, or both",
+)
+parser.add_argument(
+    "--rules",
+    action="store",
+    type=str,
+    help="JSON file with extra submission rules, see v3/submission_rules.py",
+)
 
 args = parser.parse_args()
 
@@ -69,8 +82,11 @@ def download_manifest(s3key, submission, input_path):
 
 
 # for everything after and including ACR_20220314
-def process_submission_new(submission, input_path, output_path):
+def process_submission_new(
+    submission, input_path, output_path, extra_rules=None, output_format="csv"
+):
     print(submission)
+    rules = rules_for("acr_new", submission, extra_rules)
     packages_path = Path(output_path) / submission
     # packages_path.mkdir(parents=True, exist_ok=True)
 
@@ -85,29 +101,13 @@ def process_submission_new(submission, input_path, output_path):
 
     image_manifest_file = image_manifest_file[0]
 
-    rename_columns = {
-        "case_ids": "case_id",
-        "study_uid": "study_id",
-        "series_uid": "series_id",
-        "instance_uid": "instance_id",
-    }
-
-    instances = pd.read_csv(image_manifest_file, sep="\t").rename(
-        columns=rename_columns
+    instances = read_manifest(image_manifest_file).rename(
+        columns=rules["instances_rename"]
     )
-    instances = instances.drop(columns=["modality"])
-    instances["storage_urls"] = instances["storage_urls"].apply(
-        lambda v: v.replace("//", "replicated-data-acr/")
-    )
-
-    if submission in ("ACR_20220314", "ACR_20220415", "ACR_20220715"):
-        instances["storage_urls"] = instances["storage_urls"].apply(
-            lambda v: "/".join(v.split("/")[i] for i in [0, 1, 3, 5])
-        )
+    instances = instances.drop(columns=rules["drop_columns"])
+    instances = rules["instance_transforms"](instances)
 
-    instances["file_name"] = instances["file_name"].apply(lambda v: v.split("/")[-1])
-
-    instances.to_csv(f"{output_path}/instance_{submission}.csv", index=False)
+    write_instances(instances, output_path, submission, output_format)
 
     # list_of_packages = []
 
@@ -158,9 +158,12 @@ def process_submission_new(submission, input_path, output_path):
 
 
 # for everything before (not including) ACR_20220314
-def process_submission_old(submission, input_path, output_path):
+def process_submission_old(
+    submission, input_path, output_path, extra_rules=None, output_format="csv"
+):
     # useful paths for data manipulation
     print(submission)
+    rules = rules_for("acr_old", submission, extra_rules)
     # packages_path = Path(output_path) / submission
     # packages_path.mkdir(parents=True, exist_ok=True)
 
@@ -177,9 +180,6 @@ def process_submission_old(submission, input_path, output_path):
         )
     )
     print(image_manifest_file)
-    studies_file = list(submission_path.glob("**/*imaging_study_*"))
-    if len(studies_file) > 0:
-        studies_file = studies_file[0]
     series_files = list(
         chain(
             submission_path.glob("**/*_series_*.txt"),
@@ -188,151 +188,34 @@ def process_submission_old(submission, input_path, output_path):
     )
     # instance_files = list(SUBMISSION_PATH.glob("*_instance_*.tsv"))
 
-    rename_columns = {
-        "case_ids": "case_id",
-        "Subject_ID": "case_id",
-        "series_uid": "series_id",
-        "dr_exams.submitter_id": "study_id",
-        "ct_scan.submitter_id": "study_id",
-        "ct_scans.submitter_id": "study_id",
-        "mr_exams.submitter_id": "study_id",
-        "nm_exams.submitter_id": "study_id",
-        "pt_scans.submitter_id": "study_id",
-        "pr_exams.submitter_id": "study_id",
-        "rf_exams.submitter_id": "study_id",
-        "series-submitter": "submitter_id",
-        "imaging_studies.submitter_id": "study_id",
-    }
-
-    if submission != "0827":
-        rename_columns.update(
-            {
-                "radiography_exam.submitter_id": "study_id",
-                "radiography_exams.submitter_id": "study_id",
-            }
-        )
-
     series = map(
-        lambda v: pd.read_csv(v, sep="\t").rename(columns=rename_columns), series_files
+        lambda v: read_manifest(v).rename(columns=rules["series_rename"]), series_files
     )
 
-    rename_columns = {
-        "case_ids": "case_id",
-        "study_uid": "study_id",
-        "ct_scans.submitter_id": "study_id",
-        "radiography_exam.submitter_id": "study_id",
-        "series_uid": "series_id",
-        "series.submitter_id": "series_id",
-        "cr_series.submitter_id": "series_id",
-        "ct_series.submitter_id": "series_id",
-        "dx_series.submitter_id": "series_id",
-        "mr_series.submitter_id": "series_id",
-        "us_series.submitter_id": "series_id",
-        "*md5sum": "md5sum",
-        "mdsum": "md5sum",
-        "*file_name": "file_name",
-        "*file_size": "file_size",
-        "submitter_id": "instance_id",
-        "storage_url": "storage_urls",
-    }
-
-    if submission != "0827":
-        rename_columns.update(
-            {
-                "object_id": "instance_id",
-                "instance_uid": "instance_id",
-            }
-        )
-
-        if studies_file:
-            studies = pd.read_csv(studies_file, sep="\t")
-
     instances = map(
-        lambda v: pd.read_csv(v, sep="\t").rename(columns=rename_columns),
+        lambda v: read_manifest(v).rename(columns=rules["instances_rename"]),
         image_manifest_file,
     )
-    if submission == "08":
+    if rules["instance_files"] == "first":
         instances = [list(instances)[0]]
 
     instances = pd.concat(instances, ignore_index=True).reset_index(drop=True)
 
-    # instances["series_id"] = instances["series_id"].apply(lambda v: v.split("_")[1])
-    # instances["study_id"] = instances["study_id"].apply(lambda v: v.split("_")[1])
-
     series = list(series)
 
     if series:
         series = pd.concat(series, ignore_index=True).reset_index(drop=True)
+        series = rules["series_transforms"](series)
+        series = series[rules["series_columns"]].drop_duplicates()
 
-        # series["study_id"] = series["study_id"].apply(lambda v: v.split("_")[1])
-
-        if submission == "0827":
-            # print(series.columns)
-            series["study_id"] = (
-                series["radiography_exams.submitter_id"]
-                .str.split("_")
-                .apply(lambda v: v[1])
-            )
-            series = series[["series_id", "study_id", "case_id"]].drop_duplicates()
-            # print(instances.columns)
-            instances["study_id"] = (
-                instances["storage_urls"].str.split("/").apply(lambda v: v[5])
-            )
-            instances = instances.merge(series, on=["case_id", "series_id"])
-
-        elif submission == "08":
-            series = series[["series_id", "case_id"]].drop_duplicates()
-            instances["study_id"] = (
-                instances["storage_urls"].str.split("/").apply(lambda v: v[5])
-            )
-            instances = instances.merge(series, on=["case_id", "series_id"])
-
-        elif submission == "09":
-            series = series[["series_id", "case_id"]].drop_duplicates()
-            instances["series_id"] = (
-                instances["series_id"].str.split("_").apply(lambda v: v[1])
-            )
-            instances["study_id"] = (
-                instances["storage_urls"].str.split("/").apply(lambda v: v[5])
-            )
-            instances = instances.merge(series, how="left", on=["case_id", "series_id"])
-
-        elif submission == "10":
-            series = series[["series_id", "case_id"]].drop_duplicates()
-            instances["storage_urls"] = instances["storage_urls"].str.replace(
-                "/0914/", "/10/batch6/", regex=False
-            )
-
-            instances["study_id"] = (
-                instances["storage_urls"].str.split("/").apply(lambda v: v[6])
-            )
-            instances["instance_id"] = (
-                instances["instance_id"].str.split("_").apply(lambda v: v[1])
-            )
-            instances["series_id"] = (
-                instances["series_id"].str.split("_").apply(lambda v: v[1])
-            )
-
-        else:
-            series = series[["series_id", "study_id", "case_id"]].drop_duplicates()
-            instances = instances.merge(series, on=["case_id", "series_id"])
-
-    instances["storage_urls"] = instances["storage_urls"].str.replace(
-        "//", "replicated-data-acr/"
-    )
-
-    if submission == "ACRAgeResubmission_20220606":
-        instances["storage_urls"] = instances["storage_urls"].str.replace(
-            "ACRAgeResubmission_20220606",
-            "replicated-data-acr/ACRAgeResubmission_20220606",
-        )
+        instances = rules["instance_transforms"](instances)
+        if rules["merge"] is not None:
+            instances = instances.merge(series, **rules["merge"])
 
-        instances["storage_urls"] = instances["storage_urls"].apply(
-            lambda v: "/".join(v.split("/")[i] for i in [0, 1, 3, 5]) + ".dcm"
-        )
+    instances = rules["url_transforms"](instances)
 
-    if instances["file_size"].dtype == np.dtype("O"):
-        instances["file_size"] = instances["file_size"].apply(lambda v: locale.atoi(v))
+    if not pd.api.types.is_integer_dtype(instances["file_size"]):
+        instances["file_size"] = parse_file_size(instances["file_size"])
     instances = instances[
         [
             "storage_urls",
@@ -348,7 +231,7 @@ def process_submission_old(submission, input_path, output_path):
 
     # instances
 
-    instances.to_csv(f"{output_path}/instance_{submission}.csv", index=False)
+    write_instances(instances, output_path, submission, output_format)
 
     # list_of_packages = []
 
@@ -390,9 +273,22 @@ def process_submission_old(submission, input_path, output_path):
 
 
 if __name__ == "__main__":
+    extra_rules = load_rules(args.rules) if args.rules else None
     if args.new:
         if args.s3key is not None:
             download_manifest(args.s3key, args.submission, args.input_path)
-        process_submission_new(args.submission, args.input_path, args.output_path)
+        process_submission_new(
+            args.submission,
+            args.input_path,
+            args.output_path,
+            extra_rules,
+            args.output_format,
+        )
     else:
-        process_submission_old(args.submission, args.input_path, args.output_path)
+        process_submission_old(
+            args.submission,
+            args.input_path,
+            args.output_path,
+            extra_rules,
+            args.output_format,
+        )
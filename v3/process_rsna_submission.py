@@ -1,18 +1,15 @@
 import argparse
 import csv
-import locale
-import re
 from itertools import chain
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 
-locale.setlocale(locale.LC_ALL, "en_US.UTF-8")
-
-
-def remove_prefix(text, prefix):
-    return text[text.startswith(prefix) and len(prefix) :]
+from v3 import url_normalization as urls
+from v3.instance_output import OUTPUT_FORMATS, write_instances
+from v3.manifest_reader import read_manifest
+from v3.submission_rules import load_rules, rules_for
 
 
 parser = argparse.ArgumentParser(description="Process RSNA submission")
@@ -43,12 +40,28 @@ parser.add_argument(
     action="store_true",
     help='for "new"-style submissions',
 )
+parser.add_argument(
+    "--output_format",
+    action="store",
+    choices=OUTPUT_FORMATS,
+    default="csv",
+    help="write instance_<submission> as CSV, as Parquet sorted by case_id/series_id, or both",
+)
+parser.add_argument(
+    "--rules",
+    action="store",
+    type=str,
+    help="JSON file with extra submission rules, see v3/submission_rules.py",
+)
 args = parser.parse_args()
 
 
 # for everything after and including RSNA_20220329
-def process_submission_new(submission, input_path, output_path):
+def process_submission_new(
+    submission, input_path, output_path, extra_rules=None, output_format="csv"
+):
     print(submission)
+    rules = rules_for("rsna_new", submission, extra_rules)
     # packages_path = Path(output_path) / submission
     # packages_path.mkdir(parents=True, exist_ok=True)
 
@@ -66,14 +79,8 @@ def process_submission_new(submission, input_path, output_path):
     # ), "only one manifest should exist in the submission"
     # image_manifest_file = image_manifest_file[0]
 
-    rename_columns = {
-        "case_ids": "case_id",
-        "study_uid": "study_id",
-        "series_uid": "series_id",
-    }
-
     instances = map(
-        lambda v: pd.read_csv(v, sep="\t").rename(columns=rename_columns),
+        lambda v: read_manifest(v).rename(columns=rules["instances_rename"]),
         image_manifest_file,
     )
     instances = pd.concat(instances, ignore_index=True).reset_index(drop=True)
@@ -81,18 +88,8 @@ def process_submission_new(submission, input_path, output_path):
     # instances = pd.read_csv(image_manifest_file, sep="\t").rename(
     #     columns=rename_columns
     # )
-    instances = instances.drop(columns=["acl", "modality"])
-    instances["storage_urls"] = instances["storage_urls"].apply(
-        lambda v: v.replace("s3://storage.ir.rsna.ai/", "")
-    )
-
-    if submission == "RSNA_20220524":
-        instances["storage_urls"] = instances["storage_urls"].apply(
-            lambda v: v.replace("RSNA_20220520", "RSNA_20220524")
-        )
-
-    instances["file_name"] = instances["file_name"].apply(lambda v: v.split("/")[-1])
-    instances["instance_id"] = instances["file_name"].apply(lambda v: v.split("/")[-1])
+    instances = instances.drop(columns=rules["drop_columns"])
+    instances = rules["instance_transforms"](instances)
 
     instances = instances[
         [
@@ -107,7 +104,7 @@ def process_submission_new(submission, input_path, output_path):
         ]
     ].drop_duplicates()
 
-    instances.to_csv(f"{output_path}/instance_{submission}.csv", index=False)
+    write_instances(instances, output_path, submission, output_format)
 
     # list_of_packages = []
 
@@ -149,9 +146,12 @@ def process_submission_new(submission, input_path, output_path):
 
 
 # for everything before (not including) RSNA_20220329
-def process_submission_old(submission, input_path, output_path):
+def process_submission_old(
+    submission, input_path, output_path, extra_rules=None, output_format="csv"
+):
     # useful paths for data manipulation
     print(submission)
+    rules = rules_for("rsna_old", submission, extra_rules)
     # packages_path = Path(output_path) / submission
     # packages_path.mkdir(parents=True, exist_ok=True)
 
@@ -173,17 +173,14 @@ def process_submission_old(submission, input_path, output_path):
     # instance_files = list(SUBMISSION_PATH.glob("midrc_*_image_*.tsv"))
     # studies_file = list(SUBMISSION_PATH.glob("midrc_imaging_study_*.tsv"))[0]
 
-    id_pattern = r"([\d\.]+)$"
-    id_regex = re.compile(id_pattern)
-
     # load all files into pandas DF's
 
-    image_manifest = pd.read_csv(image_manifest_file, sep="\t")
-    image_manifest["storage_urls"] = image_manifest["storage_urls"].str.replace(
-        "s3://storage.ir.rsna.ai/", "", regex=False
+    image_manifest = read_manifest(image_manifest_file).rename(
+        columns=rules["image_manifest_rename"]
     )
+    image_manifest = rules["image_manifest_transforms"](image_manifest)
 
-    studies = pd.read_csv(studies_file, sep="\t")
+    studies = read_manifest(studies_file)
 
     rename_columns_studies = {
         "cases.submitter_id": "case_id",
@@ -193,11 +190,11 @@ def process_submission_old(submission, input_path, output_path):
 
     studies = studies.rename(columns=rename_columns_studies)
 
-    studies["case_id"] = studies["case_id"].apply(lambda v: remove_prefix(v, "Case_"))
+    studies["case_id"] = urls.remove_prefix(studies["case_id"], "Case_")
 
     studies = studies[["study_id", "case_id"]]
 
-    series = list(map(lambda v: pd.read_csv(v, sep="\t"), series_files))
+    series = list(map(read_manifest, series_files))
 
     rename_columns_series = {
         "imaging_studies.submitter_id": "study_id",
@@ -209,37 +206,16 @@ def process_submission_old(submission, input_path, output_path):
         "series_uid": "series_id",
     }
 
-    if submission == "midrc-ricord-2021-08-20":
-        series = list(
-            map(
-                lambda v: v.rename(columns=rename_columns_series)[
-                    ["series_id", "case_id"]
-                ],
-                series,
-            )
+    series = list(
+        map(
+            lambda v: v.rename(columns=rename_columns_series)[rules["series_columns"]],
+            series,
         )
-
-    else:
-        series = list(
-            map(
-                lambda v: v.rename(columns=rename_columns_series)[
-                    ["series_id", "study_id", "case_id"]
-                ],
-                series,
-            )
-        )
-
-    all_series = pd.concat(series)
-    all_series["case_id"] = all_series["case_id"].apply(
-        lambda v: remove_prefix(v, "Case_")
     )
 
-    if submission != "midrc-ricord-2021-08-20":
-        all_series["study_id"] = all_series["study_id"].apply(
-            lambda v: id_regex.search(v).group(0)
-        )
+    all_series = rules["series_transforms"](pd.concat(series))
 
-    instances = list(map(lambda v: pd.read_csv(v, sep="\t"), instance_files))
+    instances = list(map(read_manifest, instance_files))
 
     rename_columns_instances = {
         "cr_series.submitter_id": "series_id",
@@ -257,16 +233,7 @@ def process_submission_old(submission, input_path, output_path):
         map(lambda v: v.rename(columns=rename_columns_instances), instances)
     )
 
-    all_instances = pd.concat(instances)
-    all_instances["case_id"] = all_instances["case_id"].apply(
-        lambda v: remove_prefix(v, "Case_")
-    )
-    all_instances["instance_id"] = all_instances["instance_id"].apply(
-        lambda v: id_regex.search(v).group(0)
-    )
-    all_instances["series_id"] = all_instances["series_id"].apply(
-        lambda v: id_regex.search(v).group(0)
-    )
+    all_instances = rules["instance_transforms"](pd.concat(instances))
 
     all_instances = all_instances[
         [
@@ -280,36 +247,12 @@ def process_submission_old(submission, input_path, output_path):
         ]
     ]
 
-    # fix for RSNA_20220314
-    if submission == "RSNA_20220314":
-        all_instances["storage_urls"] = all_instances["storage_urls"].str.replace(
-            "RSNA_20220307", "RSNA_20220314", regex=False
-        )
-
-    if submission == "midrc-ricord-2021-08-20":
-        rename_columns_image_manifest = {
-            "case_ids": "case_id",
-            "series_uid": "series_id",
-            "study_uid": "study_id",
-        }
-        image_manifest = image_manifest.rename(columns=rename_columns_image_manifest)
-        image_manifest["storage_urls"] = image_manifest["storage_urls"].str.replace(
-            "midrc-ricord-2021-08-10", "midrc-ricord-2021-08-20", regex=False
-        )
-        all_instances["storage_urls"] = all_instances["storage_urls"].str.replace(
-            "midrc-ricord-2021-08-10", "midrc-ricord-2021-08-20", regex=False
-        )
-
-    all_instances["storage_urls"] = all_instances["storage_urls"].str.replace(
-        "s3://storage.ir.rsna.ai/", "", regex=False
-    )
+    tables = {"instances": all_instances, "series": all_series, "studies": studies}
+    merged = image_manifest
+    for table in rules["merge"]:
+        merged = merged.merge(tables[table])
 
-    if submission == "midrc-ricord-2021-08-20":
-        merged = image_manifest.merge(all_instances)
-    else:
-        merged = image_manifest.merge(all_instances).merge(all_series).merge(studies)
-
-    merged["file_name"] = merged["instance_id"].apply(lambda v: f"{v}.dcm")
+    merged["file_name"] = urls.add_suffix(merged["instance_id"], ".dcm")
     merged = merged[
         [
             "storage_urls",
@@ -329,7 +272,7 @@ def process_submission_old(submission, input_path, output_path):
     #     index=False,
     # )
 
-    merged.to_csv(f"{output_path}/instance_{submission}.csv", index=False)
+    write_instances(merged, output_path, submission, output_format)
 
     # print(
     #     f"image manifest: {image_manifest.shape}\nmerged manifest: {merged.shape}\nall instances: {all_instances.shape}"
@@ -378,7 +321,20 @@ def process_submission_old(submission, input_path, output_path):
 
 
 if __name__ == "__main__":
+    extra_rules = load_rules(args.rules) if args.rules else None
     if args.new:
-        process_submission_new(args.submission, args.input_path, args.output_path)
+        process_submission_new(
+            args.submission,
+            args.input_path,
+            args.output_path,
+            extra_rules,
+            args.output_format,
+        )
     else:
-        process_submission_old(args.submission, args.input_path, args.output_path)
+        process_submission_old(
+            args.submission,
+            args.input_path,
+            args.output_path,
+            extra_rules,
+            args.output_format,
+        )
@@ -0,0 +1,153 @@
+"""
+S3 Inventory (Parquet) helpers for diff-based bucket syncs
+
+An inventory is addressed by its manifest.json, either as an s3:// URL or as
+a local path inside a mirror of the inventory bucket (so the Parquet files
+listed in the manifest are found relative to the mirror root), e.g.
+
+    s3://<inventory-bucket>/<bucket>/<config>/2022-06-26T00-00Z/manifest.json
+    /wd/inventory/<bucket>/<config>/2022-06-26T00-00Z/manifest.json
+"""
+
+import json
+import math
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import urlparse
+
+import boto3
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+INVENTORY_COLUMNS = ["key", "size", "e_tag"]
+
+
+def _read_manifest(manifest_path, s3_client):
+    """
+    Returns (manifest dict, function reading one listed data file into an Arrow table)
+    """
+    if manifest_path.startswith("s3://"):
+        url = urlparse(manifest_path)
+        body = s3_client.get_object(Bucket=url.netloc, Key=url.path.lstrip("/"))["Body"]
+        manifest = json.load(body)
+
+        def read_file(key):
+            data = s3_client.get_object(Bucket=url.netloc, Key=key)["Body"].read()
+            return pq.read_table(BytesIO(data), columns=INVENTORY_COLUMNS)
+
+    else:
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        # <root>/<bucket>/<config>/<date>/manifest.json, data files are <root>/<file key>
+        root = Path(manifest_path).resolve().parents[3]
+
+        def read_file(key):
+            return pq.read_table(root / key, columns=INVENTORY_COLUMNS)
+
+    assert (
+        manifest.get("fileFormat") == "Parquet"
+    ), "Only Parquet inventories are supported: {}".format(manifest_path)
+    return manifest, read_file
+
+
+def read_inventory(manifest_path, keys=None, prefixes=None, s3_client=None):
+    """
+    Loads the key, size and e_tag columns of an S3 Inventory into one Arrow table
+
+    keys and prefixes optionally restrict the rows to a set of keys and/or to
+    keys starting with any of the prefixes; filtering happens per data file so
+    only matching rows are kept in memory.
+    """
+    s3_client = s3_client or boto3.client("s3")
+    manifest, read_file = _read_manifest(manifest_path, s3_client)
+    key_set = pa.array(sorted(set(keys)), pa.string()) if keys is not None else None
+
+    tables = []
+    for data_file in manifest["files"]:
+        table = read_file(data_file["key"])
+        mask = None
+        if key_set is not None:
+            mask = pc.is_in(table["key"], value_set=key_set)
+        if prefixes:
+            prefix_mask = pc.starts_with(table["key"], pattern=prefixes[0])
+            for prefix in prefixes[1:]:
+                prefix_mask = pc.or_(
+                    prefix_mask, pc.starts_with(table["key"], pattern=prefix)
+                )
+            mask = prefix_mask if mask is None else pc.and_(mask, prefix_mask)
+        if mask is not None:
+            table = table.filter(mask)
+        tables.append(table)
+
+    if not tables:
+        return pa.table(
+            {
+                "key": pa.array([], pa.string()),
+                "size": pa.array([], pa.int64()),
+                "e_tag": pa.array([], pa.string()),
+            }
+        )
+    return pa.concat_tables(tables)
+
+
+def already_copied(src, dst, part_size, md5=None):
+    """
+    True if the destination object (a {"Size", "ETag"} dict from a LIST) has
+    the source's size and ETag, or the ETag a copy of the source gets
+
+    A multipart copy gets a new '<hash>-<parts>' ETag that depends on the part
+    size; it is accepted when its part count is the one a copy with part_size
+    produces. A multipart source copied with a single CopyObject (smaller
+    than part_size) gets the plain MD5 of its content; it is accepted when it
+    equals md5, the object's MD5 from the indexed manifest.
+    """
+    if src is None or dst is None or src["Size"] != dst["Size"]:
+        return False
+    if src["ETag"] == dst["ETag"]:
+        return True
+    dst_etag = dst["ETag"].strip('"')
+    if "-" in dst_etag:
+        return int(dst_etag.split("-")[1]) == math.ceil(src["Size"] / part_size)
+    return md5 is not None and dst_etag == md5
+
+
+def inventory_delta(src, dst, part_size=None, md5s=None):
+    """
+    Returns the rows of src missing from dst or differing in size or ETag
+
+    Both tables come from read_inventory. A destination with the same size
+    but another ETag is still accepted as a copy, as in already_copied:
+    - when part_size is given, a multipart ETag ('<hash>-<parts>') whose part
+      count matches a copy made with that part size, since multipart copies
+      never reproduce the source ETag;
+    - when md5s ({key: md5}) is given, a plain ETag equal to the key's md5,
+      which is what a multipart source copied with a single CopyObject gets.
+    Without md5s, such single-part copies of multipart sources always stay in
+    the delta, as the inventory has no other record of their content MD5.
+    """
+    dst = dst.rename_columns(["key", "dst_size", "dst_e_tag"])
+    joined = src.join(dst, keys="key", join_type="left outer")
+
+    missing = pc.is_null(joined["dst_size"])
+    differs = pc.or_(
+        pc.not_equal(joined["size"], joined["dst_size"]),
+        pc.not_equal(joined["e_tag"], joined["dst_e_tag"]),
+    )
+    delta = joined.filter(pc.or_(missing, pc.fill_null(differs, True)))
+
+    if (part_size is not None or md5s) and delta.num_rows:
+        df = delta.to_pandas()
+        dst_e_tag = df["dst_e_tag"].fillna("").str.strip('"')
+        copied = pd.Series(False, index=df.index)
+        if part_size is not None:
+            parts = dst_e_tag.str.extract(r"-(\d+)$", expand=False).astype(float)
+            expected = (df["size"] / part_size).apply(math.ceil)
+            copied |= parts == expected
+        if md5s:
+            copied |= ~dst_e_tag.str.contains("-") & (dst_e_tag == df["key"].map(md5s))
+        copied &= df["size"] == df["dst_size"]
+        delta = pa.Table.from_pandas(df.loc[~copied], preserve_index=False)
+
+    return delta.select(["key", "size", "e_tag"])
@@ -0,0 +1,316 @@
+"""
+Per-submission processing rules for the ACR and RSNA processors
+
+Each registry maps submission name patterns (fnmatch, e.g. "ACR_2022031*")
+to the parts of processing that differ between submissions: column rename
+maps, column transforms and how the instance, series and study tables are
+merged. The "*" rule holds the defaults; every other pattern matching a
+submission overrides the keys it sets, in registry order.
+
+Transforms are lists of steps [op, column, *params] compiled once into
+column operations from v3.url_normalization:
+
+    ["urls", column, org]                      org storage URL rewrites
+    ["replace", column, old, new]              literal replacement
+    ["basename", column]                       last '/' component
+    ["component", column, source, index, sep]  source.split(sep)[index]
+    ["join_components", column, indices, suffix]
+    ["remove_prefix", column, prefix]
+    ["trailing_uid", column]                   UID at the end of an ID
+    ["copy", column, source]
+
+New batches can be handled without a code edit by passing a JSON file of
+extra rules, {"<registry>": {"<pattern>": {...}}}, with --rules.
+"""
+
+import json
+from fnmatch import fnmatchcase
+
+from v3 import url_normalization as urls
+
+TRANSFORMS = {
+    "urls": lambda df, column, org: urls.normalize_storage_urls(df[column], org),
+    "replace": lambda df, column, old, new: urls.replace(df[column], old, new),
+    "basename": lambda df, column: urls.basename(df[column]),
+    "component": lambda df, column, source, index, sep="/": urls.path_component(
+        df[source], index, sep
+    ),
+    "join_components": lambda df, column, indices, suffix="": urls.join_path_components(
+        df[column], indices, suffix=suffix
+    ),
+    "remove_prefix": lambda df, column, prefix: urls.remove_prefix(df[column], prefix),
+    "trailing_uid": lambda df, column: urls.trailing_uid(df[column]),
+    "copy": lambda df, column, source: df[source],
+}
+
+ACR_SERIES_RENAME = {
+    "case_ids": "case_id",
+    "Subject_ID": "case_id",
+    "series_uid": "series_id",
+    "dr_exams.submitter_id": "study_id",
+    "ct_scan.submitter_id": "study_id",
+    "ct_scans.submitter_id": "study_id",
+    "mr_exams.submitter_id": "study_id",
+    "nm_exams.submitter_id": "study_id",
+    "pt_scans.submitter_id": "study_id",
+    "pr_exams.submitter_id": "study_id",
+    "rf_exams.submitter_id": "study_id",
+    "series-submitter": "submitter_id",
+    "imaging_studies.submitter_id": "study_id",
+}
+ACR_RADIOGRAPHY_RENAME = {
+    "radiography_exam.submitter_id": "study_id",
+    "radiography_exams.submitter_id": "study_id",
+}
+ACR_INSTANCES_RENAME = {
+    "case_ids": "case_id",
+    "study_uid": "study_id",
+    "ct_scans.submitter_id": "study_id",
+    "radiography_exam.submitter_id": "study_id",
+    "series_uid": "series_id",
+    "series.submitter_id": "series_id",
+    "cr_series.submitter_id": "series_id",
+    "ct_series.submitter_id": "series_id",
+    "dx_series.submitter_id": "series_id",
+    "mr_series.submitter_id": "series_id",
+    "us_series.submitter_id": "series_id",
+    "*md5sum": "md5sum",
+    "mdsum": "md5sum",
+    "*file_name": "file_name",
+    "*file_size": "file_size",
+    "submitter_id": "instance_id",
+    "storage_url": "storage_urls",
+}
+ACR_INSTANCE_UID_RENAME = {
+    "object_id": "instance_id",
+    "instance_uid": "instance_id",
+}
+
+# ACR submissions from ACR_20220314 on (process_submission_new)
+ACR_NEW = {
+    "*": {
+        "instances_rename": {
+            "case_ids": "case_id",
+            "study_uid": "study_id",
+            "series_uid": "series_id",
+            "instance_uid": "instance_id",
+        },
+        "drop_columns": ["modality"],
+        "instance_transforms": [
+            ["urls", "storage_urls", "ACR"],
+            ["basename", "file_name"],
+        ],
+    },
+    # storage_urls carry two extra path levels
+    "ACR_20220314": {
+        "instance_transforms": [
+            ["urls", "storage_urls", "ACR"],
+            ["join_components", "storage_urls", [0, 1, 3, 5]],
+            ["basename", "file_name"],
+        ],
+    },
+}
+ACR_NEW["ACR_20220415"] = ACR_NEW["ACR_20220715"] = ACR_NEW["ACR_20220314"]
+
+# ACR submissions before ACR_20220314 (process_submission_old)
+ACR_OLD = {
+    "*": {
+        "series_rename": {**ACR_SERIES_RENAME, **ACR_RADIOGRAPHY_RENAME},
+        "instances_rename": {**ACR_INSTANCES_RENAME, **ACR_INSTANCE_UID_RENAME},
+        # "all" image manifests, or only the "first" one
+        "instance_files": "all",
+        "series_transforms": [],
+        "series_columns": ["series_id", "study_id", "case_id"],
+        "instance_transforms": [],
+        # how instances are merged with series; null keeps the instances as they are
+        "merge": {"on": ["case_id", "series_id"], "how": "inner"},
+        "url_transforms": [["urls", "storage_urls", "ACR"]],
+    },
+    "0827": {
+        "series_rename": ACR_SERIES_RENAME,
+        "instances_rename": ACR_INSTANCES_RENAME,
+        "series_transforms": [
+            ["component", "study_id", "radiography_exams.submitter_id", 1, "_"]
+        ],
+        "instance_transforms": [["component", "study_id", "storage_urls", 5]],
+    },
+    "08": {
+        "instance_files": "first",
+        "series_columns": ["series_id", "case_id"],
+        "instance_transforms": [["component", "study_id", "storage_urls", 5]],
+    },
+    "09": {
+        "series_columns": ["series_id", "case_id"],
+        "instance_transforms": [
+            ["component", "series_id", "series_id", 1, "_"],
+            ["component", "study_id", "storage_urls", 5],
+        ],
+        "merge": {"on": ["case_id", "series_id"], "how": "left"},
+    },
+    "10": {
+        "series_columns": ["series_id", "case_id"],
+        "instance_transforms": [
+            ["replace", "storage_urls", "/0914/", "/10/batch6/"],
+            ["component", "study_id", "storage_urls", 6],
+            ["component", "instance_id", "instance_id", 1, "_"],
+            ["component", "series_id", "series_id", 1, "_"],
+        ],
+        "merge": None,
+    },
+    "ACRAgeResubmission_20220606": {
+        "url_transforms": [
+            ["urls", "storage_urls", "ACR"],
+            [
+                "replace",
+                "storage_urls",
+                "ACRAgeResubmission_20220606",
+                "replicated-data-acr/ACRAgeResubmission_20220606",
+            ],
+            ["join_components", "storage_urls", [0, 1, 3, 5], ".dcm"],
+        ],
+    },
+}
+
+# RSNA submissions from RSNA_20220329 on (process_submission_new)
+RSNA_NEW = {
+    "*": {
+        "instances_rename": {
+            "case_ids": "case_id",
+            "study_uid": "study_id",
+            "series_uid": "series_id",
+        },
+        "drop_columns": ["acl", "modality"],
+        "instance_transforms": [
+            ["urls", "storage_urls", "RSNA"],
+            ["basename", "file_name"],
+            ["copy", "instance_id", "file_name"],
+        ],
+    },
+    # files were uploaded under the name of an earlier batch
+    "RSNA_20220524": {
+        "instance_transforms": [
+            ["urls", "storage_urls", "RSNA"],
+            ["replace", "storage_urls", "RSNA_20220520", "RSNA_20220524"],
+            ["basename", "file_name"],
+            ["copy", "instance_id", "file_name"],
+        ],
+    },
+}
+
+# RSNA submissions before RSNA_20220329 (process_submission_old)
+RSNA_OLD = {
+    "*": {
+        "image_manifest_rename": {},
+        "image_manifest_transforms": [["urls", "storage_urls", "RSNA"]],
+        "series_columns": ["series_id", "study_id", "case_id"],
+        "series_transforms": [
+            ["remove_prefix", "case_id", "Case_"],
+            ["trailing_uid", "study_id"],
+        ],
+        "instance_transforms": [
+            ["remove_prefix", "case_id", "Case_"],
+            ["trailing_uid", "instance_id"],
+            ["trailing_uid", "series_id"],
+            ["urls", "storage_urls", "RSNA"],
+        ],
+        # tables merged into the image manifest, in order
+        "merge": ["instances", "series", "studies"],
+    },
+    "RSNA_20220314": {
+        "instance_transforms": [
+            ["remove_prefix", "case_id", "Case_"],
+            ["trailing_uid", "instance_id"],
+            ["trailing_uid", "series_id"],
+            ["replace", "storage_urls", "RSNA_20220307", "RSNA_20220314"],
+            ["urls", "storage_urls", "RSNA"],
+        ],
+    },
+    "midrc-ricord-2021-08-20": {
+        "image_manifest_rename": {
+            "case_ids": "case_id",
+            "series_uid": "series_id",
+            "study_uid": "study_id",
+        },
+        "image_manifest_transforms": [
+            ["urls", "storage_urls", "RSNA"],
+            [
+                "replace",
+                "storage_urls",
+                "midrc-ricord-2021-08-10",
+                "midrc-ricord-2021-08-20",
+            ],
+        ],
+        "series_columns": ["series_id", "case_id"],
+        "series_transforms": [["remove_prefix", "case_id", "Case_"]],
+        "instance_transforms": [
+            ["remove_prefix", "case_id", "Case_"],
+            ["trailing_uid", "instance_id"],
+            ["trailing_uid", "series_id"],
+            [
+                "replace",
+                "storage_urls",
+                "midrc-ricord-2021-08-10",
+                "midrc-ricord-2021-08-20",
+            ],
+            ["urls", "storage_urls", "RSNA"],
+        ],
+        "merge": ["instances"],
+    },
+}
+
+REGISTRIES = {
+    "acr_new": ACR_NEW,
+    "acr_old": ACR_OLD,
+    "rsna_new": RSNA_NEW,
+    "rsna_old": RSNA_OLD,
+}
+
+
+def compile_transforms(steps):
+    """
+    Turns transform steps into one function applying them to a DataFrame in place
+    """
+    compiled = []
+    for op, column, *params in steps:
+        assert op in TRANSFORMS, "Unknown transform '{}', expected one of {}".format(
+            op, list(TRANSFORMS)
+        )
+        compiled.append((TRANSFORMS[op], column, params))
+
+    def transform(df):
+        for func, column, params in compiled:
+            df[column] = func(df, column, *params)
+        return df
+
+    return transform
+
+
+def load_rules(path):
+    """
+    Reads extra rules from a JSON file shaped like REGISTRIES
+    """
+    with open(path, encoding="utf8") as rules_file:
+        extra = json.load(rules_file)
+    unknown = set(extra) - set(REGISTRIES)
+    assert not unknown, "Unknown rule registries {} in {}".format(sorted(unknown), path)
+    return extra
+
+
+def rules_for(registry, submission, extra=None):
+    """
+    Resolves the rules of a submission from a registry name and optional
+    extra rules (from load_rules); keys ending in "_transforms" are
+    compiled into functions
+    """
+    patterns = dict(REGISTRIES[registry])
+    patterns.update((extra or {}).get(registry, {}))
+
+    rules = dict(patterns["*"])
+    for pattern, overrides in patterns.items():
+        if pattern != "*" and fnmatchcase(submission, pattern):
+            rules.update(overrides)
+
+    for key in rules:
+        if key.endswith("_transforms"):
+            rules[key] = compile_transforms(rules[key])
+    return rules
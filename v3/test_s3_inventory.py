@@ -0,0 +1,147 @@
+import hashlib
+import os
+
+import boto3
+import pyarrow as pa
+import pytest
+from boto3.s3.transfer import TransferConfig
+from moto import mock_aws
+
+from v3.s3_inventory import already_copied, inventory_delta
+
+MiB = 1024 * 1024
+PART_SIZE = 64 * MiB
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.delenv("AWS_ENDPOINT_URL", raising=False)
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="src")
+        client.create_bucket(Bucket="dst")
+        yield client
+
+
+def listed(client, bucket, key):
+    obj = client.list_objects_v2(Bucket=bucket, Prefix=key)["Contents"][0]
+    return {"Size": obj["Size"], "ETag": obj["ETag"]}
+
+
+def upload_multipart(client, bucket, key, parts):
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+    etags = [
+        client.upload_part(
+            Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=part
+        )["ETag"]
+        for number, part in enumerate(parts, 1)
+    ]
+    client.complete_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        UploadId=upload_id,
+        MultipartUpload={
+            "Parts": [
+                {"ETag": etag, "PartNumber": number}
+                for number, etag in enumerate(etags, 1)
+            ]
+        },
+    )
+
+
+def test_multipart_source_copied_as_single_part(s3_client):
+    # a 15 MiB package uploaded in 3 parts, copied below the part size with one CopyObject
+    key = "zip/case/study/series.zip"
+    parts = [os.urandom(5 * MiB) for _ in range(3)]
+    upload_multipart(s3_client, "src", key, parts)
+    config = TransferConfig(
+        multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE
+    )
+    s3_client.copy({"Bucket": "src", "Key": key}, "dst", key, Config=config)
+
+    src, dst = listed(s3_client, "src", key), listed(s3_client, "dst", key)
+    assert src["ETag"].strip('"').endswith("-3")
+    assert "-" not in dst["ETag"]
+
+    md5 = hashlib.md5(b"".join(parts)).hexdigest()
+    assert already_copied(src, dst, PART_SIZE, md5)
+    assert not already_copied(src, dst, PART_SIZE)
+    assert not already_copied(src, dst, PART_SIZE, "0" * 32)
+
+
+def test_multipart_copy(s3_client):
+    key = "zip/case/study/series.zip"
+    s3_client.put_object(Bucket="src", Key=key, Body=os.urandom(12 * MiB))
+    config = TransferConfig(multipart_threshold=5 * MiB, multipart_chunksize=5 * MiB)
+    s3_client.copy({"Bucket": "src", "Key": key}, "dst", key, Config=config)
+
+    src, dst = listed(s3_client, "src", key), listed(s3_client, "dst", key)
+    assert dst["ETag"].strip('"').endswith("-3")
+    assert already_copied(src, dst, 5 * MiB)
+    assert not already_copied(src, dst, PART_SIZE)
+
+
+def test_size_mismatch():
+    assert not already_copied(
+        {"Size": 1, "ETag": '"a"'}, {"Size": 2, "ETag": '"a"'}, PART_SIZE, "a"
+    )
+    assert not already_copied({"Size": 1, "ETag": '"a"'}, None, PART_SIZE)
+
+
+def inventory(rows):
+    keys, sizes, e_tags = zip(*rows)
+    return pa.table(
+        {
+            "key": pa.array(keys, pa.string()),
+            "size": pa.array(sizes, pa.int64()),
+            "e_tag": pa.array(e_tags, pa.string()),
+        }
+    )
+
+
+def test_inventory_delta():
+    md5 = "0" * 31 + "1"
+    src = inventory(
+        [
+            ("same", 10, "a"),
+            ("missing", 10, "b"),
+            ("single_part_copy", 15 * MiB, "c-3"),
+            ("other_content", 15 * MiB, "d-3"),
+            ("multipart_copy", 150 * MiB, "e-30"),
+            ("resized", 10, "f"),
+        ]
+    )
+    dst = inventory(
+        [
+            ("same", 10, "a"),
+            ("single_part_copy", 15 * MiB, md5),
+            ("other_content", 15 * MiB, "0" * 32),
+            ("multipart_copy", 150 * MiB, "g-3"),
+            ("resized", 11, "f"),
+        ]
+    )
+    md5s = {"single_part_copy": md5, "other_content": md5}
+
+    def delta(**kwargs):
+        return sorted(inventory_delta(src, dst, **kwargs)["key"].to_pylist())
+
+    assert delta() == [
+        "missing",
+        "multipart_copy",
+        "other_content",
+        "resized",
+        "single_part_copy",
+    ]
+    assert delta(part_size=PART_SIZE) == [
+        "missing",
+        "other_content",
+        "resized",
+        "single_part_copy",
+    ]
+    assert delta(part_size=PART_SIZE, md5s=md5s) == [
+        "missing",
+        "other_content",
+        "resized",
+    ]
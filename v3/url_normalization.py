@@ -0,0 +1,132 @@
+"""
+Vectorized storage URL and file name normalization
+
+The submission processors used to rewrite storage_urls, file_name and the
+IDs derived from them with Series.apply(lambda ...), a Python call per row.
+These helpers do the same rewrites with pyarrow compute kernels over the
+whole column; each one returns exactly what the lambda it replaces returned.
+
+Per-organization URL rewrites are data in ORG_URL_REPLACEMENTS, so the
+row-at-a-time packaging scripts apply the same rules with
+normalize_storage_url.
+"""
+
+import re
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+TCIA_UPLOAD_BUCKET = "midrcprod-default-813684607867-upload"
+
+# literal (old, new) replacements applied in order, every occurrence replaced
+ORG_URL_REPLACEMENTS = {
+    # '//ACR_20220606/...' is relative to the replicated-data-acr prefix
+    "ACR": [("//", "replicated-data-acr/")],
+    "RSNA": [("s3://storage.ir.rsna.ai/", "")],
+    # upload bucket URLs, sometimes written as a one-element list "['s3://...']"
+    "TCIA": [
+        ("[", ""),
+        ("]", ""),
+        ("'", ""),
+        ("s3://{}/".format(TCIA_UPLOAD_BUCKET), ""),
+    ],
+}
+
+
+def _to_arrow(values):
+    return pa.array(values, type=pa.string(), from_pandas=True)
+
+
+def _to_series(result, like):
+    out = result.to_pandas()
+    out.index = like.index
+    out.name = like.name
+    return out if out.dtype == like.dtype else out.astype(like.dtype)
+
+
+def replace(values, old, new):
+    """
+    values.apply(lambda v: v.replace(old, new))
+    """
+    return _to_series(
+        pc.replace_substring(_to_arrow(values), pattern=old, replacement=new), values
+    )
+
+
+def normalize_storage_urls(urls, org):
+    """
+    Applies the URL rewrites of org (ACR, RSNA or TCIA) to a column of
+    storage URLs; URLs of other organizations are returned unchanged
+    """
+    result = _to_arrow(urls)
+    for old, new in ORG_URL_REPLACEMENTS.get(org, []):
+        result = pc.replace_substring(result, pattern=old, replacement=new)
+    return _to_series(result, urls)
+
+
+def normalize_storage_url(url, org):
+    """
+    normalize_storage_urls for a single URL
+    """
+    for old, new in ORG_URL_REPLACEMENTS.get(org, []):
+        url = url.replace(old, new)
+    return url
+
+
+def basename(values):
+    """
+    values.apply(lambda v: v.split("/")[-1])
+    """
+    return _to_series(
+        pc.replace_substring_regex(_to_arrow(values), pattern="^.*/", replacement=""),
+        values,
+    )
+
+
+def path_component(values, index, sep="/"):
+    """
+    values.str.split(sep).apply(lambda v: v[index]) for index >= 0
+    """
+    parts = pc.split_pattern(_to_arrow(values), pattern=sep)
+    return _to_series(pc.list_element(parts, index), values)
+
+
+def join_path_components(values, indices, sep="/", suffix=""):
+    """
+    values.apply(lambda v: sep.join(v.split(sep)[i] for i in indices) + suffix)
+    """
+    parts = pc.split_pattern(_to_arrow(values), pattern=sep)
+    components = [pc.list_element(parts, i) for i in indices]
+    joined = pc.binary_join_element_wise(*components, sep)
+    if suffix:
+        joined = pc.binary_join_element_wise(joined, pa.scalar(suffix), "")
+    return _to_series(joined, values)
+
+
+def add_suffix(values, suffix):
+    """
+    values.apply(lambda v: f"{v}{suffix}")
+    """
+    joined = pc.binary_join_element_wise(_to_arrow(values), pa.scalar(suffix), "")
+    return _to_series(joined, values)
+
+
+def remove_prefix(values, prefix):
+    """
+    values.apply(lambda v: v[v.startswith(prefix) and len(prefix):])
+    """
+    return _to_series(
+        pc.replace_substring_regex(
+            _to_arrow(values), pattern="^" + re.escape(prefix), replacement=""
+        ),
+        values,
+    )
+
+
+def trailing_uid(values):
+    """
+    values.apply(lambda v: re.search(r"([\\d\\.]+)$", v).group(0)), the UID at
+    the end of IDs like 'Series_1.2.840...'
+    """
+    matched = pc.extract_regex(_to_arrow(values), pattern=r"(?P<uid>[\d\.]+)$")
+    return _to_series(pc.struct_field(matched, [0]), values)